@@ -0,0 +1,355 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Benchmarks of the client, run from client directory:
+#   python benchmark.py <benchmark> [options]
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+import yaml
+
+# files needed to run the client in a scratch directory
+CLIENT_FILES = (
+    "chat_client.py", "compression.py", "framing.py", "keystore.py", "client_logging.yaml"
+)
+
+PROMPT = b"Enter your username: "
+
+IMPORT_SCRIPT = (
+    "import time; start = time.perf_counter(); import chat_client; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def measure(function: Callable, iterations: int) -> float:
+    """
+    Run function for given iterations, returning CPU microseconds per call
+    """
+    function()
+    start = time.process_time()
+    for _ in range(iterations):
+        function()
+    return (time.process_time() - start) * 1e6 / iterations
+
+
+def iterations_within(function: Callable, budget: float) -> int:
+    """
+    Iterations of function taking about budget CPU seconds, by timing one call
+    """
+    start = time.process_time()
+    function()
+    return max(1, int(budget / max(time.process_time() - start, 1e-6)))
+
+
+def measure_rounds(cases: dict, budget: float, rounds: int) -> dict:
+    """
+    Least CPU microseconds per call of each function of cases, measured
+    once per round. A busy moment of the machine slows down one round of
+    a case instead of all its measurements.
+    """
+    # sizing calls also warm up, buffers freed by the largest cases change
+    # how later buffers are allocated
+    iterations = {name: iterations_within(function, budget) for name, function in cases.items()}
+    results = {name: float("inf") for name in cases}
+    for _ in range(rounds):
+        for name, function in cases.items():
+            results[name] = min(results[name], measure(function, iterations[name]))
+    return results
+
+
+def print_table(header: list, rows: list):
+    widths = [
+        max(len(str(value)) for value in column) for column in zip(header, *rows)
+    ]
+    for row in [header] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+
+def summary_row(name: str, samples: list) -> list:
+    return [
+        name,
+        f"{statistics.median(samples) * 1000:.1f}",
+        f"{min(samples) * 1000:.1f}",
+        f"{max(samples) * 1000:.1f}",
+    ]
+
+
+def import_time(directory: str) -> float:
+    """
+    Seconds to import chat_client in a fresh interpreter
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=directory, capture_output=True, text=True, check=True
+    )
+    return float(output.stdout.strip())
+
+
+async def time_to_prompt(directory: str, runs: int, env: dict) -> list:
+    """
+    Seconds from starting the client process until it prompts for username
+    """
+    samples = []
+    # first run creates key store if enabled, it is not measured
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "chat_client.py", cwd=directory, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        output = b""
+        while PROMPT not in output:
+            data = await asyncio.wait_for(process.stdout.read(1024), 60)
+            if not data:
+                raise RuntimeError("client exited before prompt")
+            output += data
+        if run:
+            samples.append(time.perf_counter() - start)
+        process.kill()
+        await process.wait()
+    return samples
+
+
+def bench_startup(args):
+    """
+    Compare import time and time to prompt of the client with a session key
+    pair and with a key pair loaded from the key store
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for file_name in CLIENT_FILES:
+            shutil.copy(file_name, directory)
+        rows.append(summary_row(
+            "import chat_client", [import_time(directory) for _ in range(args.runs)]
+        ))
+        env = dict(os.environ, SPCHAT_KEY_PASSPHRASE="benchmark")
+        for name, key_store in (
+            ("prompt, session key", {"enabled": False}),
+            ("prompt, key store", {"enabled": True, "path": "keys/identity.pem"}),
+        ):
+            with open(os.path.join(directory, "client_config.yaml"), "w") as f:
+                yaml.safe_dump({"key_store": key_store}, f)
+            rows.append(summary_row(name, asyncio.run(time_to_prompt(directory, args.runs, env))))
+    print_table(["startup", "median ms", "min ms", "max ms"], rows)
+
+
+def bench_files(args):
+    """
+    Wall clock throughput of sealing and opening a file of --size-mb with
+    one AES-GCM call, and in segments on pools of --workers threads. Opened
+    files are written to a temporary file as segments complete.
+    """
+    from chat_client import SegmentCipher, aes_open, aes_seal, generate_content_key
+    key = generate_content_key()
+    size = args.size_mb * 1024 * 1024
+    rows = []
+    with tempfile.TemporaryFile() as source, tempfile.TemporaryFile() as target:
+        source.write(os.urandom(size))
+        cases = {"single call": (
+            lambda: aes_seal(source.read(), key),
+            lambda sealed: target.write(aes_open(sealed, key)),
+        )}
+        for workers in args.workers:
+            cipher = SegmentCipher(args.segment_kb * 1024, workers)
+            cases[f"{workers} workers"] = (
+                lambda cipher=cipher: cipher.seal_file(source, size, key),
+                lambda sealed, cipher=cipher: cipher.open_to(sealed, key, target),
+            )
+        for name, (seal, open_to) in cases.items():
+            seal_times, open_times = [], []
+            for _ in range(args.runs):
+                source.seek(0)
+                start = time.perf_counter()
+                sealed = seal()
+                seal_times.append(time.perf_counter() - start)
+                target.seek(0)
+                start = time.perf_counter()
+                open_to(sealed)
+                open_times.append(time.perf_counter() - start)
+                del sealed
+            rows.append([
+                name,
+                f"{size / statistics.median(seal_times) / 1e6:.0f}",
+                f"{size / statistics.median(open_times) / 1e6:.0f}",
+            ])
+    print(f"{args.size_mb}MB file, {args.segment_kb}KB segments, {os.cpu_count()} cores")
+    print_table(["files", "seal MB/s", "open MB/s"], rows)
+
+
+# Microbenchmarks of crypto hot paths, checked against BASELINE_FILE by
+# test_client.py when SPCHAT_BENCHMARK_GATE is set
+BASELINE_FILE = "benchmark_baseline.json"
+# allowed slowdown relative to baseline, unless set in BASELINE_FILE
+DEFAULT_TOLERANCE = 0.5
+# runs of microbenchmarks making up a new baseline
+BASELINE_RUNS = 3
+# CPU seconds per measurement, and measurements of each case per run
+MICRO_BUDGET = 0.1
+MICRO_ROUNDS = 5
+
+SIZES = {"1KB": 1024, "64KB": 64 * 1024, "1MB": 1024 * 1024, "50MB": 50 * 1024 * 1024}
+
+
+def calibration_workload():
+    """
+    Fixed pure Python workload, results are stored relative to it so that a
+    baseline applies to faster or slower machines
+    """
+    total = 0
+    for i in range(20000):
+        total += i * i % 7
+    return total
+
+
+def micro_cases() -> dict:
+    """
+    Hot paths as { <name>: function }. Files are sealed with AES-GCM, RSA
+    only encrypts messages and legacy files, at most 64KB are measured as
+    RSA decryption of 1MB takes seconds.
+    """
+    # imported here, so that startup benchmark measures the first import
+    from chat_client import (
+        aes_open, aes_seal, base64_rsa_decrypt, base64_rsa_encrypt, data_split,
+        generate_content_key, get_public_key_pem,
+    )
+    public_key_pem = get_public_key_pem()
+    key = generate_content_key()
+    cases = {}
+    for label, size in SIZES.items():
+        data = os.urandom(size)
+        cases[f"data_split {label}"] = lambda data=data: data_split(data, 190)
+        if size <= SIZES["64KB"]:
+            encrypted = base64_rsa_encrypt(data, public_key_pem)
+            cases[f"rsa encrypt {label}"] = lambda data=data: base64_rsa_encrypt(data, public_key_pem)
+            cases[f"rsa decrypt {label}"] = lambda encrypted=encrypted: base64_rsa_decrypt(encrypted)
+        sealed = aes_seal(data, key)
+        cases[f"aes encrypt {label}"] = lambda data=data: aes_seal(data, key)
+        cases[f"aes decrypt {label}"] = lambda sealed=sealed: aes_open(sealed, key)
+    return cases
+
+
+def run_micro() -> dict:
+    """
+    Microseconds per call of every case, and of the calibration workload
+    as "calibration"
+    """
+    cases = micro_cases()
+    cases["calibration"] = calibration_workload
+    return measure_rounds(cases, MICRO_BUDGET, MICRO_ROUNDS)
+
+
+def load_baseline(path: str = BASELINE_FILE) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(results: dict, tolerance: float, path: str = BASELINE_FILE):
+    calibration = results["calibration"]
+    baseline = {
+        "tolerance": tolerance,
+        "calibration_us": round(calibration, 3),
+        "results": {
+            name: {"us": round(us, 3), "relative": round(us / calibration, 6)}
+            for name, us in results.items() if name != "calibration"
+        },
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float = None) -> List[list]:
+    """
+    Compare results with baseline scaled to this machine by calibration
+
+    Returns:
+        rows of [case, us, baseline us, change, regressed]
+    """
+    if tolerance is None:
+        tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    rows = []
+    for name, us in results.items():
+        expected = baseline["results"].get(name, None)
+        if name == "calibration" or expected is None:
+            continue
+        expected_us = expected["relative"] * results["calibration"]
+        rows.append([name, us, expected_us, us / expected_us - 1, us > expected_us * (1 + tolerance)])
+    return rows
+
+
+def gate_regressions(path: str = BASELINE_FILE) -> List[str]:
+    """
+    Run microbenchmarks and describe cases slower than baseline beyond
+    tolerance, which SPCHAT_BENCHMARK_TOLERANCE overrides
+    """
+    tolerance = os.environ.get("SPCHAT_BENCHMARK_TOLERANCE", None)
+    rows = compare_baseline(
+        run_micro(), load_baseline(path), float(tolerance) if tolerance is not None else None
+    )
+    return [
+        f"{name}: {us:.2f}us, baseline {expected_us:.2f}us ({change:+.0%})"
+        for name, us, expected_us, change, regressed in rows if regressed
+    ]
+
+
+def bench_micro(args):
+    """
+    Microbenchmarks of crypto hot paths compared with the stored baseline,
+    --update-baseline stores the results as new baseline
+    """
+    results = run_micro()
+    if args.update_baseline:
+        # median of runs, so that a baseline is not taken at a slow or fast moment
+        runs = [results] + [run_micro() for _ in range(BASELINE_RUNS - 1)]
+        baseline_results = {name: statistics.median(run[name] for run in runs) for name in results}
+        save_baseline(baseline_results, args.tolerance if args.tolerance is not None else DEFAULT_TOLERANCE)
+        print(f"baseline written to {BASELINE_FILE}")
+    baseline = load_baseline() if os.path.exists(BASELINE_FILE) else {"results": {}}
+    compared = {row[0]: row for row in compare_baseline(results, baseline, args.tolerance)}
+    rows = []
+    for name, us in results.items():
+        if name in compared:
+            _, _, expected_us, change, regressed = compared[name]
+            rows.append([name, f"{us:.2f}", f"{expected_us:.2f}", f"{change:+.0%}", "REGRESSED" if regressed else "ok"])
+        else:
+            rows.append([name, f"{us:.2f}", "-", "-", "-"])
+    print_table(["case", "us", "baseline us", "change", "gate"], rows)
+
+
+BENCHMARKS = {
+    "files": bench_files,
+    "micro": bench_micro,
+    "startup": bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="client benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=None, help="allowed slowdown, 0.5 is 50%%")
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--segment-kb", type=int, default=256)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@
 #          Yu-Ting Huang (a1903622)           #
 ###############################################
 
+import argparse
 import logging
 import logging.config
 import yaml
@@ -16,30 +17,31 @@ import websockets
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import base64
+import io
 import json
 import traceback
 import sys
 import getpass
+import random
+import struct
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from framing import (
+    BINARY_SUBPROTOCOLS, COMMAND_PREFIX, COMMANDS, FLAG_REMOTE, Frame, FrameType, command_to_text,
+    is_binary, pairs_to_fields, parse_server_text, split_batch, text_field,
+)
+from compression import client_extensions, compression_settings
+from tls import client_ssl_context, tls_settings
+from tracing import Tracer, tracing_settings
+from keystore import generate_private_key, load_or_create_private_key, public_key_pem
 
 log_directory = 'log'
 download_directory = 'download'
 
-# Create the log directory if it doesn't exist
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-if not os.path.exists(download_directory):
-    os.makedirs(download_directory)
-
-# Load logging configuration from YAML file
-with open('client_logging.yaml', 'r') as config_file:
-    config = yaml.safe_load(config_file)
-
-# Configure logging based on the YAML configuration
-logging.config.dictConfig(config)
-
-# Create logger
+# Create logger, configured by setup_logging when client starts
 logger = logging.getLogger('chat_client')
 
 
@@ -48,8 +50,20 @@ def log_unhandled_exception(exc_type, exc_value, exc_traceback):
     logger.exception("An unhandled exception occurred:", exc_info=(exc_type, exc_value, exc_traceback))
 
 
-# Set the custom exception handler
-sys.excepthook = log_unhandled_exception
+def setup_logging():
+    # Create the log directory if it doesn't exist
+    if not os.path.exists(log_directory):
+        os.makedirs(log_directory)
+
+    # Load logging configuration from YAML file
+    with open('client_logging.yaml', 'r') as config_file:
+        config = yaml.safe_load(config_file)
+
+    # Configure logging based on the YAML configuration
+    logging.config.dictConfig(config)
+
+    # Set the custom exception handler
+    sys.excepthook = log_unhandled_exception
 
 from datetime import datetime
 
@@ -61,20 +75,75 @@ def get_current_timestamp():
     return timestamp.strftime("%Y%m%d_%H%M%S")
 
 
-# Generate RSA key pair as client startup
-local_private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-local_public_key = local_private_key.public_key()
-
-local_public_key_pem = local_public_key.public_bytes(
-    encoding=serialization.Encoding.PEM,
-    format=serialization.PublicFormat.SubjectPublicKeyInfo,
-).decode("utf-8")
+# identity key pair of client in format { private_key, public_key_pem },
+# loaded from key store when client starts, otherwise generated on first use
+identity = {}
 
 default_padding = padding.OAEP(
     mgf=padding.MGF1(algorithm=hashes.SHA1()), algorithm=hashes.SHA256(), label=None
 )
 
-current_presence = []
+# joined rooms in format
+# { <room>: { jid, members: [presence], key_id, key } }
+# where jid is own jid, key is own sender key of the room, rotated when
+# room membership changes
+joined_rooms = {}
+
+# sender keys of other room members in format
+# { (<room>, <sender jid>, <key_id>): key }
+room_keys = {}
+
+# seconds between reconnection attempts, doubled after each failure
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# seconds to wait for a roster query response
+ROSTER_QUERY_TIMEOUT = 5
+# page size used when looking up the public key of a single user
+ROSTER_LOOKUP_LIMIT = 10
+
+
+def read_passphrase(key_store_config: dict) -> str:
+    """
+    Read key store passphrase from the environment variable named in config,
+    or prompt for it
+    """
+    passphrase = os.environ.get(key_store_config.get("passphrase_env", "SPCHAT_KEY_PASSPHRASE"), None)
+    if passphrase is None:
+        passphrase = getpass.getpass("Enter key store passphrase: ")
+    return passphrase
+
+
+def load_identity(key_store_config: dict, passphrase: str):
+    """
+    Load identity key pair from key store if it is enabled, otherwise
+    generate a key pair for this session
+
+    Raises:
+        ValueError if the passphrase does not decrypt the key store
+    """
+    if not key_store_config.get("enabled", False):
+        get_private_key()
+        return
+    private_key = load_or_create_private_key(
+        key_store_config.get("path", "keys/identity.pem"), passphrase.encode("utf-8")
+    )
+    identity["private_key"] = private_key
+    identity["public_key_pem"] = public_key_pem(private_key)
+
+
+def get_private_key():
+    if "private_key" not in identity:
+        # no key store, key pair lasts for this session only
+        private_key = generate_private_key()
+        identity["private_key"] = private_key
+        identity["public_key_pem"] = public_key_pem(private_key)
+    return identity["private_key"]
+
+
+def get_public_key_pem() -> str:
+    get_private_key()
+    return identity["public_key_pem"]
 
 
 # Split data into chunks
@@ -85,35 +154,48 @@ def data_split(data:bytes, chunk_size:int):
     return chunks
 
 
-def base64_rsa_encrypt(data_bytes: bytes, public_key_pem: str) -> str:
+def rsa_encrypt(data_bytes: bytes, public_key_pem: str) -> bytes:
     """
-    Encrypts data using given RSA public key and base64.
+    Encrypts data using given RSA public key.
     Due to the limitation of RSA encryption, data is split into chunks of
     190 bytes, then encrypt chunk by chunk and then combine all encrypted
-    chunks together, and finally apply base64 encoding.
+    chunks together.
     """
     public_key = serialization.load_pem_public_key(public_key_pem.encode("utf-8"))
     if not isinstance(public_key, rsa.RSAPublicKey):
         raise ValueError("Invalid public key format")
-    encrypted_data = b''
-    for data_chunk in data_split(data_bytes, 190):
-        encrypted_data += public_key.encrypt(data_chunk, default_padding)
-    return base64.b64encode(
-        encrypted_data
-    ).decode("utf-8")
+    return b''.join(
+        public_key.encrypt(data_chunk, default_padding)
+        for data_chunk in data_split(data_bytes, 190)
+    )
 
 
-def base64_rsa_decrypt(encrypted_message: str) -> bytes:
+def rsa_decrypt(encrypted_data) -> bytes:
     """
-    Decrypts data using given RSA private key and base64.
-    Due to the limitation of RSA encryption, decoded data is split into chunks of
+    Decrypts data using local RSA private key.
+    Due to the limitation of RSA encryption, data is split into chunks of
     256 bytes, then decrypt chunk by chunk and then combine all decrypted
     chunks together to restore original data
     """
-    decrypted_data = b''
-    for data_chunk in data_split(base64.b64decode(encrypted_message), 256):
-        decrypted_data += local_private_key.decrypt(data_chunk, default_padding)
-    return decrypted_data
+    private_key = get_private_key()
+    return b''.join(
+        private_key.decrypt(data_chunk, default_padding)
+        for data_chunk in data_split(bytes(encrypted_data), 256)
+    )
+
+
+def base64_rsa_encrypt(data_bytes: bytes, public_key_pem: str) -> str:
+    """
+    Encrypts data using given RSA public key and base64.
+    """
+    return base64.b64encode(rsa_encrypt(data_bytes, public_key_pem)).decode("utf-8")
+
+
+def base64_rsa_decrypt(encrypted_message: str) -> bytes:
+    """
+    Decrypts base64 data using local RSA private key.
+    """
+    return rsa_decrypt(base64.b64decode(encrypted_message))
 
 
 def encrypt_message(message: str, public_key_pem: str):
@@ -132,6 +214,348 @@ def decrypt_file_data(encrypted_data):
     return base64_rsa_decrypt(encrypted_data)
 
 
+def generate_content_key() -> bytes:
+    return AESGCM.generate_key(bit_length=256)
+
+
+def aes_seal(data_bytes: bytes, key: bytes) -> bytes:
+    """
+    Encrypts data using AES-256-GCM with given key.
+    Random 12 bytes nonce is prepended to the ciphertext.
+    """
+    nonce = os.urandom(12)
+    return nonce + AESGCM(key).encrypt(nonce, data_bytes, None)
+
+
+def aes_open(encrypted_data, key: bytes) -> bytes:
+    data = memoryview(encrypted_data)
+    return AESGCM(key).decrypt(data[:12], data[12:], None)
+
+
+def aes_encrypt(data_bytes: bytes, key: bytes) -> str:
+    """
+    Encrypts data using AES-256-GCM with given key and base64.
+    """
+    return base64.b64encode(aes_seal(data_bytes, key)).decode("utf-8")
+
+
+def aes_decrypt(encrypted_data: str, key: bytes) -> bytes:
+    return aes_open(base64.b64decode(encrypted_data), key)
+
+
+# files are sealed in segments, each authenticated with the header, its
+# index and a flag marking the last one, so that segments cannot be
+# reordered, dropped or cut off at the end. Header is in format
+# <version> <segment bytes> <nonce prefix>
+SEGMENTED_FILE_VERSION = 1
+SEGMENT_HEADER = struct.Struct(">BI7s")
+SEGMENT_TAG_BYTES = 16
+
+
+def file_cipher_settings(file_encryption_config: dict) -> dict:
+    """
+    SegmentCipher arguments from file_encryption section of config, workers
+    of 0 use every core
+    """
+    return {
+        "segment_bytes": file_encryption_config.get("segment_bytes", 256 * 1024),
+        "workers": file_encryption_config.get("workers", 0) or os.cpu_count() or 1,
+    }
+
+
+def seal_segment(key: bytes, header: bytes, index: int, last: bool, data) -> bytes:
+    nonce = header[-7:] + struct.pack(">IB", index, last)
+    return AESGCM(key).encrypt(nonce, data, header)
+
+
+def open_segment(key: bytes, header: bytes, index: int, last: bool, data) -> bytes:
+    nonce = header[-7:] + struct.pack(">IB", index, last)
+    return AESGCM(key).decrypt(nonce, data, header)
+
+
+class SegmentCipher:
+    """
+    SegmentCipher seals files with AES-256-GCM in independently
+    authenticated segments, which are encrypted and decrypted on a pool of
+    threads, so that large files use every core. Output is assembled in
+    order as segments complete.
+
+    Attributes:
+    - segment_bytes: plaintext bytes of each segment but the last
+    - workers: threads of pool
+    - pool: ThreadPoolExecutor, created on first file of more than one
+      segment
+
+    Assumptions:
+    - AESGCM releases the GIL while encrypting, so that threads run on all
+      cores without copying segments to other processes
+    - at most 2 * workers segments are in flight, so that memory besides
+      the sealed file is bounded by 2 * workers * segment_bytes
+    - the sealed file is sent in one frame, which servers limit to
+      max_frame_bytes (1MB by default), so segment_bytes is a fraction of
+      it for files to be sealed in several segments
+    """
+
+    def __init__(self, segment_bytes: int = 256 * 1024, workers: int = 1):
+        self.segment_bytes = segment_bytes
+        self.workers = workers
+        self.pool = None
+
+    def configure(self, segment_bytes: int, workers: int):
+        self.segment_bytes = segment_bytes
+        if workers != self.workers and self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+        self.workers = workers
+
+    def ordered_map(self, function, arguments, count: int):
+        """
+        Yield function of each arguments in order, on the pool if there are
+        several segments
+        """
+        if count == 1 or self.workers == 1:
+            for args in arguments:
+                yield function(*args)
+            return
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="file_cipher")
+        pending = deque()
+        try:
+            for args in arguments:
+                pending.append(self.pool.submit(function, *args))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def sealed_size(self, size: int) -> int:
+        count = max(1, -(-size // self.segment_bytes))
+        return SEGMENT_HEADER.size + size + count * SEGMENT_TAG_BYTES
+
+    def seal_file(self, file, size: int, key: bytes) -> bytearray:
+        """
+        Read size bytes of binary file segment by segment and seal them
+
+        Raises:
+            ValueError if file ends before size bytes
+        """
+        segment_bytes = self.segment_bytes
+        count = max(1, -(-size // segment_bytes))
+        header = SEGMENT_HEADER.pack(SEGMENTED_FILE_VERSION, segment_bytes, os.urandom(7))
+        sealed = bytearray(self.sealed_size(size))
+        sealed[:len(header)] = header
+
+        def segments():
+            for index in range(count):
+                data = file.read(min(segment_bytes, size - index * segment_bytes))
+                if len(data) < min(segment_bytes, size - index * segment_bytes):
+                    raise ValueError("file is shorter than its size")
+                yield key, header, index, index == count - 1, data
+
+        offset = len(header)
+        for segment in self.ordered_map(seal_segment, segments(), count):
+            sealed[offset:offset + len(segment)] = segment
+            offset += len(segment)
+        return sealed
+
+    def seal(self, data: bytes, key: bytes) -> bytearray:
+        return self.seal_file(io.BytesIO(data), len(data), key)
+
+    def open_to(self, sealed, key: bytes, file):
+        """
+        Decrypt sealed file segment by segment, writing plaintext to binary
+        file in order
+
+        Raises:
+            ValueError if sealed is not a segmented file
+            InvalidTag if a segment fails authentication
+        """
+        sealed = memoryview(sealed)
+        if len(sealed) < SEGMENT_HEADER.size + SEGMENT_TAG_BYTES:
+            raise ValueError("sealed file is truncated")
+        header = bytes(sealed[:SEGMENT_HEADER.size])
+        version, segment_bytes, _ = SEGMENT_HEADER.unpack(header)
+        if version != SEGMENTED_FILE_VERSION or segment_bytes == 0:
+            raise ValueError(f"unsupported sealed file version {version}")
+        stride = segment_bytes + SEGMENT_TAG_BYTES
+        body = len(sealed) - len(header)
+        count = max(1, -(-body // stride))
+        if body - (count - 1) * stride < SEGMENT_TAG_BYTES:
+            raise ValueError("sealed file is truncated")
+        segments = (
+            (
+                key, header, index, index == count - 1,
+                sealed[len(header) + index * stride:len(header) + (index + 1) * stride],
+            )
+            for index in range(count)
+        )
+        for data in self.ordered_map(open_segment, segments, count):
+            file.write(data)
+
+    def open(self, sealed, key: bytes) -> bytes:
+        file = io.BytesIO()
+        self.open_to(sealed, key, file)
+        return file.getvalue()
+
+
+# cipher of files sent and received, configured when client starts
+file_cipher = SegmentCipher()
+
+
+def wrap_key(key: bytes, public_key_pem: str) -> str:
+    return base64_rsa_encrypt(key, public_key_pem)
+
+
+def unwrap_key(wrapped_key: str) -> bytes:
+    return base64_rsa_decrypt(wrapped_key)
+
+
+def encrypt_direct_message(target: str, message: str, public_key_pem: str) -> Frame:
+    return Frame(
+        FrameType.DIRECT, (text_field(target),), rsa_encrypt(message.encode("utf-8"), public_key_pem)
+    )
+
+
+def encrypt_multi_message(message: str, presence_list: list) -> Frame:
+    """
+    Encrypt message once with a new content key, and wrap the content key
+    with the public key of each receipient
+    """
+    key = generate_content_key()
+    keys = {
+        presence["jid"]: rsa_encrypt(key, presence["publickey"])
+        for presence in presence_list
+    }
+    return Frame(FrameType.MULTI, pairs_to_fields(keys), aes_seal(message.encode("utf-8"), key))
+
+
+def decrypt_multi_message(wrapped_key, encrypted_message) -> str:
+    return aes_open(encrypted_message, rsa_decrypt(wrapped_key)).decode("utf-8")
+
+
+def encrypt_multi_file(file_name: str, file, size: int, presence_list: list) -> Frame:
+    """
+    Encrypt size bytes of binary file once with a new file key, and wrap the
+    file key with the public key of each receipient, so that the server
+    stores it only once
+    """
+    key = generate_content_key()
+    keys = {
+        presence["jid"]: rsa_encrypt(key, presence["publickey"])
+        for presence in presence_list
+    }
+    return Frame(
+        FrameType.FILE, [text_field(file_name)] + pairs_to_fields(keys), file_cipher.seal_file(file, size, key)
+    )
+
+
+def download_path(file_name: str) -> str:
+    file_name = os.path.basename(file_name)
+    os.makedirs(download_directory, exist_ok=True)
+    return f'{download_directory}/{file_name}.{get_current_timestamp()}'
+
+
+def save_file(file_name: str, file_data) -> str:
+    """
+    Save received file to download directory
+
+    Returns:
+        path of saved file
+    """
+    full_file_path = download_path(file_name)
+    with open(full_file_path, "wb") as file:
+        file.write(file_data)
+    return full_file_path
+
+
+def save_multi_file(frame: Frame) -> str:
+    """
+    Decrypt received FILE frame into download directory, segments are
+    written as they are decrypted. A file failing authentication is removed.
+
+    Returns:
+        path of saved file
+    """
+    key = rsa_decrypt(frame.fields[2])
+    full_file_path = download_path(frame.field(1))
+    try:
+        with open(full_file_path, "wb") as file:
+            file_cipher.open_to(frame.payload, key, file)
+    except Exception:
+        os.remove(full_file_path)
+        raise
+    return full_file_path
+
+
+def encrypt_room_message(room: str, message: str) -> str:
+    """
+    Encrypt room message once with own sender key of the room.
+    A new sender key is generated after membership change, and it is wrapped
+    with the public key of every member and attached to the first message.
+    """
+    room_state = joined_rooms[room]
+    payload = {}
+    if room_state.get("key", None) is None:
+        room_state["key"] = generate_content_key()
+        room_state["key_id"] = os.urandom(8).hex()
+        payload["keys"] = {
+            member["jid"]: wrap_key(room_state["key"], member["publickey"])
+            for member in room_state["members"]
+            if member["jid"] != room_state["jid"]
+        }
+    payload["key_id"] = room_state["key_id"]
+    payload["info"] = aes_encrypt(message.encode("utf-8"), room_state["key"])
+    return json.dumps(payload)
+
+
+def decrypt_room_message(room: str, sender: str, payload_str: str) -> str:
+    """
+    Decrypt room message with the sender key of sender, learning the sender
+    key first if it is wrapped for this client
+    """
+    payload = parse_json(payload_str)
+    key_id = payload.get("key_id", None)
+    own_jid = joined_rooms.get(room, {}).get("jid", None)
+    wrapped_key = payload.get("keys", {}).get(own_jid, None)
+    if wrapped_key:
+        room_keys[(room, sender, key_id)] = unwrap_key(wrapped_key)
+    key = room_keys.get((room, sender, key_id), None)
+    if key is None:
+        raise ValueError(f"missing room key {key_id} from {sender}")
+    return aes_decrypt(payload["info"], key).decode("utf-8")
+
+
+def handle_room_message(room_message: dict):
+    """
+    Handle room membership update and room message from server
+
+    Returns:
+        ChatEvent, None if message is not for this client
+    """
+    tag = room_message.get("tag", None)
+    room = room_message.get("room", None)
+    if tag == "room_members":
+        own_jid = room_message["jid"]
+        members = room_message.get("members", [])
+        if own_jid not in [member["jid"] for member in members]:
+            joined_rooms.pop(room, None)
+            return None
+        # membership changed, rotate own sender key on next message
+        joined_rooms[room] = {"jid": own_jid, "members": members, "key_id": None, "key": None}
+        return ChatEvent(EVENT_ROOM_MEMBERS, room=room, members=[member["jid"] for member in members])
+    elif tag == "room_message":
+        sender = room_message.get("from", None)
+        try:
+            text = decrypt_room_message(room, sender, room_message.get("info", ""))
+            return ChatEvent(EVENT_ROOM_MESSAGE, sender, text, room=room)
+        except Exception as e:
+            logger.error(f"unable to decrypt room message from {sender}: {e}")
+    return None
+
+
 # Convert json string to dict
 def parse_json(json_str: str) -> dict:
     try:
@@ -141,71 +565,798 @@ def parse_json(json_str: str) -> dict:
         return {}
 
 
-async def receive_messages(websocket):
+async def send_frame(websocket, frame: Frame):
     """
-    Handler for received data from connected websocket.
-    It will save the received file to specific folder,
-    and it will display received message in console.
+    Send frame to server, as text command if the server does not support
+    binary frames
     """
-    try:
+    if is_binary(websocket.subprotocol):
+        await websocket.send(frame.encode())
+    else:
+        await websocket.send(command_to_text(frame))
+
+
+def receive_frame(message) -> Frame:
+    """
+    Decode binary frame or parse text from server into frame
+    """
+    if isinstance(message, str):
+        return parse_server_text(message)
+    return Frame.decode(message)
+
+
+class AuthenticationError(Exception):
+    """
+    Raised when server rejects the username or password
+    """
+
+
+# kinds of ChatEvent
+EVENT_NOTICE = "notice"
+EVENT_BROADCAST = "broadcast"
+# broadcast relayed from a client of another server
+EVENT_SERVER_BROADCAST = "server_broadcast"
+EVENT_DIRECT = "direct"
+EVENT_MULTI = "multi"
+EVENT_FILE = "file"
+EVENT_ROOM_MEMBERS = "room_members"
+EVENT_ROOM_MESSAGE = "room_message"
+
+
+class ChatEvent:
+    """
+    Event received from server, yielded by ChatClient.events
+
+    Attributes:
+    - kind: one of EVENT_*
+    - sender: jid or username of sender, None for notice
+    - text: decrypted message, notice, or path of saved file
+    - target: receipient of direct message
+    - room: room of room events
+    - members: jids of room members for EVENT_ROOM_MEMBERS
+    """
+    __slots__ = ("kind", "sender", "text", "target", "room", "members")
+
+    def __init__(self, kind: str, sender=None, text=None, target=None, room=None, members=None):
+        self.kind = kind
+        self.sender = sender
+        self.text = text
+        self.target = target
+        self.room = room
+        self.members = members
+
+    def __str__(self):
+        """
+        Event as displayed by command line client
+        """
+        if self.kind == EVENT_NOTICE:
+            return self.text
+        if self.kind == EVENT_SERVER_BROADCAST:
+            return f"BROADCAST from {self.sender}: {self.text}"
+        if self.kind == EVENT_DIRECT:
+            return f"{self.sender} to {self.target}: {self.text}"
+        if self.kind == EVENT_FILE:
+            return f"Received file from {self.sender} at {self.text}"
+        if self.kind == EVENT_ROOM_MEMBERS:
+            return f"[#{self.room}] members: {self.members}"
+        if self.kind == EVENT_ROOM_MESSAGE:
+            return f"[#{self.room}] {self.sender}: {self.text}"
+        return f"{self.sender}: {self.text}"
+
+
+class ChatClient:
+    """
+    ChatClient is the async client API, used by the command line client and
+    by bots and integrations:
+
+        client = ChatClient("ws://localhost:12345", BINARY_SUBPROTOCOLS)
+        await client.connect(username, password)
+        await client.send_direct("c2@s1", "hello")
+        async for event in client.events():
+            print(event)
+
+    Attributes:
+    - uri: websocket uri of chat server
+    - unix_path: unix domain socket of a chat server on the same host,
+      connected instead of the host and port of uri
+    - ssl_context: ResumingSSLContext of a wss uri, connections after the
+      first one, such as session resumes, resume its TLS session
+    - subprotocols: websocket subprotocols offered to server
+    - extensions: websocket extensions offering compression, built from
+      compression section of config
+    - websocket: current connection, replaced when session is resumed
+    - connected: event set while websocket is usable, senders wait on it
+      while session is being resumed
+    - session: resume token in format { token, grace }, where grace is
+      seconds the server keeps the session after connection loss
+    - known_presence: presences learnt from roster queries and subscriptions,
+      in format { <jid>: { nickname, jid, publickey } }
+    - pending_roster_queries: futures waiting for roster response, server
+      answers queries in order
+    - event_queue: queue of ChatEvent, None marks end of events
+    - tracer: Tracer sampling sent messages and files, and continuing
+      traces of received ones, None if disabled
+
+    Assumptions:
+    - events are consumed, the client stops reading from server while
+      event_queue is full
+    - identity key pair and room keys are shared by clients of the process
+    """
+
+    def __init__(
+        self, uri: str, subprotocols=None, max_queued_events: int = 1024, compression: dict = None,
+        unix_path: str = None, ssl_context=None, tracer: Tracer = None,
+    ):
+        self.uri = uri
+        self.unix_path = unix_path
+        self.ssl_context = ssl_context
+        self.subprotocols = subprotocols
+        self.extensions = client_extensions(compression_settings(compression or {}))
+        self.websocket = None
+        self.connected = asyncio.Event()
+        self.session = {}
+        self.known_presence = {}
+        self.pending_roster_queries = deque()
+        self.event_queue = asyncio.Queue(maxsize=max_queued_events)
+        self.tracer = tracer
+        self.receive_task = None
+        self.closing = False
+        self.closed = False
+
+    async def open_websocket(self):
+        if self.unix_path:
+            return await websockets.unix_connect(
+                self.unix_path, self.uri, subprotocols=self.subprotocols,
+                compression=None, extensions=self.extensions,
+            )
+        websocket = await websockets.connect(
+            self.uri, subprotocols=self.subprotocols, compression=None, extensions=self.extensions,
+            ssl=self.ssl_context,
+        )
+        if self.ssl_context is not None:
+            self.ssl_context.remember(websocket)
+        return websocket
+
+    async def connect(self, username: str, password: str):
+        """
+        Connect and log in, then receive events in background
+
+        Raises:
+            AuthenticationError if server rejects username or password
+        """
+        websocket = await self.open_websocket()
+        try:
+            # Authentication exchange
+            while True:
+                response = await websocket.recv()
+                if response == "Enter your username: ":
+                    await websocket.send(username)
+                elif response == "Enter your password: ":
+                    await websocket.send(password)
+                elif response == "Authentication successful":
+                    # send public key pem after authentication
+                    await websocket.send(await asyncio.to_thread(get_public_key_pem))
+                    break
+                elif "Authentication failed" in str(response):
+                    raise AuthenticationError(response)
+        except Exception:
+            await websocket.close()
+            raise
+        self.websocket = websocket
+        self.connected.set()
+        self.receive_task = asyncio.create_task(self.receive_messages())
+
+    async def close(self):
+        self.closing = True
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.receive_task is not None:
+            await self.receive_task
+
+    async def events(self):
+        """
+        Iterate events received from server until client is closed
+        """
         while True:
-            try:
-                message = await websocket.recv()
-                if message.startswith("FILE"):
-                    try:
-                        file_part = message.split(" ", 3)
-                        if len(file_part) < 4:
-                            logger.error('Incorrect FILE message format')
+            event = await self.event_queue.get()
+            if event is None:
+                # keep end mark for other iterators
+                self.event_queue.put_nowait(None)
+                return
+            yield event
+
+    async def receive_messages(self):
+        """
+        Receive frames from server into events, and resume session whenever
+        the connection is lost until client is closed
+        """
+        while self.websocket is not None:
+            await self.receive_frames(self.websocket)
+            if self.closing:
+                break
+            self.connected.clear()
+            logger.info("Connection lost, reconnecting ....")
+            self.websocket = await self.resume_session()
+            if self.websocket is not None:
+                logger.info("Session resumed.")
+                self.connected.set()
+            else:
+                await self.event_queue.put(ChatEvent(
+                    EVENT_NOTICE, text="Unable to resume session, please restart the client."
+                ))
+        self.websocket = None
+        self.closed = True
+        # wake senders waiting for resumed session, they find client closed
+        self.connected.set()
+        await self.event_queue.put(None)
+
+    async def receive_frames(self, websocket):
+        """
+        Handler for received data from connected websocket.
+        It will save the received file to specific folder,
+        and it will queue received message as event.
+        """
+        try:
+            while True:
+                try:
+                    message = await websocket.recv()
+                    if message:
+                        try:
+                            frame = receive_frame(message)
+                            # frames coalesced by server
+                            frames = split_batch(frame) if frame.type == FrameType.BATCH else (frame,)
+                        except ValueError as e:
+                            logger.error(f"Incorrect message format: {e}")
                             continue
-                        _, sender, file_data, file_name = file_part
-                        full_file_path = f'{download_directory}/{file_name}.{get_current_timestamp()}'
-                        with open(full_file_path, "wb") as file:
-                            file.write(decrypt_file_data(file_data))
-                        print(f"Received file from {sender} at {full_file_path}")
-                    except Exception as e:
-                        logger.error(f"Error receiving file: {e}")
-                elif message:
-                    # special handling for updating presence, which contains public key
-                    if "tag" in message and "presence" in message:
-                        presence_json = parse_json(message)
-                        global current_presence
-                        current_presence = presence_json["presence"]
-                    else:
-                        msg_split = message.split(": ", 1)
-                        if len(msg_split) < 2:
-                            print(message)
-                        else:
-                            sender, encrypted_message = message.split(": ", 1)
-                            if sender.startswith("@"):
-                                try:
-                                    real_msg = decrypt_message(encrypted_message)
-                                    print(sender[1:] + ": " + real_msg)
-                                except Exception as e:
-                                    logger.error(f'decryption error on  {encrypted_message}: {e}')
+                        for frame in frames:
+                            span = None
+                            if frame.trace is not None and self.tracer is not None:
+                                span = self.tracer.start(frame.trace, "server", frame.type.name)
+                            if frame.type == FrameType.FILE:
+                                # decrypted by file_cipher pool, the event loop keeps running
+                                event = await asyncio.to_thread(self.handle_frame, frame)
                             else:
-                                print(message)
-                else:
+                                event = self.handle_frame(frame)
+                            if span is not None:
+                                span.mark("decrypt")
+                                self.tracer.finish(span)
+                            if event is not None:
+                                await self.event_queue.put(event)
+                    else:
+                        break
+                except websockets.ConnectionClosed:
+                    logger.info("Server connection closed.")
                     break
-            except websockets.ConnectionClosed:
-                logger.info("Server connection closed.")
-                break
+                except Exception as e:
+                    logger.error(f"Error receiving message: {e}")
+                    logger.exception(traceback.print_exc())
+                    break
+        finally:
+            await websocket.close()
+            logger.info("Connection closed gracefully.")
+
+    async def resume_session(self):
+        """
+        Reconnect with exponential backoff and jitter, and resume session with
+        its token until the grace period of the server ends
+
+        Returns:
+            websocket of resumed session, None if session cannot be resumed
+        """
+        deadline = time.monotonic() + self.session.get("grace", 0)
+        delay = RECONNECT_INITIAL_DELAY
+        while self.session.get("token", None) and time.monotonic() < deadline and not self.closing:
+            try:
+                websocket = await self.open_websocket()
+                # answer username prompt with resume token, which is used once
+                await websocket.recv()
+                await websocket.send(f"RESUME {self.session.pop('token')}")
+                response = await websocket.recv()
+                if response == "Session resumed":
+                    return websocket
+                logger.warning(f"{response}. Disconnecting.")
+                await websocket.close()
+                return None
+            except (OSError, websockets.WebSocketException) as e:
+                logger.debug(f"reconnect failed: {e}")
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return None
+
+    def handle_frame(self, frame: Frame):
+        """
+        Decrypt message or save file received from server
+
+        Returns:
+            ChatEvent, None if frame only updates client state
+        """
+        if frame.type == FrameType.NOTICE:
+            return ChatEvent(EVENT_NOTICE, text=frame.text())
+        elif frame.type == FrameType.BROADCAST:
+            kind = EVENT_SERVER_BROADCAST if frame.flags & FLAG_REMOTE else EVENT_BROADCAST
+            return ChatEvent(kind, frame.field(0), frame.text())
+        elif frame.type == FrameType.DIRECT:
+            try:
+                real_msg = rsa_decrypt(frame.payload).decode("utf-8")
+                return ChatEvent(EVENT_DIRECT, frame.field(0), real_msg, frame.field(1))
             except Exception as e:
-                logger.error(f"Error receiving message: {e}")
-                logger.exception(traceback.print_exc())
-                break
-    finally:
-        await websocket.close()
-        logger.info("Connection closed gracefully.")
+                logger.error(f'decryption error on message from {frame.field(0)}: {e}')
+        elif frame.type == FrameType.MULTI:
+            try:
+                return ChatEvent(
+                    EVENT_MULTI, frame.field(0), decrypt_multi_message(frame.fields[1], frame.payload)
+                )
+            except Exception as e:
+                logger.error(f'decryption error on message from {frame.field(0)}: {e}')
+        elif frame.type == FrameType.FILE:
+            try:
+                return ChatEvent(EVENT_FILE, frame.field(0), save_multi_file(frame))
+            except Exception as e:
+                logger.error(f"Error receiving file from {frame.field(0)}: {e}")
+        elif frame.type == FrameType.LEGACY_FILE:
+            try:
+                full_file_path = save_file(frame.field(1), rsa_decrypt(frame.payload))
+                return ChatEvent(EVENT_FILE, frame.field(0), full_file_path)
+            except Exception as e:
+                logger.error(f"Error receiving file: {e}")
+        elif frame.type == FrameType.JSON:
+            # special handling for roster and presence, which contains public key
+            server_message = parse_json(frame.text())
+            if server_message.get("tag", "").startswith("room_"):
+                return handle_room_message(server_message)
+            elif server_message.get("tag", None) == "session":
+                self.session["token"] = server_message["token"]
+                self.session["grace"] = server_message["grace"]
+            else:
+                self.handle_roster_message(server_message)
+        else:
+            logger.warning(f"Unsupported frame {frame.type.name}")
+        return None
+
+    def handle_roster_message(self, roster_message: dict):
+        """
+        Update known presences from presence push or roster response, and
+        resolve the pending roster query for the response
+        """
+        tag = roster_message.get("tag", None)
+        for presence in roster_message.get("presence", []):
+            self.known_presence[presence["jid"]] = presence
+        if tag in ("roster", "roster_count") and self.pending_roster_queries:
+            future = self.pending_roster_queries.popleft()
+            if not future.done():
+                future.set_result(roster_message)
+
+    async def send_frame(self, frame: Frame):
+        """
+        Send frame on current connection, waiting while session is resumed
+
+        Raises:
+            ConnectionError if client is closed
+        """
+        await self.connected.wait()
+        if self.websocket is None:
+            raise ConnectionError("client is closed")
+        await send_frame(self.websocket, frame)
+
+    def start_span(self, frame_type: FrameType):
+        """
+        Return span of message or file about to be sent, None if not sampled
+        """
+        if self.tracer is None:
+            return None
+        trace_id = self.tracer.sample()
+        if trace_id is None:
+            return None
+        return self.tracer.start(trace_id, "user", frame_type.name, "input")
+
+    async def send_traced_frame(self, frame: Frame, span):
+        """
+        Send frame of message or file, with the trace id of its span if sampled
+        """
+        if span is None:
+            await self.send_frame(frame)
+            return
+        span.mark("encrypt")
+        frame.trace = span.trace_id
+        await self.send_frame(frame)
+        span.mark("send")
+        self.tracer.finish(span)
+
+    async def roster_query(self, command: str) -> dict:
+        """
+        Send LIST or COUNT command to server and wait for its response
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending_roster_queries.append(future)
+        await self.send_command(command)
+        return await asyncio.wait_for(future, ROSTER_QUERY_TIMEOUT)
+
+    async def lookup_presence(self, jid: str):
+        """
+        Return presence of given jid, querying the server if not yet known
+        """
+        if jid not in self.known_presence:
+            await self.roster_query(f"LIST {jid} 0 {ROSTER_LOOKUP_LIMIT}")
+        return self.known_presence.get(jid, None)
+
+    async def lookup_presences(self, jids: list) -> list:
+        """
+        Return presences of given jids, looked up concurrently, skipping
+        users not present
+
+        Raises:
+            ValueError if none of the users is present
+        """
+        presences = await asyncio.gather(*(self.lookup_presence(jid) for jid in jids))
+        presence_list = []
+        for jid, presence in zip(jids, presences):
+            if not presence:
+                logger.warning(f"User {jid} not present")
+                continue
+            presence_list.append(presence)
+        if not presence_list:
+            raise ValueError("No receipient present")
+        return presence_list
+
+    async def send_direct(self, target: str, message: str):
+        """
+        Send message encrypted with public key of target, <user>@<server>
+
+        Raises:
+            ValueError if target is not present
+        """
+        span = self.start_span(FrameType.DIRECT)
+        target_presence = await self.lookup_presence(target)
+        if not target_presence:
+            raise ValueError(f"User {target} not present")
+        if span is not None:
+            span.mark("lookup")
+        await self.send_traced_frame(
+            encrypt_direct_message(target, message, target_presence["publickey"]), span
+        )
+
+    async def send_multi(self, targets: list, message: str):
+        """
+        Send message encrypted once for all present targets
+        """
+        span = self.start_span(FrameType.MULTI)
+        presence_list = await self.lookup_presences(targets)
+        if span is not None:
+            span.mark("lookup")
+        await self.send_traced_frame(encrypt_multi_message(message, presence_list), span)
+
+    async def send_file(self, targets: list, file_path: str):
+        """
+        Send file encrypted once for all present targets
+
+        Raises:
+            FileNotFoundError if file does not exist
+        """
+        span = self.start_span(FrameType.FILE)
+        presence_list = await self.lookup_presences(targets)
+        if span is not None:
+            span.mark("lookup")
+        with open(file_path, "rb") as file:
+            # read and encrypted segment by segment without blocking receiving
+            frame = await asyncio.to_thread(
+                encrypt_multi_file, os.path.basename(file_path), file, os.fstat(file.fileno()).st_size,
+                presence_list,
+            )
+        await self.send_traced_frame(frame, span)
+
+    async def broadcast(self, message: str):
+        await self.send_frame(Frame(FrameType.BROADCAST, (), text_field(message)))
+
+    async def send_command(self, command: str):
+        """
+        Send LIST, COUNT, SUBSCRIBE, UNSUBSCRIBE, JOIN or LEAVE command
+        """
+        await self.send_frame(Frame(FrameType.COMMAND, (), text_field(command)))
+
+    async def join_room(self, room: str):
+        await self.send_command(f"JOIN {room}")
+
+    async def leave_room(self, room: str):
+        await self.send_command(f"LEAVE {room}")
+
+    async def send_room(self, room: str, message: str):
+        """
+        Send message encrypted with own sender key of joined room
+
+        Raises:
+            ValueError if room is not joined
+        """
+        if room not in joined_rooms:
+            raise ValueError(f"Room {room} is not joined")
+        await self.send_frame(Frame(
+            FrameType.ROOM, (text_field(room),), text_field(encrypt_room_message(room, message))
+        ))
+
+
+def user_command(message: str) -> str:
+    """
+    Text of COMMAND frame of /<command> entered by user, e.g. JOIN r1 of
+    /join r1, empty if message is not such a command
+    """
+    if not message.startswith(COMMAND_PREFIX):
+        return ""
+    command, _, arguments = message[len(COMMAND_PREFIX):].partition(" ")
+    if command.upper() not in COMMANDS:
+        return ""
+    return f"{command.upper()} {arguments}".rstrip(" ")
+
+
+async def handle_input(client: ChatClient, message: str):
+    """
+    Send message, file or command entered by user to server
+    """
+    command = user_command(message)
+    # special command to send file, encrypted once for all receipients
+    # expected format: FILE <user>@<server>[,<user>@<server>...] <filepath>
+    if message.startswith("FILE "):
+        parts = message.split(" ", 2)
+        if len(parts) < 3:
+            print("Usage: FILE username@server[,username@server...] filepath")
+            return
+        _, target_usernames, file_path = parts
+        try:
+            await client.send_file(target_usernames.split(","), file_path)
+        except FileNotFoundError:
+            logger.warning(f"File {file_path} not found.")
+        except (ValueError, asyncio.TimeoutError) as e:
+            logger.error(f'unable to handle message: {e}')
+    # special command to display active users across servers
+    # expected format: LIST [prefix] [offset] [limit]
+    elif (command or message).split(" ", 1)[0] == "LIST":
+        try:
+            roster = await client.roster_query(command or message)
+        except asyncio.TimeoutError:
+            logger.warning("No response for LIST")
+            return
+        active_users = [f"{presence['nickname']}({presence['jid']})" for presence in roster["presence"]]
+        first = roster["offset"] + 1 if active_users else 0
+        last = roster["offset"] + len(active_users)
+        print(f"active users ({first}-{last} of {roster['total']}): {active_users}")
+    # special command to count active users
+    # expected format: /count [prefix]
+    elif command.split(" ", 1)[0] == "COUNT":
+        try:
+            roster = await client.roster_query(command)
+        except asyncio.TimeoutError:
+            logger.warning("No response for COUNT")
+            return
+        print(f"active users: {roster['count']}")
+    # special command to receive presence update, optionally filtered by prefix
+    # expected format: /subscribe [prefix] or /unsubscribe
+    # special command to join or leave room
+    # expected format: /join <room>, /leave <room>
+    elif command:
+        await client.send_command(command)
+    # special command to send room message
+    # expected format: #<room> <message>
+    elif message.startswith("#"):
+        parts = message.split(" ", 1)
+        if len(parts) < 2:
+            print("Usage: #room message, after /join room")
+            return
+        try:
+            await client.send_room(parts[0][1:], parts[1])
+        except ValueError as e:
+            logger.error(f'unable send room message {message}: {e}')
+    # special command to send direct message to multiple users
+    # expected format: @<user>@<server>,<user>@<server>,... <message>
+    # special command to send direct message
+    # expected format: @<user>@<server> <message>
+    elif message.startswith("@"):
+        try:
+            target_username_str, info = message.split(" ", 1)
+            if "," in target_username_str:
+                targets = [target.lstrip("@") for target in target_username_str[1:].split(",")]
+                await client.send_multi(targets, info)
+            else:
+                await client.send_direct(target_username_str[1:], info)
+        except (ValueError, asyncio.TimeoutError) as e:
+            logger.error(f'unable send message {message}: {e}')
+    # Assume to be broadcast message
+    elif message:
+        await client.broadcast(message)
+    else:
+        print("Error: Cannot Print Empty Message!")
+
+
+async def read_lines(file):
+    """
+    Iterate non empty lines of file without blocking the event loop
+    """
+    while True:
+        line = await asyncio.to_thread(file.readline)
+        if not line:
+            return
+        line = line.rstrip("\r\n")
+        if line.strip():
+            yield line
+
+
+async def run_batch(client: ChatClient, lines, concurrency: int):
+    """
+    Send commands of lines with at most concurrency commands in flight,
+    e.g. waiting for a presence lookup. Reading pauses while all workers
+    are busy, so that a large batch is not read into memory.
+
+    Assumptions:
+    - commands in flight may complete in any order, concurrency 1 keeps
+      the order of lines
+    """
+    queue = asyncio.Queue(maxsize=concurrency)
+
+    async def worker():
+        while True:
+            line = await queue.get()
+            if line is None:
+                return
+            try:
+                await handle_input(client, line)
+            except (ConnectionError, websockets.ConnectionClosed):
+                logger.warning(f"Connection lost, not sent: {line}")
+            except Exception as e:
+                # a failed line, e.g. FILE of a directory, must not stop the worker
+                logger.error(f"Unable to send {line}: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    async for line in lines:
+        await queue.put(line)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+
+# notices of users joining and leaving, collapsed into one line per write
+JOIN_NOTICE = " has joined the chat."
+LEAVE_NOTICE = " has left the chat."
+# users named in a collapsed join or leave line, the others are counted
+MAX_NAMED_USERS = 5
+# collapsed line of notices, by action in the line
+COLLAPSED_NOTICES = ((JOIN_NOTICE, "joined"), (LEAVE_NOTICE, "left"))
+
+
+def console_settings(console_config: dict) -> dict:
+    """
+    ConsoleRenderer arguments from console section of config
+    """
+    return {
+        "flush_interval": console_config.get("flush_interval_ms", 50) / 1000,
+        "max_lines_per_second": console_config.get("max_lines_per_second", 2000),
+        "max_pending_lines": console_config.get("max_pending_lines", 5000),
+    }
+
+
+def users_line(users: list, action: str) -> str:
+    named = ", ".join(users[:MAX_NAMED_USERS])
+    if len(users) > MAX_NAMED_USERS:
+        named += f" and {len(users) - MAX_NAMED_USERS} others"
+    return f"{named} {action} the chat."
+
+
+class ConsoleRenderer:
+    """
+    ConsoleRenderer prints events of the command line client. Events are
+    queued as lines, and written every flush_interval in one write from a
+    worker thread, so that receiving never waits for the terminal.
+
+    Attributes:
+    - pending: lines not yet written as [line, repeats], a line repeating
+      the previous one is counted instead of queued. A collapsed line is
+      queued as [action, 0] at the position of its first notice
+    - collapsed: users of join and leave notices of the collapsed lines
+      pending, written as one line each
+        { <action>: [user, ...] }
+    - skipped: lines dropped since the last write, the oldest lines are
+      dropped once max_pending_lines are waiting
+    - written: lines written
+
+    Assumptions:
+    - at most max_lines_per_second lines are written, the rest wait for
+      the next write or are skipped, with a summary line
+    - lines of user commands, e.g. roster queries, are printed directly
+    """
+
+    def __init__(
+        self,
+        output=None,
+        flush_interval: float = 0.05,
+        max_lines_per_second: int = 2000,
+        max_pending_lines: int = 5000,
+    ):
+        self.output = output if output is not None else sys.stdout
+        self.flush_interval = flush_interval
+        self.lines_per_write = max(1, int(max_lines_per_second * flush_interval))
+        self.max_pending_lines = max_pending_lines
+        self.pending = deque()
+        self.collapsed = {}
+        self.skipped = 0
+        self.written = 0
+
+    def add(self, event: ChatEvent):
+        line = str(event).rstrip("\n")
+        if event.kind == EVENT_NOTICE:
+            for notice, action in COLLAPSED_NOTICES:
+                if line.endswith(notice):
+                    if action not in self.collapsed:
+                        self.queue([action, 0])
+                        self.collapsed[action] = []
+                    self.collapsed[action].append(line[:-len(notice)])
+                    return
+        if self.pending and self.pending[-1][1] and self.pending[-1][0] == line:
+            self.pending[-1][1] += 1
+            return
+        self.queue([line, 1])
+
+    def queue(self, entry: list):
+        if len(self.pending) >= self.max_pending_lines:
+            line, repeats = self.pending.popleft()
+            self.skipped += repeats if repeats else len(self.collapsed.pop(line))
+        self.pending.append(entry)
+
+    def render(self) -> str:
+        """
+        Take text of the next write, empty if nothing is pending
+        """
+        lines = []
+        if self.skipped:
+            lines.append(f"... {self.skipped} messages skipped, output could not keep up")
+            self.skipped = 0
+        while self.pending and len(lines) < self.lines_per_write:
+            line, repeats = self.pending.popleft()
+            if not repeats:
+                lines.append(users_line(self.collapsed.pop(line), line))
+            else:
+                lines.append(line if repeats == 1 else f"{line} (x{repeats})")
+        if not lines:
+            return ""
+        self.written += len(lines)
+        lines.append("")
+        return "\n".join(lines)
+
+    def write(self, text: str):
+        self.output.write(text)
+        self.output.flush()
+
+    async def run(self, events):
+        """
+        Render events until they end, then write what is still pending
+        """
+        async def consume():
+            async for event in events:
+                self.add(event)
+
+        consumer = asyncio.create_task(consume())
+        while not consumer.done():
+            await asyncio.wait({consumer}, timeout=self.flush_interval)
+            text = self.render()
+            if text:
+                await asyncio.to_thread(self.write, text)
+        await consumer
+        text = self.render()
+        while text:
+            self.write(text)
+            text = self.render()
+
+
+async def print_events(client: ChatClient, renderer: ConsoleRenderer):
+    await renderer.run(client.events())
+    if not client.closing:
         logger.info("Please press Enter to exit ....")
 
 
-async def start_client():
+async def start_client(batch: str = None, concurrency: int = 8, username: str = None):
     """
     Start client and connect to chat server.
-    It will wait for user input for interacting with the chat server.
+    It will wait for user input for interacting with the chat server,
+    or send the commands of batch file, - for stdin.
     Interaction includes authentication, sending message, sending file,
     and broadcasting message.
     """
+    setup_logging()
     config = {}
     with open("client_config.yaml", "r") as f:
         try:
@@ -215,109 +1366,95 @@ async def start_client():
     chat_server_config = config.get("chat_server", {})
     host = chat_server_config.get("host", "localhost")
     port = chat_server_config.get("port", 12345)
-    uri = f"ws://{host}:{port}"
+    # chat server on the same host, host and port are then only used in headers
+    unix_path = chat_server_config.get("unix_path", None)
+    # unix sockets are not encrypted, access is limited by their file mode
+    tls = tls_settings(chat_server_config.get("tls", {})) if not unix_path else None
+    uri = f"{'wss' if tls is not None else 'ws'}://{host}:{port}"
+    # binary frames, and batches of them, are used if the server also supports them
+    subprotocols = list(BINARY_SUBPROTOCOLS) if chat_server_config.get("binary_frames", True) else None
+    key_store_config = config.get("key_store", {})
+    passphrase = read_passphrase(key_store_config) if key_store_config.get("enabled", False) else ""
+    # key pair is loaded or generated while user logs in
+    identity_task = asyncio.create_task(asyncio.to_thread(load_identity, key_store_config, passphrase))
+
+    if username is None:
+        username = (await asyncio.to_thread(input, "Enter your username: ")).strip()
+    password = os.environ.get("SPCHAT_PASSWORD", None)
+    if password is None:
+        password = getpass.getpass("Enter your password: ")
     try:
-        async with websockets.connect(uri) as websocket:
-            # Authentication exchange
-            while True:
-                response = await websocket.recv()
-                print(response)
-                if response == "Enter your username: ":
-                    username = input()
-                    await websocket.send(username)
-                elif response == "Enter your password: ":
-                    password = getpass.getpass("")
-                    await websocket.send(password)
-                elif response == "Authentication successful":
-                    # send public key pem after authentication
-                    await websocket.send(local_public_key_pem)
-                    break
-                elif "Authentication failed" in str(response):
-                    logger.warning(f"{response}. Disconnecting.")
-                    await websocket.close()
-                    return
+        await identity_task
+    except ValueError as e:
+        logger.error(f"unable to load identity key: {e}")
+        return
 
-            receive_task = asyncio.create_task(receive_messages(websocket))
+    file_cipher.configure(**file_cipher_settings(config.get("file_encryption", {})))
+    tracing_config = tracing_settings(config.get("tracing", {}))
+    tracer = None
+    if tracing_config is not None:
+        tracer = Tracer(username, **tracing_config)
+        tracer.open()
 
+    client = ChatClient(
+        uri, subprotocols, compression=chat_server_config.get("compression", {}), unix_path=unix_path,
+        ssl_context=client_ssl_context(tls) if tls is not None else None, tracer=tracer,
+    )
+    try:
+        await client.connect(username, password)
+    except AuthenticationError as e:
+        logger.warning(f"{e}. Disconnecting.")
+        return
+    except (OSError, websockets.WebSocketException) as e:
+        logger.error(f"unable to connect to {unix_path or uri}: {e}")
+        return
+    print("Authentication successful")
+    renderer = ConsoleRenderer(**console_settings(config.get("console", {})))
+    printer = asyncio.create_task(print_events(client, renderer))
+
+    try:
+        if batch is not None:
+            with (sys.stdin if batch == "-" else open(batch, "r")) as file:
+                await run_batch(client, read_lines(file), concurrency)
+        else:
             # User input exchange, includes sending message and file
             while True:
-                message = await asyncio.to_thread(input)
-                if websocket.closed:
+                try:
+                    message = await asyncio.to_thread(input)
+                except EOFError:
+                    break
+                if client.closed:
                     break
                 # special command to close the client
                 if message.strip().upper() == "EXIT":
-                    await websocket.close()
-                    await receive_task
                     break
-                # special command to send file
-                # expected format: FILE <user>@<server> <filepath>
-                elif message.startswith("FILE"):
-                    parts = message.split(" ", 2)
-                    if len(parts) < 3:
-                        print("Usage: FILE username@server filepath")
-                        continue
-                    _, target_username, file_path = parts
-                    try:
-                        target_presence_array = [
-                            presence
-                            for presence in current_presence
-                            if presence["jid"] == target_username
-                        ]
-                        if len(target_presence_array) < 1:
-                            logger.warning(f"User {target_username} not present")
-                            continue
-                        target_presence = target_presence_array[0]
-                        with open(file_path, "rb") as file:
-                            file_name = os.path.basename(file_path)
-                            file_data = file.read()
-                            encrypted_file_data = encrypt_file_data(file_data, target_presence["publickey"])
-                            file_message = f"FILE {target_username} {file_name} {encrypted_file_data}"
-                            await websocket.send(file_message)
-                    except FileNotFoundError:
-                        logger.warning(f"File {file_path} not found.")
-                    except Exception as e:
-                        logger.error(f'unable to handle message: {e}')
-                # special command to display all current active users across servers
-                elif message.startswith("LIST"):
-                    active_users = [f"{presence['nickname']}({presence['jid']})" for presence in current_presence]
-                    print(f"active users: {active_users}")
-                else:
-                    # special command to send direct message
-                    # expected format: @<user>@<server> <message>
-                    if message.startswith("@"):
-                        try:
-                            target_username_str, info = message.split(" ", 1)
-                            target_username = target_username_str[1:]
-                            target_presence_array = [
-                                presence
-                                for presence in current_presence
-                                if presence["jid"] == target_username
-                            ]
-                            if len(target_presence_array) < 1:
-                                logger.warning(f"User {target_username} not present")
-                                continue
-                            target_presence = target_presence_array[0]
-                            message = (
-                                target_username_str
-                                + " "
-                                + encrypt_message(info, target_presence["publickey"])
-                            )
-                        except ValueError as e:
-                            logger.error(f'unable send message {message}: {e}')
-                            continue
-                    # Assume to be broadcast message
-                    if message:
-                        await websocket.send(message)
-                    else:
-                        print("Error: Cannot Print Empty Message!")
-
-    except websockets.ConnectionClosed:
-        logger.info("Connection closed by server.")
+                try:
+                    await handle_input(client, message)
+                except (ConnectionError, websockets.ConnectionClosed):
+                    logger.warning("Connection lost, message not sent.")
     except Exception as e:
         logger.error(f"Error: {e}")
     finally:
+        await client.close()
+        await printer
         logger.info("Client shutting down.")
 
 
+def main():
+    parser = argparse.ArgumentParser(description="chat client")
+    parser.add_argument(
+        "--batch", metavar="FILE",
+        help="send commands of file, - for stdin, instead of reading user input",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="maximum batch commands in flight",
+    )
+    parser.add_argument("--username", help="username, prompted if not given")
+    args = parser.parse_args()
+    if args.batch == "-" and args.username is None:
+        parser.error("--username is required when batch is read from stdin")
+    asyncio.run(start_client(args.batch, max(1, args.concurrency), args.username))
+
+
 if __name__ == "__main__":
-    asyncio.run(start_client())
+    main()
@@ -0,0 +1,73 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import logging
+import os
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# child of chat_client logger, so that it uses the client handlers
+logger = logging.getLogger("chat_client.keystore")
+
+KEY_SIZE = 2048
+
+
+def generate_private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=KEY_SIZE)
+
+
+def public_key_pem(private_key) -> str:
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode("utf-8")
+
+
+def load_or_create_private_key(path: str, passphrase: bytes):
+    """
+    Load identity key pair from key store, generating and storing it on
+    first use, so that peers see the same public key in every session.
+    The key is stored as PKCS8 PEM encrypted with passphrase, or in clear
+    if passphrase is empty.
+
+    Raises:
+        ValueError if the passphrase does not decrypt the stored key
+    """
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            try:
+                return serialization.load_pem_private_key(f.read(), passphrase or None)
+            except TypeError:
+                # key is encrypted but no passphrase is given, or vice versa
+                raise ValueError(f"wrong passphrase for key store {path}")
+
+    private_key = generate_private_key()
+    if passphrase:
+        encryption = serialization.BestAvailableEncryption(passphrase)
+    else:
+        logger.warning(f"no passphrase given, key store {path} is not encrypted")
+        encryption = serialization.NoEncryption()
+    data = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=encryption,
+    )
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # write to temporary file readable by owner only, then rename, so that
+    # an interrupted write does not leave a broken key store
+    temp_path = f"{path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    logger.info(f"new identity key stored in {path}")
+    return private_key
@@ -1,24 +1,64 @@
+import asyncio
+import base64
+import io
+import json
+import os
+
+import pytest
+import websockets
+
+from benchmark import BASELINE_FILE, gate_regressions
 from chat_client import (
     base64_rsa_encrypt,
     base64_rsa_decrypt,
-    local_public_key_pem,
-    parse_json
+    get_public_key_pem,
+    parse_json,
+    generate_content_key,
+    aes_encrypt,
+    aes_decrypt,
+    wrap_key,
+    unwrap_key,
+    encrypt_room_message,
+    encrypt_multi_message,
+    decrypt_multi_message,
+    encrypt_multi_file,
+    save_multi_file,
+    SegmentCipher,
+    decrypt_room_message,
+    joined_rooms,
+    room_keys,
+    receive_frame,
+    ChatClient,
+    ChatEvent,
+    ConsoleRenderer,
+    EVENT_BROADCAST,
+    EVENT_DIRECT,
+    EVENT_NOTICE,
+    EVENT_SERVER_BROADCAST,
+    run_batch,
+    handle_input,
+    user_command,
 )
+from cryptography.exceptions import InvalidTag
+from framing import BINARY_SUBPROTOCOL, Frame, FrameType, command_to_text, fields_to_pairs, text_field
+from keystore import load_or_create_private_key, public_key_pem
+from tls import client_ssl_context, generate_self_signed, server_ssl_context, tls_settings
+from tracing import Tracer, read_spans
 
 
 def test_base64_rsa_encrypt_decrypt():
     # empty data
-    encrypted = base64_rsa_encrypt(b"", local_public_key_pem)
+    encrypted = base64_rsa_encrypt(b"", get_public_key_pem())
     decrypted = base64_rsa_decrypt(encrypted)
     assert decrypted == b""
 
     # short data
-    encrypted = base64_rsa_encrypt(b"hello", local_public_key_pem)
+    encrypted = base64_rsa_encrypt(b"hello", get_public_key_pem())
     decrypted = base64_rsa_decrypt(encrypted)
     assert decrypted == b"hello"
 
     # long data
-    encrypted = base64_rsa_encrypt(b"h" * 500, local_public_key_pem)
+    encrypted = base64_rsa_encrypt(b"h" * 500, get_public_key_pem())
     decrypted = base64_rsa_decrypt(encrypted)
     assert decrypted == b"h" * 500
 
@@ -61,3 +101,312 @@ def test_parse_json():
         "tag": "presence",
         "presence": [{"nickname": "user1", "jid": "user1", "publickey": "key1"}],
     }
+
+
+def test_aes_encrypt_decrypt():
+    key = generate_content_key()
+    encrypted = aes_encrypt(b"hello", key)
+    assert aes_decrypt(encrypted, key) == b"hello"
+
+    # wrapped key can only be unwrapped by the private key owner
+    wrapped_key = wrap_key(key, get_public_key_pem())
+    assert unwrap_key(wrapped_key) == key
+
+
+def test_room_message_encrypt_decrypt():
+    joined_rooms["r1"] = {
+        "jid": "c1@s1",
+        "members": [
+            {"nickname": "c1", "jid": "c1@s1", "publickey": get_public_key_pem()},
+            {"nickname": "c2", "jid": "c2@s1", "publickey": get_public_key_pem()},
+        ],
+        "key_id": None,
+        "key": None,
+    }
+    # first message carries the sender key wrapped for other members only
+    first = encrypt_room_message("r1", "hello")
+    assert list(parse_json(first)["keys"].keys()) == ["c2@s1"]
+    second = encrypt_room_message("r1", "again")
+    assert "keys" not in parse_json(second)
+
+    # decrypt as c2, which needs the wrapped key from the first message
+    joined_rooms["r1"]["jid"] = "c2@s1"
+    assert decrypt_room_message("r1", "c1@s1", first) == "hello"
+    assert decrypt_room_message("r1", "c1@s1", second) == "again"
+    joined_rooms.clear()
+    room_keys.clear()
+
+
+def test_multi_message_encrypt_decrypt():
+    presence_list = [
+        {"nickname": "c1", "jid": "c1@s1", "publickey": get_public_key_pem()},
+        {"nickname": "c2", "jid": "c2@s2", "publickey": get_public_key_pem()},
+    ]
+    frame = encrypt_multi_message("hello", presence_list)
+    keys = fields_to_pairs(frame.fields)
+    assert sorted(keys.keys()) == ["c1@s1", "c2@s2"]
+    for wrapped_key in keys.values():
+        assert decrypt_multi_message(wrapped_key, frame.payload) == "hello"
+
+    # same frame through binary framing and text command
+    decoded = Frame.decode(frame.encode())
+    assert decrypt_multi_message(decoded.fields[3], decoded.payload) == "hello"
+    assert command_to_text(frame).startswith("/multi {")
+
+
+def test_multi_file_encrypt_save():
+    presence_list = [{"nickname": "c1", "jid": "c1@s1", "publickey": get_public_key_pem()}]
+    frame = encrypt_multi_file("../a.txt", io.BytesIO(b"file data"), 9, presence_list)
+    keys = fields_to_pairs(frame.fields[1:])
+    frame = Frame.decode(frame.encode())
+    full_file_path = save_multi_file(Frame(
+        FrameType.FILE, (b"c2@s1", frame.fields[0], keys["c1@s1"]), frame.payload
+    ))
+    # file is saved into download directory only
+    assert full_file_path.startswith("download/a.txt.")
+    with open(full_file_path, "rb") as file:
+        assert file.read() == b"file data"
+    os.remove(full_file_path)
+
+
+
+def test_segment_cipher():
+    cipher = SegmentCipher(segment_bytes=1000, workers=4)
+    key = generate_content_key()
+    for size in (0, 999, 1000, 10500):
+        data = os.urandom(size)
+        sealed = cipher.seal(data, key)
+        assert len(sealed) == cipher.sealed_size(size)
+        # segments are decrypted on the pool and written in order
+        assert cipher.open(sealed, key) == data
+    # segments reordered, dropped at the end or altered are rejected
+    header, stride = 12, 1016
+    swapped = sealed[:header] + sealed[header + stride:header + 2 * stride] + sealed[header:header + stride]
+    swapped += sealed[header + 2 * stride:]
+    for tampered in (swapped, sealed[:header + 10 * stride], sealed[:-1] + bytes([sealed[-1] ^ 1])):
+        with pytest.raises(InvalidTag):
+            cipher.open(tampered, key)
+    with pytest.raises(ValueError):
+        cipher.open(sealed[:20], key)
+    # file shorter than size announced
+    with pytest.raises(ValueError):
+        cipher.seal_file(io.BytesIO(b"x" * 1500), 2000, key)
+    cipher.pool.shutdown()
+
+
+def test_receive_frame():
+    # text from server without binary frames is parsed into the same frames
+    frame = receive_frame("BROADCAST from c2@s2: hi: there")
+    assert frame.type == FrameType.BROADCAST
+    assert (frame.field(0), frame.text()) == ("c2@s2", "hi: there")
+    assert receive_frame("c1 has joined the chat.\n").type == FrameType.NOTICE
+    assert receive_frame('{"tag": "roster_count", "prefix": "", "count": 2}').type == FrameType.JSON
+
+    direct = receive_frame("@c1 to c2: " + base64_rsa_encrypt(b"hello", get_public_key_pem()))
+    assert (direct.field(0), direct.field(1)) == ("c1", "c2")
+    assert base64_rsa_decrypt(base64.b64encode(direct.payload)) == b"hello"
+
+
+def test_key_store(tmp_path):
+    path = str(tmp_path / "keys" / "identity.pem")
+    private_key = load_or_create_private_key(path, b"secret")
+    # same identity is loaded in the next session, store is readable by owner only
+    assert public_key_pem(load_or_create_private_key(path, b"secret")) == public_key_pem(private_key)
+    assert os.stat(path).st_mode & 0o077 == 0
+    with open(path, "rb") as file:
+        assert b"ENCRYPTED" in file.read()
+    for passphrase in (b"wrong", b""):
+        try:
+            load_or_create_private_key(path, passphrase)
+            assert False
+        except ValueError:
+            pass
+
+
+def test_client_events():
+    client = ChatClient("ws://localhost:12345")
+    event = client.handle_frame(receive_frame("BROADCAST from c2@s2: hi"))
+    assert (event.kind, event.sender, event.text) == (EVENT_SERVER_BROADCAST, "c2@s2", "hi")
+    assert str(event) == "BROADCAST from c2@s2: hi"
+    event = client.handle_frame(
+        receive_frame("@c1 to c2: " + base64_rsa_encrypt(b"hello", get_public_key_pem()))
+    )
+    assert (event.kind, event.sender, event.target, event.text) == (EVENT_DIRECT, "c1", "c2", "hello")
+
+    # presence and session token update client state without event
+    presence = {"nickname": "c3", "jid": "c3@s1", "publickey": "key"}
+    assert client.handle_frame(receive_frame(f'{{"tag": "presence", "presence": [{json.dumps(presence)}]}}')) is None
+    assert client.known_presence["c3@s1"] == presence
+    assert client.handle_frame(receive_frame('{"tag": "session", "token": "t", "grace": 60}')) is None
+    assert client.session == {"token": "t", "grace": 60}
+
+
+class ServerWebsocket:
+    subprotocol = BINARY_SUBPROTOCOL
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+
+    async def recv(self):
+        if not self.messages:
+            raise websockets.ConnectionClosed(None, None)
+        return self.messages.pop(0)
+
+    async def close(self):
+        pass
+
+
+def test_client_tracing(tmp_path):
+    async def run():
+        path = str(tmp_path / "spans.jsonl")
+        tracer = Tracer("c1", path=path, sample_rate=1)
+        tracer.open()
+        client = ChatClient("ws://localhost:12345", tracer=tracer)
+        received = Frame(
+            FrameType.DIRECT, (text_field("c2@s1"), text_field("c1")),
+            base64.b64decode(base64_rsa_encrypt(b"hello", get_public_key_pem())), trace=b"\xff" * 8,
+        )
+        client.websocket = ServerWebsocket([received.encode()])
+        client.connected.set()
+        client.known_presence["c2@s1"] = {"nickname": "c2", "jid": "c2@s1", "publickey": get_public_key_pem()}
+
+        # sampled message carries the trace id of its span
+        await client.send_direct("c2@s1", "hi")
+        sent = Frame.decode(client.websocket.sent[0])
+        # trace of received message is continued with its decryption
+        await client.receive_frames(client.websocket)
+        assert (await client.event_queue.get()).text == "hello"
+        tracer.close()
+        traces = read_spans([path])
+        assert [event for event, _ in traces[sent.trace.hex()][0]["events"]] == ["input", "lookup", "encrypt", "send"]
+        assert [event for event, _ in traces["ff" * 8][0]["events"]] == ["receive", "decrypt"]
+
+    asyncio.run(run())
+
+
+def test_console_renderer():
+    output = io.StringIO()
+    renderer = ConsoleRenderer(output, flush_interval=0.01, max_lines_per_second=500, max_pending_lines=8)
+    for user in ("c1", "c2", "c3", "c4", "c5", "c6", "c7"):
+        renderer.add(ChatEvent(EVENT_NOTICE, text=f"{user} has joined the chat.\n"))
+    renderer.add(ChatEvent(EVENT_NOTICE, text="c1 has left the chat."))
+    for _ in range(3):
+        renderer.add(ChatEvent(EVENT_BROADCAST, "c2", "spam"))
+    renderer.add(ChatEvent(EVENT_DIRECT, "c3@s1", "hi", "c1"))
+    # join and leave notices are collapsed, repeated lines counted
+    assert renderer.render().splitlines() == [
+        "c1, c2, c3, c4, c5 and 2 others joined the chat.",
+        "c1 left the chat.",
+        "c2: spam (x3)",
+        "c3@s1 to c1: hi",
+    ]
+    assert renderer.render() == ""
+
+    # collapsed notices are written at the position of their first notice
+    renderer.add(ChatEvent(EVENT_DIRECT, "c3@s1", "before", "c1"))
+    renderer.add(ChatEvent(EVENT_NOTICE, text="c8 has joined the chat."))
+    renderer.add(ChatEvent(EVENT_BROADCAST, "c2", "after"))
+    renderer.add(ChatEvent(EVENT_NOTICE, text="c9 has joined the chat."))
+    assert renderer.render().splitlines() == ["c3@s1 to c1: before", "c8, c9 joined the chat.", "c2: after"]
+
+    # lines beyond one write wait, the oldest are skipped once max_pending_lines wait
+    async def flood():
+        for i in range(20):
+            yield ChatEvent(EVENT_BROADCAST, "c2", f"m{i}")
+
+    asyncio.run(renderer.run(flood()))
+    lines = output.getvalue().splitlines()
+    assert lines == ["... 12 messages skipped, output could not keep up"] + [f"c2: m{i}" for i in range(12, 20)]
+
+    renderer = ConsoleRenderer(io.StringIO(), flush_interval=0.01, max_lines_per_second=300)
+    for i in range(5):
+        renderer.add(ChatEvent(EVENT_BROADCAST, "c2", f"m{i}"))
+    assert len(renderer.render().splitlines()) == 3 and len(renderer.render().splitlines()) == 2
+
+
+def test_tls_reconnect_resumes_session(tmp_path):
+    cert_file = str(tmp_path / "server.pem")
+    key_file = str(tmp_path / "server.key")
+    generate_self_signed(cert_file, key_file, ["localhost"])
+    settings = tls_settings({"enabled": True, "cert_file": cert_file, "key_file": key_file, "ca_file": cert_file})
+
+    async def handler(websocket):
+        await websocket.wait_closed()
+
+    async def run():
+        async with websockets.serve(handler, "localhost", 0, ssl=server_ssl_context(settings)) as server:
+            port = server.sockets[0].getsockname()[1]
+            client = ChatClient(f"wss://localhost:{port}", ssl_context=client_ssl_context(settings))
+            # connecting again, as when resuming a chat session, resumes the TLS session
+            for _ in range(2):
+                websocket = await client.open_websocket()
+                await websocket.close()
+            assert (client.ssl_context.handshakes, client.ssl_context.resumed) == (2, 1)
+
+    asyncio.run(run())
+
+
+class RecordingClient:
+    def __init__(self):
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def broadcast(self, message):
+        if message == "fail":
+            raise PermissionError("denied")
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.sent.append(message)
+        self.in_flight -= 1
+
+
+def test_user_command():
+    assert user_command("/join r1") == "JOIN r1"
+    assert user_command("/UNSUBSCRIBE") == "UNSUBSCRIBE"
+    assert user_command("/shrug") == "" and user_command("LEAVE now please") == ""
+
+    # chat text starting with a command word is broadcast
+    client = RecordingClient()
+    texts = ["LEAVE now please", "FILEs are great", "JOIN us", "COUNT on me", "/shrug"]
+    for text in texts:
+        asyncio.run(handle_input(client, text))
+    assert client.sent == texts
+
+def test_run_batch():
+    async def lines():
+        for i in range(20):
+            yield f"m{i}"
+
+    client = RecordingClient()
+    asyncio.run(run_batch(client, lines(), 4))
+    # every command is sent, with bounded concurrency
+    assert sorted(client.sent) == sorted(f"m{i}" for i in range(20))
+    assert client.max_in_flight == 4
+
+    client = RecordingClient()
+    asyncio.run(run_batch(client, lines(), 1))
+    assert client.sent == [f"m{i}" for i in range(20)]
+
+    async def failing_lines():
+        for i in range(20):
+            yield "fail" if i % 2 else f"m{i}"
+
+    # a line which fails does not stop the batch
+    client = RecordingClient()
+    asyncio.run(asyncio.wait_for(run_batch(client, failing_lines(), 2), 5))
+    assert sorted(client.sent) == sorted(f"m{i}" for i in range(0, 20, 2))
+
+
+@pytest.mark.skipif(
+    not os.environ.get("SPCHAT_BENCHMARK_GATE"),
+    reason=f"set SPCHAT_BENCHMARK_GATE=1 to check hot paths against {BASELINE_FILE}",
+)
+def test_microbenchmark_gate():
+    regressions = gate_regressions()
+    assert not regressions, "slower than baseline:\n" + "\n".join(regressions)
@@ -0,0 +1,271 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Tracing of sampled messages through client, chat server, exchange server
+# and the remote server. A trace id is carried in the frame (FLAG_TRACE) and
+# in exchange json ("trace"), and each hop writes a span of the events the
+# message passed there, one json line per span.
+# The same file is used by server and client, keep both copies identical.
+#
+# Spans of the files of all hops are joined by trace id and summarized by:
+#   python tracing.py traces/*.jsonl
+
+import argparse
+import asyncio
+import atexit
+import json
+import logging
+import os
+import random
+import socket
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# random trace id, carried as a raw field in frames and as hex in json
+TRACE_ID_BYTES = 8
+
+# span of the message being handled by the current task, None if the
+# message is not traced
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def tracing_settings(tracing_config: dict) -> Optional[dict]:
+    """
+    Tracer arguments from tracing section of config, None if tracing is
+    disabled
+    """
+    if not tracing_config.get("enabled", False):
+        return None
+    return {
+        "path": time.strftime(tracing_config.get("path", "traces/spans-%Y%m%d-%H%M%S.jsonl")),
+        "collector": tracing_config.get("collector", None),
+        "sample_rate": tracing_config.get("sample_rate", 0.01),
+    }
+
+
+def mark(event: str):
+    """
+    Mark event on span of current message, if it is traced
+    """
+    span = current_span.get()
+    if span is not None:
+        span.mark(event)
+
+
+def current_trace() -> Optional[str]:
+    """
+    Trace id of current message in hex for exchange json, None if not traced
+    """
+    span = current_span.get()
+    return span.trace_id.hex() if span is not None else None
+
+
+class Span:
+    """
+    Events of one message at one hop
+
+    Attributes:
+    - trace_id: raw trace id
+    - hop: name of client or server
+    - link: link the message arrived on, "client" or "peer" at servers,
+      "server" at clients, "user" for messages sent by the user
+    - kind: frame type or exchange tag
+    - started: wall clock seconds of first event, for ordering spans of
+      different hosts
+    - events: list of [event, microseconds since first event], measured
+      with the monotonic clock of the hop
+    """
+    __slots__ = ("trace_id", "hop", "link", "kind", "started", "start_ns", "events")
+
+    def __init__(self, trace_id: bytes, hop: str, link: str, kind: str, event: str):
+        self.trace_id = trace_id
+        self.hop = hop
+        self.link = link
+        self.kind = kind
+        self.started = time.time()
+        self.start_ns = time.monotonic_ns()
+        self.events = [[event, 0]]
+
+    def mark(self, event: str):
+        self.events.append([event, (time.monotonic_ns() - self.start_ns) // 1000])
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "trace": self.trace_id.hex(),
+            "hop": self.hop,
+            "link": self.link,
+            "kind": self.kind,
+            "started": round(self.started, 6),
+            "events": self.events,
+        })
+
+
+class Tracer:
+    """
+    Tracer samples messages and writes their spans to a json lines file,
+    or to a collector receiving one span per UDP datagram
+
+    Attributes:
+    - hop: name of this client or server in spans
+    - sample_rate: fraction of messages traced by this hop, messages
+      arriving with a trace id are always traced
+    - buffer: spans not yet written to file
+    - spans: spans written or sent
+
+    Assumptions:
+    - spans are written once flush_bytes are buffered, flush_interval
+      after the first span buffered, and at exit
+    - spans sent to the collector are lost if it is not listening
+    - timestamps of different hops are not compared, only the events of
+      each hop are measured with its monotonic clock
+    """
+
+    def __init__(
+        self,
+        hop: str,
+        path: Optional[str] = None,
+        collector: Optional[str] = None,
+        sample_rate: float = 0.01,
+        flush_bytes: int = 64 * 1024,
+        flush_interval: float = 1.0,
+    ):
+        self.hop = hop
+        self.path = path
+        self.collector = collector
+        self.sample_rate = sample_rate
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.spans = 0
+        self.file = None
+        self.sock = None
+
+    def open(self):
+        if self.collector:
+            host, _, port = self.collector.rpartition(":")
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.sock.connect((host, int(port)))
+            logger.info(f"sending spans to {self.collector}")
+        else:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+            logger.info(f"writing spans to {self.path}")
+        atexit.register(self.close)
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def flush(self):
+        if self.buffer and self.file is not None:
+            self.file.write("".join(self.buffer))
+            self.file.flush()
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def sample(self) -> Optional[bytes]:
+        """
+        New trace id for a sampled message, None if not sampled
+        """
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return os.urandom(TRACE_ID_BYTES)
+        return None
+
+    def start(self, trace_id: bytes, link: str, kind: str, event: str = "receive") -> Span:
+        return Span(trace_id, self.hop, link, kind, event)
+
+    def finish(self, span: Span):
+        line = span.to_json() + "\n"
+        self.spans += 1
+        if self.sock is not None:
+            try:
+                self.sock.send(line.encode("utf-8"))
+            except OSError:
+                pass
+            return
+        if self.file is None:
+            return
+        self.buffer.append(line)
+        self.buffered_bytes += len(line)
+        if self.buffered_bytes >= self.flush_bytes:
+            self.flush()
+        elif len(self.buffer) == 1:
+            # spans are rare, so that the next one may be far away
+            try:
+                asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+            except RuntimeError:
+                self.flush()
+
+
+def read_spans(paths: List[str]) -> Dict[str, List[dict]]:
+    """
+    Spans of json lines files grouped by trace id, each trace in order of
+    wall clock start of its spans. Lines which are not spans are skipped.
+    """
+    traces = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                    traces.setdefault(span["trace"], []).append(span)
+                except (ValueError, KeyError, TypeError):
+                    continue
+    for spans in traces.values():
+        spans.sort(key=lambda span: span.get("started", 0))
+    return traces
+
+
+def span_duration(span: dict) -> int:
+    """
+    Microseconds from first to last event of span
+    """
+    return span["events"][-1][1] if span.get("events") else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per hop latency of traced messages")
+    parser.add_argument("paths", nargs="+", help="span files of clients and servers")
+    parser.add_argument("--traces", type=int, default=20, help="slowest traces to print")
+    args = parser.parse_args()
+    traces = read_spans(args.paths)
+    durations = {}
+    for spans in traces.values():
+        for span in spans:
+            durations.setdefault((span["hop"], span["link"]), []).append(span_duration(span))
+    print(f"{len(traces)} traces")
+    print(f"{'hop':<16} {'link':<8} {'spans':>7} {'p50 us':>10} {'p99 us':>10} {'max us':>10}")
+    for (hop, link), values in sorted(durations.items()):
+        values.sort()
+        print(
+            f"{hop:<16} {link:<8} {len(values):>7} {values[len(values) // 2]:>10} "
+            f"{values[min(len(values) - 1, len(values) * 99 // 100)]:>10} {values[-1]:>10}"
+        )
+    slowest = sorted(traces.items(), key=lambda item: -sum(map(span_duration, item[1])))
+    for trace_id, spans in slowest[:args.traces]:
+        print(f"\ntrace {trace_id}")
+        for span in spans:
+            events = " ".join(f"{event} {offset}" for event, offset in span["events"])
+            print(f"  {span['hop']:<16} {span['link']:<8} {span['kind']:<14} {events}")
+
+
+if __name__ == "__main__":
+    main()
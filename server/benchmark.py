@@ -0,0 +1,826 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Benchmarks of server hot paths, run from server directory:
+#   python benchmark.py <benchmark> [options]
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List
+
+import websockets
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from compression import client_extensions, compression_settings, server_extensions
+from framing import (
+    BATCH_SUBPROTOCOL, BINARY_SUBPROTOCOL, Frame, FrameType, b64, batch_frames, command_to_text,
+    frame_to_text, pairs_to_fields, parse_command, split_batch, text_field,
+)
+from chat_server import ChatServer
+from exchange_server import (
+    ExchangeServer, Presence, batch_json, broadcast_json, check_json, message_json,
+    multi_message_json, parse_json, presence_json,
+)
+from roster import parse_roster_command
+from sessions import ClientConnection
+from traffic import LANE_CHAT, LANE_CONTROL, PriorityOutbox
+from unix_socket import bind_unix_socket
+from tls import client_ssl_context, generate_self_signed, server_ssl_context, tls_settings
+
+
+def measure(function: Callable, iterations: int) -> float:
+    """
+    Run function for given iterations, returning CPU microseconds per call
+    """
+    function()
+    start = time.process_time()
+    for _ in range(iterations):
+        function()
+    return (time.process_time() - start) * 1e6 / iterations
+
+
+def iterations_within(function: Callable, budget: float) -> int:
+    """
+    Iterations of function taking about budget CPU seconds, by timing one call
+    """
+    start = time.process_time()
+    function()
+    return max(1, int(budget / max(time.process_time() - start, 1e-6)))
+
+
+def measure_rounds(cases: dict, budget: float, rounds: int) -> dict:
+    """
+    Least CPU microseconds per call of each function of cases, measured
+    once per round. A busy moment of the machine slows down one round of
+    a case instead of all its measurements.
+    """
+    # sizing calls also warm up, buffers freed by the largest cases change
+    # how later buffers are allocated
+    iterations = {name: iterations_within(function, budget) for name, function in cases.items()}
+    results = {name: float("inf") for name in cases}
+    for _ in range(rounds):
+        for name, function in cases.items():
+            results[name] = min(results[name], measure(function, iterations[name]))
+    return results
+
+
+def print_table(header: list, rows: list):
+    widths = [
+        max(len(str(value)) for value in column) for column in zip(header, *rows)
+    ]
+    for row in [header] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+
+def is_view_of(payload, buffer) -> bool:
+    return isinstance(payload, memoryview) and payload.obj is buffer
+
+
+def sample_frames(file_bytes: int) -> dict:
+    """
+    Client frames of typical size, RSA ciphertext is 256 bytes per block
+    """
+    keys = {f"c{i}@s{i % 3}": os.urandom(256) for i in range(10)}
+    return {
+        "broadcast": Frame(FrameType.BROADCAST, (), text_field("hello everyone " * 4)),
+        "direct": Frame(FrameType.DIRECT, (text_field("c2@s2"),), os.urandom(256)),
+        "multi x10": Frame(FrameType.MULTI, pairs_to_fields(keys), os.urandom(64)),
+        "file x10": Frame(
+            FrameType.FILE, [text_field("report.pdf")] + pairs_to_fields(keys), os.urandom(file_bytes)
+        ),
+    }
+
+
+def relay_frame(frame: Frame) -> Frame:
+    """
+    Frame delivered to recipient, as built by ChatServer
+    """
+    if frame.type == FrameType.BROADCAST:
+        return Frame(FrameType.BROADCAST, (text_field("c1"),), frame.payload)
+    if frame.type == FrameType.DIRECT:
+        return Frame(FrameType.DIRECT, (text_field("c1"), frame.fields[0]), frame.payload)
+    if frame.type == FrameType.MULTI:
+        return Frame(FrameType.MULTI, (text_field("c1@s1"), frame.fields[1]), frame.payload)
+    return Frame(FrameType.FILE, (text_field("c1@s1"), frame.fields[0], frame.fields[2]), frame.payload)
+
+
+def bench_framing(args):
+    """
+    Compare text commands with binary frames on the client link: bytes on
+    the wire, CPU per frame for the server to decode the client frame and
+    encode it for the recipient, and whether the decoded payload is copied
+    """
+    rows = []
+    for name, frame in sample_frames(args.file_bytes).items():
+        iterations = max(1, args.iterations * 1024 // (len(frame.payload) + 1024))
+        text = command_to_text(frame)
+        data = frame.encode()
+
+        def text_server():
+            received = parse_command(text)
+            frame_to_text(relay_frame(received))
+
+        def binary_server():
+            received = Frame.decode(data)
+            relay_frame(received).encode()
+
+        decoded = Frame.decode(data)
+        rows.append([
+            name,
+            len(text.encode("utf-8")),
+            len(data),
+            f"{measure(text_server, iterations):.1f}",
+            f"{measure(binary_server, iterations):.1f}",
+            "no" if is_view_of(parse_command(text).payload, text) else "yes",
+            "no" if is_view_of(decoded.payload, data) else "yes",
+        ])
+    print_table(
+        ["frame", "text B", "binary B", "text us", "binary us", "text copy", "binary copy"],
+        rows,
+    )
+
+
+def sample_messages(file_bytes: int, variants: int) -> dict:
+    """
+    Variants of websocket messages of client and peer links, differing in
+    ciphertext and users. Presence carries RSA 2048 public keys in PEM.
+    """
+    presences = [
+        Presence(f"c{i}", f"c{i}@s1", rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        ).public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode("utf-8"))
+        for i in range(variants + 10)
+    ]
+    messages = {}
+    for i in range(variants):
+        frames = sample_frames(file_bytes)
+        for name, data in {
+            "presence x1": presence_json(presences[i:i + 1]).encode("utf-8"),
+            "presence x10": presence_json(presences[i:i + 10]).encode("utf-8"),
+            "broadcast text": command_to_text(frames["broadcast"]).encode("utf-8"),
+            "direct text": command_to_text(frames["direct"]).encode("utf-8"),
+            "direct binary": frames["direct"].encode(),
+            "multi x10 binary": frames["multi x10"].encode(),
+            "file binary": frames["file x10"].encode(),
+            "exchange message": message_json(
+                "c1@s1", "c2@s2", base64.b64encode(os.urandom(256)).decode("utf-8")
+            ).encode("utf-8"),
+        }.items():
+            messages.setdefault(name, []).append(data)
+    return messages
+
+
+def negotiate_compression(settings: dict):
+    """
+    Extensions of client and server after negotiating with given settings
+    """
+    server_factories = server_extensions(settings)
+    for client_factory in client_extensions(settings):
+        for server_factory in server_factories:
+            if server_factory.name == client_factory.name:
+                params, server = server_factory.process_request_params(
+                    client_factory.get_request_params(), []
+                )
+                return client_factory.process_response_params(params, []), server
+    return None, None
+
+
+COMPRESSION_MODES = {
+    "off": {"enabled": False},
+    "deflate all": {"threshold_bytes": 0, "skip_ciphertext": False, "preset_dictionary": False},
+    "selective": {"preset_dictionary": False},
+    "selective+dict": {},
+}
+
+
+def bench_compression(args):
+    """
+    Compare bytes on the wire and CPU to compress and decompress websocket
+    messages, with permessage-deflate for every message, skipping short
+    messages and ciphertext, and with the preset dictionary for presence.
+    First B is the first message on a new connection, B and CPU are
+    averaged over the following variants on the same connection.
+    """
+    rows = []
+    for name, variants in sample_messages(args.file_bytes, 16).items():
+        frames = [websockets.frames.Frame(websockets.frames.OP_BINARY, data) for data in variants]
+        raw = len(variants[0])
+        rounds = max(1, args.iterations * 64 // (raw + 1024))
+        for mode, compression_config in COMPRESSION_MODES.items():
+            settings = compression_settings(compression_config)
+            if not settings["enabled"]:
+                rows.append([name, mode, raw, raw, raw, "0.0"])
+                continue
+            first_bytes = 0
+            later_bytes = 0
+            cpu = 0.0
+            for _ in range(rounds):
+                sender, receiver = negotiate_compression(settings)
+                receiver.decode(sender.encode(frames[0]))
+                first = sender.sent_bytes
+                start = time.process_time()
+                for frame in frames[1:]:
+                    receiver.decode(sender.encode(frame))
+                cpu += time.process_time() - start
+                first_bytes += first
+                later_bytes += sender.sent_bytes - first
+            later = rounds * (len(frames) - 1)
+            rows.append([
+                name, mode, raw, first_bytes // rounds, later_bytes // later, f"{cpu * 1e6 / later:.1f}"
+            ])
+    print_table(["message", "compression", "raw B", "first B", "B", "cpu us"], rows)
+
+
+async def run_load(batch: bool, clients: int, messages: int, burst: int, window: float) -> list:
+    """
+    Deliver messages to clients connected over localhost through their
+    outboxes, burst messages per loop tick, and count websocket frames
+    """
+    subprotocol = BATCH_SUBPROTOCOL if batch else BINARY_SUBPROTOCOL
+    outboxes = []
+
+    async def handler(websocket):
+        outboxes.append(PriorityOutbox(
+            websocket, batch=batch_frames if batch else None, batch_window=window
+        ))
+        await websocket.wait_closed()
+
+    async def receive(websocket):
+        received = 0
+        frames = 0
+        while frames < messages:
+            frame = Frame.decode(await websocket.recv())
+            received += 1
+            frames += len(split_batch(frame)) if frame.type == FrameType.BATCH else 1
+        return received
+
+    chat = Frame(FrameType.BROADCAST, (text_field("c1"),), text_field("hello everyone " * 4)).encode()
+    presence = Frame(FrameType.JSON, (), text_field('{"tag": "presence", "presence": []}')).encode()
+    async with websockets.serve(handler, "localhost", 0, subprotocols=[subprotocol]) as server:
+        port = server.sockets[0].getsockname()[1]
+        connections = [
+            await websockets.connect(f"ws://localhost:{port}", subprotocols=[subprotocol])
+            for _ in range(clients)
+        ]
+        while len(outboxes) < clients:
+            await asyncio.sleep(0.01)
+        receivers = [asyncio.create_task(receive(websocket)) for websocket in connections]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        for i in range(messages):
+            for outbox in outboxes:
+                if i % 10:
+                    outbox.put(chat, LANE_CHAT)
+                else:
+                    outbox.put(presence, LANE_CONTROL)
+            if (i + 1) % burst == 0:
+                await asyncio.sleep(0)
+        received = sum(await asyncio.gather(*receivers))
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        for websocket in connections:
+            await websocket.close()
+    delivered = clients * messages
+    return [
+        "batched" if batch else "per message",
+        sum(outbox.sends for outbox in outboxes),
+        f"{received / delivered:.3f}",
+        f"{cpu * 1e6 / delivered:.1f}",
+        f"{delivered / wall:.0f}",
+    ]
+
+
+def bench_load(args):
+    """
+    Compare one websocket frame per delivered message with frames coalesced
+    per client into batch frames, under bursts of deliveries. Server and
+    clients run in this process, CPU includes both sides.
+    """
+    rows = [
+        asyncio.run(run_load(batch, args.clients, args.messages, args.burst, args.batch_window_us / 1e6))
+        for batch in (False, True)
+    ]
+    print_table(["outbound", "sends", "frames/msg", "cpu us/msg", "msg/s"], rows)
+
+
+async def run_federation(batch: bool, messages: int, burst: int, window: float) -> list:
+    """
+    Send broadcast json over one exchange link through its outbox, burst
+    messages per loop tick, and measure frames and latency at the peer
+    """
+    outboxes = []
+    latencies = []
+
+    async def handler(websocket):
+        outboxes.append(PriorityOutbox(
+            websocket, batch=batch_json if batch else None, batch_window=window
+        ))
+        await websocket.wait_closed()
+
+    async def receive(websocket):
+        received = 0
+        while len(latencies) < messages:
+            exchange = json.loads(await websocket.recv())
+            now = time.perf_counter()
+            received += 1
+            for broadcast in exchange["frames"] if exchange["tag"] == "batch" else [exchange]:
+                latencies.append(now - float(broadcast["info"]))
+        return received
+
+    async with websockets.serve(handler, "localhost", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        websocket = await websockets.connect(f"ws://localhost:{port}")
+        while not outboxes:
+            await asyncio.sleep(0.01)
+        receiver = asyncio.create_task(receive(websocket))
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        for i in range(messages):
+            outboxes[0].put(broadcast_json("c1@s1", str(time.perf_counter())), LANE_CHAT)
+            if (i + 1) % burst == 0:
+                await asyncio.sleep(0)
+        received = await receiver
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        await websocket.close()
+    latencies.sort()
+    return [
+        f"batched, {window * 1e6:.0f}us" if batch else "per message",
+        outboxes[0].sends,
+        f"{received / messages:.3f}",
+        f"{cpu * 1e6 / messages:.1f}",
+        f"{messages / wall:.0f}",
+        f"{statistics.median(latencies) * 1000:.2f}",
+        f"{latencies[int(len(latencies) * 0.99)] * 1000:.2f}",
+    ]
+
+
+def bench_federation(args):
+    """
+    Compare one websocket frame per exchange json on a peer link with json
+    coalesced into batch json, without and with a batch window. Both ends
+    run in this process, CPU includes both sides.
+    """
+    window = args.batch_window_us / 1e6
+    cases = [(False, 0), (True, 0)] + ([(True, window)] if window else [])
+    rows = [
+        asyncio.run(run_federation(batch, args.messages, args.burst, batch_window))
+        for batch, batch_window in cases
+    ]
+    print_table(["peer link", "sends", "frames/msg", "cpu us/msg", "msg/s", "p50 ms", "p99 ms"], rows)
+
+
+async def run_transport(unix: bool, messages: int, size: int) -> list:
+    """
+    Send a direct frame of size bytes and wait for it to be echoed, over
+    localhost TCP or a unix socket, with the subprotocol and compression
+    of client links
+    """
+    settings = compression_settings({})
+
+    async def echo(websocket):
+        async for message in websocket:
+            await websocket.send(message)
+
+    frame = Frame(FrameType.DIRECT, (text_field("c2@s1"),), os.urandom(size)).encode()
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory:
+        if unix:
+            serve = websockets.unix_serve(
+                echo, sock=bind_unix_socket(os.path.join(directory, "chat.sock")),
+                subprotocols=[BINARY_SUBPROTOCOL], compression=None, extensions=server_extensions(settings),
+            )
+        else:
+            serve = websockets.serve(
+                echo, "localhost", 0,
+                subprotocols=[BINARY_SUBPROTOCOL], compression=None, extensions=server_extensions(settings),
+            )
+        async with serve as server:
+            options = {
+                "subprotocols": [BINARY_SUBPROTOCOL], "compression": None,
+                "extensions": client_extensions(settings),
+            }
+            if unix:
+                websocket = await websockets.unix_connect(os.path.join(directory, "chat.sock"), **options)
+            else:
+                port = server.sockets[0].getsockname()[1]
+                websocket = await websockets.connect(f"ws://localhost:{port}", **options)
+            start_cpu = time.process_time()
+            for _ in range(messages):
+                start = time.perf_counter()
+                await websocket.send(frame)
+                await websocket.recv()
+                latencies.append(time.perf_counter() - start)
+            cpu = time.process_time() - start_cpu
+            await websocket.close()
+    latencies.sort()
+    return [
+        "unix" if unix else "tcp",
+        size,
+        f"{cpu * 1e6 / messages:.1f}",
+        f"{statistics.median(latencies) * 1e6:.0f}",
+        f"{latencies[int(len(latencies) * 0.99)] * 1e6:.0f}",
+    ]
+
+
+def bench_transport(args):
+    """
+    Compare round trips of direct frames over localhost TCP and unix
+    sockets, for clients and peers on the same host. Both ends run in this
+    process, CPU includes both sides.
+    """
+    rows = [
+        asyncio.run(run_transport(unix, args.messages, size))
+        for size in (256, 64 * 1024)
+        for unix in (False, True)
+    ]
+    print_table(["transport", "bytes", "cpu us/rt", "p50 us", "p99 us"], rows)
+
+
+async def run_handshakes(mode: str, connections: int, directory: str) -> list:
+    """
+    Open and close connections with the websocket handshake, over ws, wss
+    with a full TLS handshake every time, and wss resuming the session
+    """
+    if mode == "ws":
+        server_context = client_context = None
+    else:
+        cert_file = os.path.join(directory, "server.pem")
+        settings = tls_settings({
+            "enabled": True, "cert_file": cert_file, "key_file": os.path.join(directory, "server.key"),
+            "ca_file": cert_file, "session_resumption": mode == "wss resumed",
+        })
+        server_context = server_ssl_context(settings)
+        client_context = client_ssl_context(settings)
+
+    async def handler(websocket):
+        await websocket.wait_closed()
+
+    latencies = []
+    async with websockets.serve(handler, "localhost", 0, ssl=server_context) as server:
+        port = server.sockets[0].getsockname()[1]
+        uri = f"{'ws' if mode == 'ws' else 'wss'}://localhost:{port}"
+        start_cpu = time.process_time()
+        for _ in range(connections):
+            start = time.perf_counter()
+            websocket = await websockets.connect(uri, ssl=client_context)
+            latencies.append(time.perf_counter() - start)
+            if client_context is not None:
+                client_context.remember(websocket)
+            await websocket.close()
+        cpu = time.process_time() - start_cpu
+    latencies.sort()
+    return [
+        mode,
+        client_context.resumed if client_context is not None else "-",
+        f"{cpu * 1e6 / connections:.0f}",
+        f"{statistics.median(latencies) * 1e6:.0f}",
+        f"{latencies[int(len(latencies) * 0.99)] * 1e6:.0f}",
+    ]
+
+
+def bench_tls(args):
+    """
+    Compare connection setup of reconnecting clients and peers without TLS,
+    with full TLS handshakes and with resumed TLS sessions, with self-signed
+    P-256 and RSA 2048 certificates. Both ends run in this process, CPU
+    includes both sides.
+    """
+    rows = [["-"] + asyncio.run(run_handshakes("ws", args.connections, ""))]
+    for key_type in ("ec", "rsa"):
+        with tempfile.TemporaryDirectory() as directory:
+            generate_self_signed(
+                os.path.join(directory, "server.pem"), os.path.join(directory, "server.key"),
+                ["localhost"], key_type=key_type,
+            )
+            rows += [
+                [key_type] + asyncio.run(run_handshakes(mode, args.connections, directory))
+                for mode in ("wss full", "wss resumed")
+            ]
+    print_table(["key", "connection", "resumed", "cpu us/conn", "p50 us", "p99 us"], rows)
+
+
+class PresenceListener:
+    """
+    Stands in for ChatServer, which is notified of presence changes
+    """
+
+    async def broadcast_presence(self):
+        pass
+
+
+def random_public_key() -> str:
+    """
+    PEM of the size of an RSA 2048 public key, without generating one
+    """
+    der = base64.b64decode("MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA") + os.urandom(262)
+    body = base64.b64encode(der).decode("ascii")
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return "-----BEGIN PUBLIC KEY-----\n" + "\n".join(lines) + "\n-----END PUBLIC KEY-----\n"
+
+
+async def run_memory(servers: int, users: int) -> list:
+    """
+    Receive presence of users spread over remote servers twice, as every
+    server announces its full presence list on each change, and measure
+    memory held by the exchange server and its roster
+    """
+    exchange_server = ExchangeServer()
+    exchange_server.set_chat_server(PresenceListener())
+    announcements = {
+        f"s{server}": presence_json([
+            Presence(f"user{i}", f"user{i}@s{server}", random_public_key())
+            for i in range(users // servers)
+        ])
+        for server in range(servers)
+    }
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    update_times = []
+    for _ in range(2):
+        for server_name, data in announcements.items():
+            start = time.perf_counter()
+            await exchange_server.handle_exchange(None, {"name": server_name}, parse_json(data))
+            update_times.append(time.perf_counter() - start)
+    memory = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+    online = len(exchange_server.roster)
+    return [
+        servers,
+        online,
+        f"{memory / online:.0f}",
+        f"{memory / 1024 / 1024:.1f}",
+        f"{statistics.median(update_times[servers:]) * 1000:.1f}",
+    ]
+
+
+def bench_memory(args):
+    """
+    Memory per online federated user held in presences and roster, and
+    time to apply a repeated presence announcement of one server
+    """
+    rows = [asyncio.run(run_memory(args.servers, users)) for users in args.users]
+    print_table(["servers", "users", "bytes/user", "MiB", "update ms"], rows)
+
+
+# Microbenchmarks of hot paths, checked against BASELINE_FILE by
+# test_server.py when SPCHAT_BENCHMARK_GATE is set
+BASELINE_FILE = "benchmark_baseline.json"
+# allowed slowdown relative to baseline, unless set in BASELINE_FILE
+DEFAULT_TOLERANCE = 0.5
+# runs of microbenchmarks making up a new baseline
+BASELINE_RUNS = 3
+# CPU seconds per measurement, and measurements of each case per run
+MICRO_BUDGET = 0.1
+MICRO_ROUNDS = 5
+# exchange json handled per measured call of dispatch cases
+DISPATCH_CALLS = 100
+
+
+def calibration_workload():
+    """
+    Fixed pure Python workload, results are stored relative to it so that a
+    baseline applies to faster or slower machines
+    """
+    total = 0
+    for i in range(20000):
+        total += i * i % 7
+    return total
+
+
+class NullWebsocket:
+    """
+    Stands in for client and peer websockets, sent data is dropped
+    """
+    subprotocol = BINARY_SUBPROTOCOL
+    close_code = None
+
+    async def send(self, data):
+        pass
+
+    async def close(self):
+        pass
+
+
+def dispatch_cases(loop) -> dict:
+    """
+    ExchangeServer.handle_exchange per tag, with 10 local clients behind a
+    ChatServer. Outboxes are drained every 64 json, so that their sends are
+    included.
+    """
+    chat_server = ChatServer()
+    exchange_server = ExchangeServer()
+    chat_server.set_exchange_server(exchange_server)
+    exchange_server.set_chat_server(chat_server)
+    for i in range(10):
+        chat_server.clients[f"c{i}"] = ClientConnection(f"c{i}", NullWebsocket())
+    peer = NullWebsocket()
+    remote_server = {"name": "s2"}
+    exchanges = {
+        "message": message_json("c9@s2", "c1@s4", b64(os.urandom(256))),
+        "message public": broadcast_json("c9@s2", "hello everyone " * 4),
+        "multi_message x3": multi_message_json(
+            "c9@s2", {f"c{i}@s4": b64(os.urandom(256)) for i in range(3)}, b64(os.urandom(64))
+        ),
+        "presence 10": presence_json([
+            Presence(f"u{i}", f"u{i}@s2", random_public_key()) for i in range(10)
+        ]),
+        "check": check_json(),
+    }
+
+    async def dispatch(exchange: dict):
+        for i in range(DISPATCH_CALLS):
+            await exchange_server.handle_exchange(peer, remote_server, exchange)
+            if i % 64 == 63:
+                await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    return {
+        f"dispatch {tag}": (
+            lambda exchange=parse_json(data): loop.run_until_complete(dispatch(exchange)),
+            DISPATCH_CALLS,
+        )
+        for tag, data in exchanges.items()
+    }
+
+
+def micro_cases(loop) -> dict:
+    """
+    Hot paths as { <name>: (function, calls per function call) }
+    """
+    presences = [
+        Presence(f"user{i}", f"user{i}@s2", random_public_key()) for i in range(100000)
+    ]
+    presence_1k = presence_json(presences[:1000])
+    direct = Frame(FrameType.DIRECT, (text_field("c2@s1"),), os.urandom(256))
+    keys = {f"c{i}@s{i % 3}": os.urandom(256) for i in range(10)}
+    multi = Frame(FrameType.MULTI, pairs_to_fields(keys), os.urandom(64))
+    message = message_json("c1@s1", "c2@s2", b64(os.urandom(256)))
+    cases = {
+        "presence_json 10": (lambda: presence_json(presences[:10]), 1),
+        "presence_json 1k": (lambda: presence_json(presences[:1000]), 1),
+        "presence_json 100k": (lambda: presence_json(presences), 1),
+        "parse_json presence 1k": (lambda: parse_json(presence_1k), 1),
+        "message_json": (lambda: message_json("c1@s1", "c2@s2", "abc" * 100), 1),
+        "parse_json message": (lambda: parse_json(message), 1),
+        "parse_command direct": (lambda text=command_to_text(direct): parse_command(text), 1),
+        "parse_command multi x10": (lambda text=command_to_text(multi): parse_command(text), 1),
+        "parse_command broadcast": (lambda: parse_command("hello everyone " * 4), 1),
+        "parse_command LIST": (lambda: parse_command("LIST c 0 50"), 1),
+        "parse_roster_command": (lambda: parse_roster_command("LIST c 0 50"), 1),
+        "Frame.decode direct": (lambda data=direct.encode(): Frame.decode(data), 1),
+    }
+    cases.update(dispatch_cases(loop))
+    return cases
+
+
+def run_micro() -> dict:
+    """
+    Microseconds per call of every case, and of the calibration workload
+    as "calibration"
+    """
+    loop = asyncio.new_event_loop()
+    # server modules log to console at debug level
+    logging.disable(logging.CRITICAL)
+    try:
+        cases = micro_cases(loop)
+        functions = {name: function for name, (function, _) in cases.items()}
+        functions["calibration"] = calibration_workload
+        results = measure_rounds(functions, MICRO_BUDGET, MICRO_ROUNDS)
+        for name, (_, calls) in cases.items():
+            results[name] /= calls
+    finally:
+        logging.disable(logging.NOTSET)
+        loop.close()
+    return results
+
+
+def load_baseline(path: str = BASELINE_FILE) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_baseline(results: dict, tolerance: float, path: str = BASELINE_FILE):
+    calibration = results["calibration"]
+    baseline = {
+        "tolerance": tolerance,
+        "calibration_us": round(calibration, 3),
+        "results": {
+            name: {"us": round(us, 3), "relative": round(us / calibration, 6)}
+            for name, us in results.items() if name != "calibration"
+        },
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float = None) -> List[list]:
+    """
+    Compare results with baseline scaled to this machine by calibration
+
+    Returns:
+        rows of [case, us, baseline us, change, regressed]
+    """
+    if tolerance is None:
+        tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    rows = []
+    for name, us in results.items():
+        expected = baseline["results"].get(name, None)
+        if name == "calibration" or expected is None:
+            continue
+        expected_us = expected["relative"] * results["calibration"]
+        rows.append([name, us, expected_us, us / expected_us - 1, us > expected_us * (1 + tolerance)])
+    return rows
+
+
+def gate_regressions(path: str = BASELINE_FILE) -> List[str]:
+    """
+    Run microbenchmarks and describe cases slower than baseline beyond
+    tolerance, which SPCHAT_BENCHMARK_TOLERANCE overrides
+    """
+    tolerance = os.environ.get("SPCHAT_BENCHMARK_TOLERANCE", None)
+    rows = compare_baseline(
+        run_micro(), load_baseline(path), float(tolerance) if tolerance is not None else None
+    )
+    return [
+        f"{name}: {us:.2f}us, baseline {expected_us:.2f}us ({change:+.0%})"
+        for name, us, expected_us, change, regressed in rows if regressed
+    ]
+
+
+def bench_micro(args):
+    """
+    Microbenchmarks of protocol hot paths compared with the stored
+    baseline, --update-baseline stores the results as new baseline
+    """
+    results = run_micro()
+    if args.update_baseline:
+        # median of runs, so that a baseline is not taken at a slow or fast moment
+        runs = [results] + [run_micro() for _ in range(BASELINE_RUNS - 1)]
+        baseline_results = {name: statistics.median(run[name] for run in runs) for name in results}
+        save_baseline(baseline_results, args.tolerance if args.tolerance is not None else DEFAULT_TOLERANCE)
+        print(f"baseline written to {BASELINE_FILE}")
+    baseline = load_baseline() if os.path.exists(BASELINE_FILE) else {"results": {}}
+    compared = {row[0]: row for row in compare_baseline(results, baseline, args.tolerance)}
+    rows = []
+    for name, us in results.items():
+        if name in compared:
+            _, _, expected_us, change, regressed = compared[name]
+            rows.append([name, f"{us:.2f}", f"{expected_us:.2f}", f"{change:+.0%}", "REGRESSED" if regressed else "ok"])
+        else:
+            rows.append([name, f"{us:.2f}", "-", "-", "-"])
+    print_table(["case", "us", "baseline us", "change", "gate"], rows)
+
+
+BENCHMARKS = {
+    "compression": bench_compression,
+    "federation": bench_federation,
+    "framing": bench_framing,
+    "load": bench_load,
+    "memory": bench_memory,
+    "micro": bench_micro,
+    "tls": bench_tls,
+    "transport": bench_transport,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="server benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--file-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=10, help="messages per loop tick")
+    parser.add_argument("--batch-window-us", type=int, default=0)
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=None, help="allowed slowdown, 0.5 is 50%%")
+    args = parser.parse_args()
+    # server modules log to console at debug level
+    logging.disable(logging.CRITICAL)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import hashlib
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def blob_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobStore:
+    """
+    BlobStore keeps encrypted file chunks addressed by the sha256 of their
+    content, so that a chunk relayed to several recipients or servers is
+    stored once. Recently used chunks stay in memory, older chunks are
+    spilled to disk and read back through mmap.
+
+    Attributes:
+    - memory: OrderedDict of chunks in memory, least recently used first
+        { <hash>: bytes }
+    - disk: OrderedDict of chunks on disk, least recently used first
+        { <hash>: size }
+    - pins: references to chunks which must not be dropped, e.g. by files
+      queued in journal for offline recipients
+        { <hash>: count }
+
+    Assumptions:
+    - a chunk is dropped once both caps are exceeded, unless it is pinned,
+      so pinned chunks may keep the disk above disk_bytes
+    """
+
+    def __init__(
+        self,
+        directory: str = "blobs",
+        chunk_bytes: int = 256 * 1024,
+        memory_bytes: int = 64 * 1024 * 1024,
+        disk_bytes: int = 1024 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.chunk_bytes = chunk_bytes
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.pins = {}
+
+    def open(self):
+        """
+        Load chunks spilled to disk by previous run, oldest access first
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        spilled = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            spilled.append((os.path.getmtime(path), name, os.path.getsize(path)))
+        for _, name, size in sorted(spilled):
+            self.disk[name] = size
+            self.disk_size += size
+        self._evict_disk()
+
+    def put(self, data) -> str:
+        """
+        Store chunk and return its hash
+        """
+        chunk_hash = blob_hash(data)
+        if chunk_hash in self.memory:
+            self.memory.move_to_end(chunk_hash)
+        elif chunk_hash in self.disk:
+            self.disk.move_to_end(chunk_hash)
+        else:
+            self.memory[chunk_hash] = bytes(data)
+            self.memory_size += len(data)
+            self._spill()
+        return chunk_hash
+
+    def put_chunks(self, data: bytes) -> List[str]:
+        """
+        Split data into chunks and store them
+
+        Returns:
+            manifest as list of chunk hashes in order
+        """
+        view = memoryview(data)
+        return [
+            self.put(view[i:i + self.chunk_bytes])
+            for i in range(0, len(data), self.chunk_bytes)
+        ]
+
+    def pin(self, manifest: Iterable[str]):
+        """
+        Keep chunks of manifest until unpinned, pin before open to keep
+        chunks spilled by previous run
+        """
+        for chunk_hash in manifest:
+            self.pins[chunk_hash] = self.pins.get(chunk_hash, 0) + 1
+
+    def unpin(self, manifest: Iterable[str]):
+        for chunk_hash in manifest:
+            count = self.pins.get(chunk_hash, 0)
+            if count > 1:
+                self.pins[chunk_hash] = count - 1
+            else:
+                self.pins.pop(chunk_hash, None)
+        self._evict_disk()
+
+    def has(self, chunk_hash: str) -> bool:
+        return chunk_hash in self.memory or chunk_hash in self.disk
+
+    def missing(self, manifest: Iterable[str]) -> List[str]:
+        return list(dict.fromkeys(h for h in manifest if not self.has(h)))
+
+    def get(self, chunk_hash: str) -> Optional[bytes]:
+        if chunk_hash in self.memory:
+            self.memory.move_to_end(chunk_hash)
+            return self.memory[chunk_hash]
+        if chunk_hash in self.disk:
+            self.disk.move_to_end(chunk_hash)
+            path = self._path(chunk_hash)
+            os.utime(path)
+            with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return buffer[:]
+        return None
+
+    def assemble(self, manifest: List[str]) -> Optional[bytes]:
+        """
+        Concatenate chunks of manifest, None if any chunk is missing
+        """
+        chunks = [self.get(chunk_hash) for chunk_hash in manifest]
+        if any(chunk is None for chunk in chunks):
+            return None
+        return b"".join(chunks)
+
+    def _path(self, chunk_hash: str) -> str:
+        return os.path.join(self.directory, chunk_hash)
+
+    def _spill(self):
+        """
+        Move least recently used chunks from memory to disk
+        """
+        while self.memory_size > self.memory_bytes and self.memory:
+            chunk_hash, data = self.memory.popitem(last=False)
+            self.memory_size -= len(data)
+            try:
+                with open(self._path(chunk_hash), "wb") as file:
+                    file.write(data)
+            except OSError as e:
+                logger.error(f"unable to spill chunk {chunk_hash}: {e}")
+                continue
+            self.disk[chunk_hash] = len(data)
+            self.disk_size += len(data)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        for chunk_hash in list(self.disk):
+            if self.disk_size <= self.disk_bytes:
+                break
+            if chunk_hash in self.pins:
+                continue
+            size = self.disk.pop(chunk_hash)
+            self.disk_size -= size
+            try:
+                os.remove(self._path(chunk_hash))
+            except OSError as e:
+                logger.warning(f"unable to remove chunk {chunk_hash}: {e}")
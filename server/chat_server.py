@@ -7,6 +7,7 @@
 #          Yu-Ting Huang (a1903622)           #
 ###############################################
 
+import asyncio
 import logging
 import logging.config
 import yaml
@@ -16,6 +17,66 @@ import traceback
 import websockets
 import aiofiles
 import hashlib
+import weakref
+from http import HTTPStatus
+from exchange_server import presence_json
+from roster import parse_roster_command, roster_json, roster_count_json
+from rooms import is_valid_room_name, room_members_json, room_delivery_json
+from journal import MessageJournal
+from recorder import LINK_CLIENT, TrafficRecorder, recorder_settings
+from blob_store import BlobStore
+from compression import compression_settings, server_extensions
+from framing import (
+    BATCH_SUBPROTOCOL, BINARY_SUBPROTOCOL, FLAG_REMOTE, VERSION, Frame, FrameType, b64,
+    batch_frames, fields_to_pairs, frame_to_text, is_binary, json_frame, notice_frame,
+    parse_command, parse_server_text, text_field,
+)
+from sessions import ClientConnection, DetachedClient, SessionRegistry, session_json
+from traffic import LANE_CHAT, LANE_CONTROL, LANE_FILE, MemoryBudget, PriorityOutbox, RateLimiter, outbox_settings
+from overload import OverloadController, limits_settings, overload_settings, receive_limits
+from unix_socket import bind_unix_socket, unix_socket_settings
+from tls import server_ssl_context, tls_settings
+from tracing import Tracer, current_span, tracing_settings
+
+
+# maximum receipients of a single MULTI command
+MAX_MULTI_RECIPIENTS = 100
+
+# client commands answered from the roster index
+ROSTER_COMMANDS = ("LIST", "COUNT", "SUBSCRIBE", "UNSUBSCRIBE")
+
+# outbound traffic class of frames to client, other frames are chat
+FRAME_LANES = {
+    FrameType.NOTICE: LANE_CONTROL,
+    FrameType.JSON: LANE_CONTROL,
+    FrameType.FILE: LANE_FILE,
+    FrameType.LEGACY_FILE: LANE_FILE,
+}
+
+# frames of messages and files which are traced when sampled
+TRACED_FRAME_TYPES = (FrameType.DIRECT, FrameType.MULTI, FrameType.FILE, FrameType.LEGACY_FILE)
+
+# frames refused by OverloadController while the server is overloaded
+SHED_FRAME_KINDS = {
+    FrameType.FILE: "file",
+    FrameType.LEGACY_FILE: "file",
+    FrameType.BROADCAST: "broadcast",
+}
+
+# fields required in frame from client by type, e.g. target and file name
+# of LEGACY_FILE
+REQUIRED_FIELDS = {
+    FrameType.DIRECT: 1,
+    FrameType.FILE: 1,
+    FrameType.LEGACY_FILE: 2,
+    FrameType.ROOM: 1,
+}
+
+# frames kept for a session which is not resumed are queued in journal
+JOURNAL_FRAME_TYPES = (FrameType.DIRECT, FrameType.MULTI, FrameType.FILE_REF, FrameType.LEGACY_FILE)
+
+# websocket close codes of a client leaving on purpose, no session is kept
+NORMAL_CLOSE_CODES = (1000, 1001)
 
 
 log_directory = 'log'
@@ -45,6 +106,29 @@ def log_unhandled_exception(exc_type, exc_value, exc_traceback):
 sys.excepthook = log_unhandled_exception
 
 
+def stored_frame(data):
+    """
+    Decode frame queued in journal, text queued by earlier versions is
+    parsed as text sent to client
+    """
+    if data[:1] == bytes([VERSION]):
+        return Frame.decode(data)
+    message = str(data, "utf-8")
+    try:
+        return parse_server_text(message)
+    except ValueError:
+        return notice_frame(message)
+
+
+def file_ref_manifest(frame):
+    """
+    Chunk hashes referenced by frame, None if it is not a file reference
+    """
+    if frame.type != FrameType.FILE_REF:
+        return None
+    return tuple(str(chunk_hash, "utf-8") for chunk_hash in frame.fields[3:])
+
+
 class ChatServer:
     """
     ChatServer handles interaction with clients, including authentication,
@@ -53,15 +137,60 @@ class ChatServer:
 
     Attributes:
         clients: dictionary of connected clients in format:
-            { <username>: websocket }
-        client_names: dictionary of client names with format:
-            { <websocket>: username }
+            { <username>: ClientConnection }
+        roster_subscribers: set of ClientConnection subscribed to presence
+            updates
+        accounts: cached accounts of registered users with format:
+            { <username>: hashed_password }
+        journal: MessageJournal queueing messages for offline users, None if
+            disabled
+        blob_store: BlobStore holding chunks of relayed files
+        rate_limiter: RateLimiter with per user budgets of messages,
+            broadcasts and file bytes
+        outboxes: PriorityOutbox of each client websocket
+        sessions: SessionRegistry of resume tokens, a client losing its
+            connection is replaced by a DetachedClient in its ClientConnection
+            for session_grace seconds
+        recorder: TrafficRecorder of client and peer links, None if
+            disabled
+        unix_listener: websockets.unix_serve of clients on the same host,
+            created by start_server, None if no unix_path is configured
+        limits: connection and memory limits, see limits_settings
+        connection_count: open client websockets, including those not yet
+            authenticated
+        budget: MemoryBudget of bytes waiting in outboxes of clients and
+            peers
+        overload: OverloadController shedding files and broadcasts, shared
+            with exchange server, None if disabled
+        tracer: Tracer of sampled messages and files, shared with exchange
+            server, None if disabled
+        config: config last applied by start_server or reload
         exchange_server: exchange server for forwarding messages and file
     """
 
     def __init__(self):
         self.clients = {}
-        self.client_names = {}
+        self.roster_subscribers = set()
+        self.accounts = None
+        self.journal = None
+        self.blob_store = BlobStore()
+        # last assembled file as (manifest, data), shared by its receipients
+        self.assembled_file = ((), b"")
+        self.rate_limiter = RateLimiter({})
+        self.outboxes = weakref.WeakKeyDictionary()
+        self.outbox_settings = {}
+        self.batch_settings = {}
+        self.sessions = SessionRegistry()
+        self.config = {}
+        self.session_grace = 60
+        self.resume_buffer_frames = 256
+        self.recorder = None
+        self.unix_listener = None
+        self.limits = limits_settings({})
+        self.connection_count = 0
+        self.budget = MemoryBudget()
+        self.overload = None
+        self.tracer = None
         self.server_name = 's4'
 
     def set_exchange_server(self, exchange_server):
@@ -75,6 +204,11 @@ class ChatServer:
                 accounts[username] = password
         return accounts
 
+    async def get_accounts(self):
+        if self.accounts is None:
+            self.accounts = await self.load_accounts()
+        return self.accounts
+
     async def hash_password(self, password):
         h = hashlib.sha256()
         h.update(password.encode())
@@ -82,212 +216,792 @@ class ChatServer:
 
     async def authenticate(self, websocket):
         """
-        Start authentication exchange with client
+        Start authentication exchange with client. Client answering the
+        username prompt with RESUME <token> resumes its session instead.
+
+        Returns:
+            (username, public key, DetachedClient of resumed session)
         """
         try:
             await websocket.send("Enter your username: ")
             username = (await websocket.recv()).strip()
+            if username.startswith("RESUME "):
+                return await self.resume_session(websocket, username[len("RESUME "):].strip())
             await websocket.send("Enter your password: ")
             password = (await websocket.recv()).strip()
             password = await self.hash_password(password)
             accounts = await self.load_accounts()
-            if username in self.clients.keys():
+            self.accounts = accounts
+            current = self.client_socket(username)
+            if current is not None and not isinstance(current, DetachedClient):
                 logger.warning(f"Duplicate login attempt: {username}")
                 await websocket.send("Authentication failed: username already logged in")
-                return None, None
+                return None, None, None
             elif username in accounts and accounts[username] == password:
+                if current is not None:
+                    # new login replaces session waiting to be resumed
+                    await self.end_session(current)
                 await websocket.send("Authentication successful")
                 user_pub_key = await websocket.recv()
-                return username, user_pub_key
+                return username, user_pub_key, None
             else:
                 await websocket.send("Authentication failed")
-                return None, None
+                return None, None, None
         except websockets.exceptions.ConnectionClosed:
             logger.info("Client disconnected during authentication.")
-            return None, None
+            return None, None, None
+
+    async def resume_session(self, websocket, token):
+        """
+        Resume session of token, the previous connection is dropped if it
+        is not yet known to be lost
+        """
+        username = self.sessions.redeem(token)
+        connection = self.clients.get(username, None) if username else None
+        if connection is None:
+            await websocket.send("Session expired")
+            return None, None, None
+        if not isinstance(connection.websocket, DetachedClient):
+            previous_websocket = connection.websocket
+            self.detach_client(connection)
+            asyncio.ensure_future(previous_websocket.close())
+        await websocket.send("Session resumed")
+        return username, None, connection.websocket
 
     async def handle_client(self, websocket):
         """
         Handle all message from listening websocket. It will only process
         if authentication is successful.
+
+        Client negotiating BINARY_SUBPROTOCOL sends and receives binary
+        frames after authentication, otherwise text commands are parsed into
+        the same frames. Client negotiating BATCH_SUBPROTOCOL also receives
+        BATCH frames.
+        """
+        self.connection_count += 1
+        try:
+            await self.serve_client(websocket)
+        finally:
+            self.connection_count -= 1
+
+    async def process_request(self, path, request_headers):
         """
-        username, user_pub_key = await self.authenticate(websocket)
+        Refuse websocket handshake with 503 while max_connections clients
+        are connected, before any state is kept for the connection
+        """
+        if self.connection_count >= self.limits["max_connections"] > 0:
+            logger.warning(f"refused connection, {self.connection_count} clients connected")
+            return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", "10")], b"Server is full, try again later\n"
+        return None
+
+    async def serve_client(self, websocket):
+        username, user_pub_key, detached = await self.authenticate(websocket)
         if not username:
             await websocket.close()
             return
 
-        # Successful authentication represent online client
-        self.clients[username] = websocket
-        self.client_names[websocket] = username
+        if detached is not None:
+            # resumed session keeps presence and room membership
+            await self.attach_client(username, websocket, detached)
+        else:
+            # Successful authentication represent online client
+            self.clients[username] = ClientConnection(username, websocket)
 
-        # Update presence on the exchange server
-        await self.exchange_server.update_presence(
-            "LOCAL", username, username, user_pub_key
-        )
-        welcome_message = f"{username} has joined the chat.\n"
-        logger.info(welcome_message)
-        await self.broadcast_message(welcome_message, websocket)
+            # Update presence on the exchange server
+            await self.exchange_server.update_presence(
+                "LOCAL", username, username, user_pub_key
+            )
+            welcome_message = f"{username} has joined the chat.\n"
+            logger.info(welcome_message)
+            await self.broadcast_message(notice_frame(welcome_message), websocket)
+
+        if self.recorder is not None:
+            self.recorder.record_open(LINK_CLIENT, websocket, self.recorder.user_id(username))
+
+        if self.session_grace > 0:
+            await self.send_frame(websocket, json_frame(
+                session_json(self.sessions.issue(username), self.session_grace)
+            ))
 
         try:
+            await self.replay_journal(username, websocket)
             while True:
                 message = await websocket.recv()
                 if message:
-                    logger.debug(f"Forwarding from {username}: {message}")
-
-                    # command for direct message delivery
-                    # expected format: @<user>@<server_name> <message>
-                    if message.startswith("@"):
-                        message_array = message.split(" ", 1)
-                        if len(message_array) < 2:
-                            continue
-                        target, msg = message.split(" ", 1)
-                        target_array = target.split("@")
-
-                        # indication of local client
-                        if len(target_array) < 3 or target_array[2] == self.server_name:
-                            # local message, e.g. @c1, @c1@s4
-                            await self.send_message_to_client(
-                                msg, username, target_array[1]
-                            )
-
-                        # remote client
+                    try:
+                        if isinstance(message, str):
+                            frame = parse_command(message)
                         else:
-                            await self.exchange_server.send_message_to_server(
-                                f"{username}@{self.server_name}",
-                                target_array[2],
-                                target_array[1],
-                                msg
+                            frame = Frame.decode(message)
+                        logger.debug(f"Forwarding {frame.type.name} from {username}")
+                        if self.recorder is not None:
+                            self.recorder.record_client_in(username, frame, len(message))
+                        span = self.start_span(frame) if self.tracer is not None else None
+                        # low priority work is refused while overloaded
+                        if not self.admit(frame):
+                            if span is not None:
+                                span.mark("shed")
+                                self.tracer.finish(span)
+                            await self.send_notice(
+                                websocket, f"Server busy, {frame.type.name} not sent, try again later"
                             )
-
-                    # command for sending file
-                    elif message.startswith("FILE"):
-                        parts = message.split(" ", 3)
-                        if len(parts) < 4:
-                            logger.error("Invalid client FILE command")
-                            await websocket.send("Invalid FILE command")
                             continue
-
-                        # expected format: FILE <user>@<server_name> <filename> <filedata>
-                        _, target_username, file_name, file_data = parts
-                        target_user_array = target_username.split("@")
-                        if len(target_user_array) < 2:
-                            # local client, e.g. c1 
-                            await self.handle_file_transfer(username, target_username, file_name, file_data, websocket)
-                        elif target_user_array[1] == self.server_name:
-                            # local client, e.g. c1@s4
-                            await self.handle_file_transfer(username, target_user_array[0], file_name, file_data, websocket)
+                        # stop reading from client exceeding its budget
+                        await self.throttle(username, frame)
+                        if span is None:
+                            await self.handle_frame(username, frame, websocket)
                         else:
-                            # remote client
-                            await self.exchange_server.send_file_to_server(
-                                f"{username}@{self.server_name}",
-                                target_user_array[1],
-                                target_user_array[0],
-                                file_name,
-                                file_data
-                            )
-
-                    # everything else considered as broadcast message
-                    else:
-                        # broadcast message to all clients
-                        await self.broadcast_message(
-                            f"{username}: {message}", websocket
-                        )
-                        # broadcast message to all server
-                        await self.exchange_server.broadcast_message(f"{username}@{self.server_name}", message)
+                            await self.handle_traced_frame(span, username, frame, websocket)
+                    except ValueError as e:
+                        logger.error(f"Invalid frame from {username}: {e}")
+                        await self.send_notice(websocket, str(e))
                 else:
                     await websocket.close()
-                    await self.remove_client(websocket)
+                    await self.remove_client(username, websocket)
                     break
         except websockets.ConnectionClosed:
-            await self.remove_client(websocket)
+            await self.disconnect_client(username, websocket)
         except Exception as e:
             logger.error(f"Error: {e}")
-            await self.remove_client(websocket)
+            await self.remove_client(username, websocket)
+        if self.recorder is not None:
+            self.recorder.record_close(LINK_CLIENT, websocket)
 
+    def client_socket(self, username):
+        """
+        Return websocket or DetachedClient of user, None if not connected
+        """
+        connection = self.clients.get(username, None)
+        return connection.websocket if connection is not None else None
 
-    async def broadcast_message(self, message, sender_socket):
+    async def disconnect_client(self, username, websocket):
+        """
+        Keep session of client losing its connection for the grace period,
+        remove client closing its connection on purpose
         """
-        broadcast message to all clients
+        connection = self.clients.get(username, None)
+        if connection is None or connection.websocket is not websocket:
+            # connection was already replaced by resumed session
+            return
+        if self.sessions.has_session(username) and websocket.close_code not in NORMAL_CLOSE_CODES:
+            self.detach_client(connection)
+        else:
+            await self.remove_client(username, websocket)
+
+    def detach_client(self, connection):
         """
-        for client in self.clients.values():
+        Replace websocket of client by DetachedClient buffering its frames
+        until the session is resumed or the grace period ends
+        """
+        username = connection.username
+        websocket = connection.websocket
+        detached = DetachedClient(username, websocket.subprotocol, self.resume_buffer_frames)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            detached.pending_data = outbox.take_pending()
+        connection.websocket = detached
+        detached.expire_handle = asyncio.get_running_loop().call_later(
+            self.session_grace, lambda: asyncio.ensure_future(self.end_session(detached))
+        )
+        logger.info(f"{username} lost connection, session kept for {self.session_grace}s")
+        return detached
+
+    async def attach_client(self, username, websocket, detached):
+        """
+        Resume session on new websocket, sending what was buffered meanwhile
+        """
+        detached.expire_handle.cancel()
+        self.clients[username].websocket = websocket
+        # data queued on lost connection is in the protocol of that connection
+        if detached.pending_data and is_binary(detached.subprotocol) == is_binary(websocket.subprotocol):
+            outbox = self.get_outbox(websocket)
+            for lane, data in detached.pending_data:
+                outbox.put(data, lane)
+        for frame in detached.frames:
+            await self.send_frame(websocket, self.resolve_frame(frame))
+        if detached.dropped:
+            await self.send_notice(websocket, f"{detached.dropped} messages were dropped while disconnected.")
+        logger.info(f"{username} resumed session, replayed {len(detached.frames)} frames")
+
+    async def end_session(self, detached):
+        """
+        End session which is not resumed: remove client, then queue frames
+        addressed to it in journal
+        """
+        detached.expire_handle.cancel()
+        if self.client_socket(detached.username) is not detached:
+            return
+        await self.remove_client(detached.username, detached)
+        if self.journal is None:
+            return
+        for frame in detached.frames:
+            if frame.type in JOURNAL_FRAME_TYPES:
+                await self.journal_frame(detached.username, frame)
+
+    def start_span(self, frame):
+        """
+        Return span of message or file frame carrying a trace id, or sampled
+        here, None if the frame is not traced
+        """
+        if frame.type not in TRACED_FRAME_TYPES:
+            return None
+        if frame.trace is None:
+            frame.trace = self.tracer.sample()
+            if frame.trace is None:
+                return None
+        return self.tracer.start(frame.trace, "client", frame.type.name)
+
+    async def handle_traced_frame(self, span, username, frame, websocket):
+        """
+        Dispatch traced frame, frames and exchange json sent meanwhile carry
+        its trace id
+        """
+        span.mark("route")
+        token = current_span.set(span)
+        try:
+            await self.handle_frame(username, frame, websocket)
+        finally:
+            current_span.reset(token)
+            self.tracer.finish(span)
+
+    async def handle_frame(self, username, frame, websocket):
+        """
+        Dispatch frame from client, payload is passed on without copying
+
+        Raises:
+            ValueError if the frame is malformed
+        """
+        required = REQUIRED_FIELDS.get(frame.type, 0)
+        if len(frame.fields) < required:
+            raise ValueError(f"{frame.type.name} requires {required} fields")
+        sender = f"{username}@{self.server_name}"
+
+        # direct message, target in format of <user>[@<server_name>]
+        if frame.type == FrameType.DIRECT:
+            target_array = frame.field(0).split("@")
+            if len(target_array) < 2 or target_array[1] == self.server_name:
+                # local message, e.g. @c1, @c1@s4
+                await self.send_message_to_client(frame.payload, username, target_array[0])
+            else:
+                # remote client
+                await self.exchange_server.send_message_to_server(
+                    sender, target_array[1], target_array[0], b64(frame.payload)
+                )
+
+        # direct message encrypted once for multiple receipients
+        elif frame.type == FrameType.MULTI:
+            await self.handle_multi_message(
+                username, fields_to_pairs(frame.fields), frame.payload, websocket
+            )
+
+        # file encrypted once for multiple receipients
+        elif frame.type == FrameType.FILE:
+            await self.handle_multi_file(
+                username, frame.field(0), fields_to_pairs(frame.fields[1:]), frame.payload, websocket
+            )
+
+        # file encrypted with public key of target
+        elif frame.type == FrameType.LEGACY_FILE:
+            target_user_array = frame.field(0).split("@")
+            file_name = frame.field(1)
+            if len(target_user_array) < 2 or target_user_array[1] == self.server_name:
+                # local client, e.g. c1, c1@s4
+                await self.handle_file_transfer(
+                    username, target_user_array[0], file_name, frame.payload, websocket
+                )
+            else:
+                # remote client
+                await self.exchange_server.send_file_to_server(
+                    sender,
+                    target_user_array[1],
+                    target_user_array[0],
+                    file_name,
+                    b64(frame.payload)
+                )
+
+        # room message, payload is encrypted by client
+        elif frame.type == FrameType.ROOM:
+            room = frame.field(0)
+            if not self.exchange_server.rooms.is_member(room, sender):
+                await self.send_notice(websocket, f"You are not a member of room {room}")
+                return
+            await self.exchange_server.send_room_message(sender, room, frame.text())
+
+        elif frame.type == FrameType.COMMAND:
+            message = frame.text()
+
+            # command for querying online users
+            # expected format: LIST|COUNT|SUBSCRIBE [prefix] [offset] [limit]
+            if message.split(" ", 1)[0] in ROSTER_COMMANDS:
+                await self.handle_roster_command(message, websocket, username)
+
+            # command for joining or leaving room
+            # expected format: JOIN <room>, LEAVE <room>
+            else:
+                command, _, room = message.partition(" ")
+                room = room.strip()
+                if command not in ("JOIN", "LEAVE"):
+                    await self.send_notice(websocket, f"Unknown command {command}")
+                    return
+                if not is_valid_room_name(room):
+                    await self.send_notice(websocket, f"Invalid room name: {room}")
+                    return
+                if command == "JOIN":
+                    await self.exchange_server.join_room(room, sender)
+                else:
+                    await self.exchange_server.leave_room(room, sender)
+
+        elif frame.type == FrameType.BROADCAST:
+            # broadcast message to all clients
+            await self.broadcast_message(
+                Frame(FrameType.BROADCAST, (text_field(username),), frame.payload), websocket
+            )
+            # broadcast message to all server
+            await self.exchange_server.broadcast_message(sender, frame.text())
+
+        else:
+            raise ValueError(f"Unsupported frame type {frame.type.name}")
+
+    def admit(self, frame) -> bool:
+        """
+        Return if frame is accepted by overload controller, file data also
+        counts against the bytes of files waiting to be sent
+        """
+        kind = SHED_FRAME_KINDS.get(frame.type, None)
+        if kind is None or self.overload is None:
+            return True
+        return self.overload.admit(kind, len(frame.payload) if kind == "file" else 0)
+
+    async def throttle(self, username, frame):
+        """
+        Wait until user has budget for frame, file data is counted in bytes
+        and multi-receipient message per receipient
+        """
+        if frame.type == FrameType.BROADCAST:
+            await self.rate_limiter.throttle(username, "broadcast")
+        elif frame.type in (FrameType.FILE, FrameType.LEGACY_FILE):
+            await self.rate_limiter.throttle(username, "file_bytes", len(frame.payload))
+        elif frame.type == FrameType.MULTI:
+            await self.rate_limiter.throttle(username, "message", len(frame.fields) // 2)
+        else:
+            await self.rate_limiter.throttle(username, "message")
+
+    async def send_frame(self, websocket, frame, lane=None):
+        """
+        Queue frame to client in the protocol negotiated by the client, on
+        the outbound lane of its traffic class
+
+        Raises:
+            OutboxFull if client does not keep up, ConnectionError if closed
+        """
+        if isinstance(websocket, DetachedClient):
+            websocket.buffer(frame)
+            return
+        if lane is None:
+            lane = FRAME_LANES.get(frame.type, LANE_CHAT)
+        if self.tracer is not None and frame.type in TRACED_FRAME_TYPES:
+            span = current_span.get()
+            if span is not None:
+                # continued by the receiving client
+                frame.trace = span.trace_id
+                span.mark("send")
+        if is_binary(websocket.subprotocol):
+            data = frame.encode()
+        else:
+            data = frame_to_text(frame)
+        if self.recorder is not None:
+            self.recorder.record_client_out(websocket, frame, len(data))
+        self.get_outbox(websocket).put(data, lane)
+
+    def get_outbox(self, websocket):
+        """
+        Return outbox of websocket, frames to client advertising
+        BATCH_SUBPROTOCOL are coalesced into BATCH frames
+        """
+        outbox = self.outboxes.get(websocket, None)
+        if outbox is None:
+            if websocket.subprotocol == BATCH_SUBPROTOCOL:
+                outbox = PriorityOutbox(
+                    websocket, batch=batch_frames, **self.outbox_settings, **self.batch_settings
+                )
+            else:
+                outbox = PriorityOutbox(websocket, **self.outbox_settings)
+            self.outboxes[websocket] = outbox
+        return outbox
+
+    async def send_notice(self, websocket, text):
+        await self.send_frame(websocket, notice_frame(text))
+
+    async def broadcast_message(self, frame, sender_socket):
+        """
+        broadcast frame to all clients
+        """
+        for connection in list(self.clients.values()):
+            client = connection.websocket
             if client != sender_socket:
                 try:
-                    await client.send(message)
+                    await self.send_frame(client, frame)
                 except:
                     await client.close()
-                    await self.remove_client(client)
+                    await self.remove_client(connection.username, client)
 
 
-    async def broadcast_presence(self, presence_json):
+    async def broadcast_presence(self):
         """
-        broadcast presence to all clients
+        push presence to subscribed clients only, each receiving the
+        presences matching its subscribed prefix
         """
-        for client in self.clients.values():
+        roster = self.exchange_server.roster
+        # subscribers sharing the same prefix share the same frame
+        presence_by_prefix = {}
+        for connection in list(self.roster_subscribers):
+            prefix = connection.roster_prefix
+            if prefix not in presence_by_prefix:
+                presence_by_prefix[prefix] = json_frame(presence_json(
+                    roster.presences[jid] for jid in roster.match(prefix)
+                ))
+            client = connection.websocket
             try:
-                await client.send(presence_json)
+                await self.send_frame(client, presence_by_prefix[prefix])
             except:
                 await client.close()
-                await self.remove_client(client)
+                await self.remove_client(connection.username, client)
+
+    async def handle_roster_command(self, message, websocket, username):
+        """
+        Answer roster query from client
+
+        Args:
+            message: LIST, COUNT, SUBSCRIBE or UNSUBSCRIBE command
+            websocket: websocket of requesting client
+            username: username of requesting client
+        """
+        try:
+            command, prefix, offset, limit = parse_roster_command(message)
+        except ValueError:
+            logger.error(f"Invalid client roster command: {message}")
+            await self.send_notice(websocket, f"Invalid {message.split(' ', 1)[0]} command")
+            return
+        roster = self.exchange_server.roster
+        if command == "LIST":
+            total, presence_list = roster.query(prefix, offset, limit)
+            await self.send_frame(websocket, json_frame(roster_json(prefix, offset, total, presence_list)))
+        elif command == "COUNT":
+            await self.send_frame(websocket, json_frame(roster_count_json(prefix, roster.count(prefix))))
+        elif command == "SUBSCRIBE":
+            connection = self.clients[username]
+            connection.roster_prefix = prefix
+            self.roster_subscribers.add(connection)
+            await self.send_frame(websocket, json_frame(presence_json(
+                roster.presences[jid] for jid in roster.match(prefix)
+            )))
+        elif command == "UNSUBSCRIBE":
+            connection = self.clients[username]
+            connection.roster_prefix = None
+            self.roster_subscribers.discard(connection)
+
+
+    async def push_room_members(self, room):
+        """
+        Push current members of room, including their public key, to local
+        room members so that they can rotate the room key
+        """
+        rooms = self.exchange_server.rooms
+        roster = self.exchange_server.roster
+        members = [
+            roster.presences[jid]
+            for jid in rooms.all_members(room)
+            if jid in roster.presences
+        ]
+        for jid in list(rooms.local_members(room)):
+            target_username = jid.split("@")[0]
+            target_socket = self.client_socket(target_username)
+            if target_socket is None:
+                continue
+            try:
+                await self.send_frame(target_socket, json_frame(room_members_json(room, jid, members)))
+            except:
+                await target_socket.close()
+                await self.remove_client(target_username, target_socket)
+
+    async def deliver_room_message(self, room, sender, info):
+        """
+        Deliver room message to local room members except the sender
+
+        Args:
+            room: name of room
+            sender: jid of sender in format of <username>@<server_name>
+            info: room message payload encrypted by sender
+        """
+        frame = json_frame(room_delivery_json(room, sender, info))
+        for jid in list(self.exchange_server.rooms.local_members(room)):
+            target_username = jid.split("@")[0]
+            target_socket = self.client_socket(target_username)
+            if jid == sender or target_socket is None:
+                continue
+            try:
+                await self.send_frame(target_socket, frame, LANE_CHAT)
+            except:
+                await target_socket.close()
+                await self.remove_client(target_username, target_socket)
+
+    async def handle_multi_message(self, username, keys, info, websocket):
+        """
+        Deliver message encrypted once for multiple receipients. Receipients
+        are grouped by server, so that each remote server receives a single
+        exchange message for all of its receipients.
+
+        Args:
+            username: username of sender
+            keys: dict of content key wrapped per receipient jid
+            info: message encrypted with content key
+            websocket: websocket of sender
+        """
+        if not 0 < len(keys) <= MAX_MULTI_RECIPIENTS:
+            await self.send_notice(websocket, f"MULTI supports 1 to {MAX_MULTI_RECIPIENTS} receipients")
+            return
+
+        # group receipients by destination server
+        keys_by_server = {}
+        for target, wrapped_key in keys.items():
+            target_array = target.split("@")
+            target_server = target_array[1] if len(target_array) > 1 else self.server_name
+            keys_by_server.setdefault(target_server, {})[target] = wrapped_key
+
+        for target_server, server_keys in keys_by_server.items():
+            if target_server == self.server_name:
+                for target, wrapped_key in server_keys.items():
+                    await self.send_multi_message_to_client(
+                        info, wrapped_key, f"{username}@{self.server_name}",
+                        target.split("@")[0], websocket
+                    )
+            else:
+                await self.exchange_server.send_multi_message_to_server(
+                    f"{username}@{self.server_name}",
+                    target_server,
+                    {target: b64(wrapped_key) for target, wrapped_key in server_keys.items()},
+                    b64(info)
+                )
+
+    async def handle_multi_file(self, username, file_name, keys, file_data, websocket):
+        """
+        Store file encrypted once for multiple receipients in blob store, and
+        pass only its chunk references to local receipients and remote servers
+
+        Args:
+            username: username of sender
+            file_name: name of file
+            keys: dict of file key wrapped per receipient jid
+            file_data: encrypted file data
+            websocket: websocket of sender
+        """
+        if not 0 < len(keys) <= MAX_MULTI_RECIPIENTS:
+            await self.send_notice(websocket, f"MULTIFILE supports 1 to {MAX_MULTI_RECIPIENTS} receipients")
+            return
+        file_name = os.path.basename(file_name).replace(" ", "_")
+        manifest = self.blob_store.put_chunks(file_data)
+        sender = f"{username}@{self.server_name}"
+
+        # group receipients by destination server
+        keys_by_server = {}
+        for target, wrapped_key in keys.items():
+            target_array = target.split("@")
+            target_server = target_array[1] if len(target_array) > 1 else self.server_name
+            keys_by_server.setdefault(target_server, {})[target] = wrapped_key
+
+        for target_server, server_keys in keys_by_server.items():
+            if target_server == self.server_name:
+                for target, wrapped_key in server_keys.items():
+                    await self.deliver_file_ref(
+                        sender, target.split("@")[0], file_name, manifest, wrapped_key, websocket
+                    )
+            elif not await self.exchange_server.send_file_ref_to_server(
+                sender,
+                target_server,
+                {target: b64(wrapped_key) for target, wrapped_key in server_keys.items()},
+                file_name,
+                manifest
+            ):
+                await self.send_notice(websocket, f"Unable to send file to server {target_server}")
+
+    async def deliver_file_ref(self, sender_username, target_username, file_name, manifest, wrapped_key, websocket=None):
+        """
+        Send file referenced by manifest to target username, the reference
+        is kept in journal if target is offline
+
+        Args:
+            sender_username: username of sender in format of <username>@<server_name>
+            target_username: username of target
+            file_name: name of file
+            manifest: list of chunk hashes of encrypted file
+            wrapped_key: file key encrypted with public key of target
+        """
+        frame = Frame(
+            FrameType.FILE_REF,
+            [text_field(sender_username), text_field(file_name), wrapped_key]
+            + [text_field(chunk_hash) for chunk_hash in manifest],
+        )
+        if not await self.deliver_or_store(target_username, frame):
+            await self.report_not_found(target_username, websocket)
 
+    def resolve_frame(self, frame):
+        """
+        Replace file reference by the file data assembled from blob store
+        """
+        manifest = file_ref_manifest(frame)
+        if manifest is None:
+            return frame
+        if self.assembled_file[0] != manifest:
+            file_data = self.blob_store.assemble(manifest)
+            if file_data is None:
+                return notice_frame(
+                    f"File {frame.field(1)} from {frame.field(0)} is no longer available."
+                )
+            self.assembled_file = (manifest, file_data)
+        return Frame(FrameType.FILE, frame.fields[:3], self.assembled_file[1])
+
+    async def send_multi_message_to_client(self, message, wrapped_key, sender_username, target_username, websocket=None):
+        """
+        Send message of MULTI command to target username with its wrapped key
+
+        Args:
+            message: message encrypted with content key
+            wrapped_key: content key encrypted with public key of target
+            sender_username: username of sender in format of <username>@<server_name>
+            target_username: username of target
+        """
+        frame = Frame(FrameType.MULTI, (text_field(sender_username), wrapped_key), message)
+        if not await self.deliver_or_store(target_username, frame):
+            await self.report_not_found(target_username, websocket)
 
     async def send_message_to_client(self, message, sender_username, target_username):
         """
         Send message to target username
 
         Args:
-            message: message to send
+            message: encrypted message to send
             sender_username: username of sender in format of <username>@<server_name>
             target_username: username of target in format of <username>@<server_name>
         """
         logger.info(f"sending to {target_username}")
-        if target_username in self.clients:
-            target_socket = self.clients[target_username]
+        frame = Frame(
+            FrameType.DIRECT, (text_field(sender_username), text_field(target_username)), message
+        )
+        if not await self.deliver_or_store(target_username, frame):
+            await self.report_not_found(target_username, self.client_socket(sender_username))
+
+    async def report_not_found(self, target_username, websocket=None):
+        if websocket is not None:
+            await self.send_notice(websocket, f"User {target_username} not found.")
+        else:
+            logger.warning(f"User {target_username} not found")
+
+    async def deliver_or_store(self, target_username, frame):
+        """
+        Send frame to target if online, otherwise queue it in journal if
+        target is a registered user
+
+        Returns:
+            False if frame is neither delivered nor queued
+        """
+        target_socket = self.client_socket(target_username)
+        if isinstance(target_socket, DetachedClient):
+            # file reference is resolved once the session is resumed
+            target_socket.buffer(frame)
+            return True
+        if target_socket is not None:
             try:
-                await target_socket.send(
-                    f"@{sender_username} to {target_username}: {message}"
-                )
-            except:
+                await self.send_frame(target_socket, self.resolve_frame(frame))
+                return True
+            except Exception as e:
+                logger.error(f"unable to send to {target_username}: {e}")
                 await target_socket.close()
-                await self.remove_client(target_socket)
-        else:
-            sender_socket = self.clients[sender_username]
-            await sender_socket.send(f"User {target_username} not found.")
+                await self.remove_client(target_username, target_socket)
+        if self.journal is None or target_username not in await self.get_accounts():
+            return False
+        if await self.journal_frame(target_username, frame):
+            logger.info(f"queued message for offline user {target_username}")
+            return True
+        return False
 
+    async def journal_frame(self, target_username, frame) -> bool:
+        """
+        Queue frame in journal, chunks of a file reference are pinned in
+        blob store until it is delivered or dropped from journal
+        """
+        manifest = file_ref_manifest(frame)
+        if manifest is not None:
+            self.blob_store.pin(manifest)
+        if await self.journal.append(target_username, frame.encode()):
+            return True
+        if manifest is not None:
+            self.blob_store.unpin(manifest)
+        return False
+
+    def unpin_journaled(self, frame):
+        manifest = file_ref_manifest(frame)
+        if manifest is not None:
+            self.blob_store.unpin(manifest)
+
+    async def replay_journal(self, username, websocket):
+        """
+        Send messages queued while user was offline, in order, then release
+        them from journal once they are written to the connection. If the
+        connection is lost before, they are kept and replayed at next login.
+        """
+        if self.journal is None:
+            return
+        entries = await self.journal.read(username)
+        if not entries:
+            return
+        frames = [stored_frame(data) for _, data in entries]
+        # kept, as a detached session takes the frames of its outbox
+        outbox = self.get_outbox(websocket)
+        for frame in frames:
+            await self.send_frame(websocket, self.resolve_frame(frame))
+        if not await outbox.drain():
+            logger.warning(f"connection of {username} lost, queued messages kept")
+            return
+        await self.journal.consume(username, entries[-1][0])
+        for frame in frames:
+            self.unpin_journaled(frame)
+        logger.info(f"replayed {len(entries)} queued messages to {username}")
 
     # broadcast message from exchange server to all clients
     async def send_message_to_all_clients(self, message, sender_username):
-        for target_socket in self.clients.values():
+        frame = Frame(
+            FrameType.BROADCAST, (text_field(sender_username),), text_field(message), FLAG_REMOTE
+        )
+        for connection in list(self.clients.values()):
             try:
-                await target_socket.send(
-                    f"BROADCAST from {sender_username}: {message}"
-                )
+                await self.send_frame(connection.websocket, frame)
             except:
-                await target_socket.close()
+                await connection.websocket.close()
 
     # Send file to local user
     async def handle_file_transfer(self, sender_username, target_username, file_name, file_data, websocket=None):
-        if target_username in self.clients:
-            target_socket = self.clients[target_username]
-            try:
-                await target_socket.send(f"FILE {sender_username} {file_data} {file_name}")
-            except Exception as e:
-                logger.error(f"unable to send file from {sender_username} to {target_username}: {e}")
-                await target_socket.close()
-                await self.remove_client(target_socket)
-        else:
-            if websocket is not None:
-                await websocket.send(f"User {target_username} not found.")
+        frame = Frame(
+            FrameType.LEGACY_FILE, (text_field(sender_username), text_field(file_name)), file_data
+        )
+        if not await self.deliver_or_store(target_username, frame):
+            await self.report_not_found(target_username, websocket)
 
-    async def remove_client(self, websocket):
-        username = self.client_names.get(websocket)
-        if username:
+    async def remove_client(self, username, websocket):
+        """
+        Remove client if websocket is still its connection, it is not
+        when the session was resumed on another websocket meanwhile
+        """
+        connection = self.clients.get(username, None)
+        if connection is not None and connection.websocket is websocket:
             del self.clients[username]
-            del self.client_names[websocket]
+            self.roster_subscribers.discard(connection)
+            self.sessions.revoke(username)
 
-            # need to update presence
+            # need to update presence and room membership
             await self.exchange_server.remove_presence("LOCAL", f'{username}@{self.server_name}')
+            await self.exchange_server.leave_all_rooms(f'{username}@{self.server_name}')
             logger.info(f"{username} has left the chat.")
-            await self.broadcast_message(f"{username} has left the chat.", websocket)
+            await self.broadcast_message(notice_frame(f"{username} has left the chat."), websocket)
 
     def start_server(self):
         config = {}
@@ -300,6 +1014,147 @@ class ChatServer:
         chat_server_config = config.get("chat_server", {})
         host = chat_server_config.get("host", "localhost")
         port = chat_server_config.get("port", 12345)
-        server = websockets.serve(self.handle_client, host, port)
-        logger.info(f"Server started at {host}:{port}")
+        # clients offering BINARY_SUBPROTOCOL get binary frames, others text
+        subprotocols = [BINARY_SUBPROTOCOL] if chat_server_config.get("binary_frames", True) else None
+        if subprotocols and chat_server_config.get("batch_frames", True):
+            # preferred by clients advertising batch support
+            subprotocols.insert(0, BATCH_SUBPROTOCOL)
+        journal_config = config.get("journal", {})
+        if journal_config.get("enabled", True):
+            self.journal = MessageJournal(
+                directory=journal_config.get("directory", "journal"),
+                segment_bytes=journal_config.get("segment_bytes", 16 * 1024 * 1024),
+                max_total_bytes=journal_config.get("max_total_bytes", 256 * 1024 * 1024),
+                max_age=journal_config.get("max_age_hours", 168) * 3600,
+                max_messages_per_user=journal_config.get("max_messages_per_user", 1000),
+                commit_interval=journal_config.get("commit_interval_ms", 5) / 1000,
+            )
+            self.journal.open()
+        blob_store_config = config.get("blob_store", {})
+        self.blob_store = BlobStore(
+            directory=blob_store_config.get("directory", "blobs"),
+            chunk_bytes=blob_store_config.get("chunk_bytes", 256 * 1024),
+            memory_bytes=blob_store_config.get("memory_bytes", 64 * 1024 * 1024),
+            disk_bytes=blob_store_config.get("disk_bytes", 1024 * 1024 * 1024),
+        )
+        if self.journal is not None:
+            # chunks of files queued for offline users are kept until delivered
+            for data in self.journal.pending_messages():
+                manifest = file_ref_manifest(stored_frame(data))
+                if manifest is not None:
+                    self.blob_store.pin(manifest)
+            self.journal.on_drop = lambda data: self.unpin_journaled(stored_frame(data))
+        self.blob_store.open()
+        # outboxes of clients and peers count against the same budget
+        self.exchange_server.outbox_settings["budget"] = self.budget
+        self.configure(config)
+        recorder_config = recorder_settings(config.get("recorder", {}))
+        if recorder_config is not None:
+            # shared with exchange server, so that both links are in one trace
+            self.recorder = TrafficRecorder(server_name=self.server_name, **recorder_config)
+            self.recorder.open()
+            self.exchange_server.recorder = self.recorder
+        # compression is negotiated by the library, messages are selected here
+        extensions = server_extensions(
+            compression_settings(chat_server_config.get("compression", {}))
+        )
+        # wss, so that passwords and frames are not sent in clear
+        tls = tls_settings(chat_server_config.get("tls", {}))
+        server = websockets.serve(
+            self.handle_client, host, port, subprotocols=subprotocols,
+            compression=None, extensions=extensions,
+            ssl=server_ssl_context(tls) if tls is not None else None,
+            process_request=self.process_request, **receive_limits(self.limits),
+        )
+        logger.info(f"Server started at {'wss' if tls is not None else 'ws'}://{host}:{port}")
+        unix_settings = unix_socket_settings(chat_server_config)
+        if unix_settings is not None:
+            # same protocol as over TCP, bound now so that errors stop the start
+            self.unix_listener = websockets.unix_serve(
+                self.handle_client, sock=bind_unix_socket(**unix_settings),
+                subprotocols=subprotocols, compression=None, extensions=extensions,
+                process_request=self.process_request, **receive_limits(self.limits),
+            )
+            logger.info(f"Server started at {unix_settings['path']}")
         return server
+
+    def configure(self, config: dict):
+        """
+        Apply settings of config which may change while running, at start
+        and at reload. Listeners, the journal, the blob store and the
+        recorder keep the settings they were started with.
+        """
+        self.config = config
+        chat_server_config = config.get("chat_server", {})
+        self.session_grace = chat_server_config.get("session_grace_seconds", 60)
+        self.resume_buffer_frames = chat_server_config.get("resume_buffer_frames", 256)
+        self.batch_settings = {}
+        if chat_server_config.get("binary_frames", True) and chat_server_config.get("batch_frames", True):
+            self.batch_settings = {
+                "batch_window": chat_server_config.get("batch_window_us", 0) / 1e6,
+                "max_batch_bytes": chat_server_config.get("max_batch_bytes", 64 * 1024),
+            }
+        rate_limits_config = config.get("rate_limits", {})
+        # buckets of connected users are kept
+        self.rate_limiter.update({
+            "message": (
+                rate_limits_config.get("messages_per_second", 20),
+                rate_limits_config.get("message_burst", 50),
+            ),
+            "broadcast": (
+                rate_limits_config.get("broadcasts_per_second", 2),
+                rate_limits_config.get("broadcast_burst", 10),
+            ),
+            "file_bytes": (
+                rate_limits_config.get("file_bytes_per_second", 2 * 1024 * 1024),
+                rate_limits_config.get("file_burst_bytes", 8 * 1024 * 1024),
+            ),
+        })
+        self.outbox_settings = {**outbox_settings(config.get("outbound", {})), "budget": self.budget}
+        for outbox in self.outboxes.values():
+            outbox.update(**self.outbox_settings)
+            if outbox.batch is not None and self.batch_settings:
+                outbox.batch_window = self.batch_settings["batch_window"]
+                outbox.max_batch_bytes = self.batch_settings["max_batch_bytes"]
+        self.limits = limits_settings(config.get("limits", {}))
+        overload_config = overload_settings(config.get("overload", {}))
+        if overload_config is None:
+            if self.overload is not None:
+                self.overload.stop()
+            self.overload = None
+        elif self.overload is None:
+            self.overload = OverloadController(
+                self.budget,
+                max_file_bytes=self.limits["max_file_bytes"],
+                max_outbound_bytes=self.limits["max_outbound_bytes"],
+                **overload_config,
+            )
+            self.overload.start()
+        else:
+            # level and counts are kept
+            self.overload.max_file_bytes = self.limits["max_file_bytes"]
+            self.overload.max_outbound_bytes = self.limits["max_outbound_bytes"]
+            for key, value in overload_config.items():
+                setattr(self.overload, key, value)
+        self.exchange_server.overload = self.overload
+        tracing_config = tracing_settings(config.get("tracing", {}))
+        if tracing_config is None:
+            if self.tracer is not None:
+                self.tracer.close()
+            self.tracer = None
+        elif self.tracer is None or (self.tracer.path, self.tracer.collector) != (
+            tracing_config["path"], tracing_config["collector"]
+        ):
+            if self.tracer is not None:
+                self.tracer.close()
+            self.tracer = Tracer(self.server_name, **tracing_config)
+            self.tracer.open()
+        else:
+            self.tracer.sample_rate = tracing_config["sample_rate"]
+        self.exchange_server.tracer = self.tracer
+
+    async def reload(self, config: dict):
+        """
+        Apply changed config while running, clients stay connected
+        """
+        self.configure(config)
@@ -0,0 +1,222 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import zlib
+from typing import List, Optional
+
+from websockets import frames
+from websockets.exceptions import NegotiationError
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+
+DEFLATE_EXTENSION = "permessage-deflate"
+# permessage-deflate with PRESENCE_DICTIONARY preset in both directions,
+# the name has to change together with the dictionary
+PRESET_DEFLATE_EXTENSION = "x-spchat-deflate-v1"
+
+# Fragments of presence json (exchange_server.presence_json and
+# roster.roster_json) and RSA 2048 public keys in PEM, most frequent last
+PRESENCE_DICTIONARY = (
+    b'{"tag": "check"}{"tag": "checked"}{"tag": "attendance"}'
+    b'{"tag": "hello", "server": "", "features": ["reliable", "blob", "batch"]}'
+    b'{"tag": "roster", "prefix": "", "offset": 0, "total": '
+    b'"}, {"nickname": "'
+    b'{"tag": "presence", "presence": [{"nickname": "'
+    b'", "jid": "'
+    b'IDAQAB\\n-----END PUBLIC KEY-----\\n"}]}'
+    b'", "publickey": "-----BEGIN PUBLIC KEY-----\\n'
+    b'MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA'
+)
+
+# bytes at the end of a message checked for ciphertext, where the payload
+# follows frame headers and names
+CIPHERTEXT_SAMPLE_BYTES = 512
+
+
+def compression_settings(compression_config: dict) -> dict:
+    """
+    Compression settings of one endpoint from compression section of config
+    """
+    return {
+        "enabled": compression_config.get("enabled", True),
+        "window_bits": compression_config.get("window_bits", 12),
+        "memory_level": compression_config.get("memory_level", 5),
+        "level": compression_config.get("level", 6),
+        "threshold": compression_config.get("threshold_bytes", 128),
+        "skip_ciphertext": compression_config.get("skip_ciphertext", True),
+        "preset_dictionary": compression_config.get("preset_dictionary", True),
+    }
+
+
+def is_ciphertext(data: bytes) -> bool:
+    """
+    Guess if data ends with encrypted or random bytes by counting distinct
+    byte values, text and base64 use far fewer of them
+    """
+    sample = data[-CIPHERTEXT_SAMPLE_BYTES:]
+    return len(set(sample)) > min(128, len(sample) // 2)
+
+
+def is_compressible(data: bytes, threshold: int, skip_ciphertext: bool) -> bool:
+    if len(data) < threshold:
+        return False
+    return not (skip_ciphertext and is_ciphertext(data))
+
+
+class SelectiveDeflate(Extension):
+    """
+    SelectiveDeflate sends messages shorter than threshold, or looking like
+    ciphertext, uncompressed, and compresses other messages with the
+    negotiated permessage-deflate. RFC 7692 allows any message to be sent
+    uncompressed, so the receiver needs no support for it.
+
+    Attributes:
+    - deflate: negotiated PerMessageDeflate
+    - dictionary: preset dictionary of compressor and decompressor, or None
+    - compressing: if the message being sent is compressed, for its
+      continuation frames
+    - raw_bytes, sent_bytes: message bytes before and after compression
+
+    Assumptions:
+    - with a dictionary, the decompressor is reset here instead of in
+      PerMessageDeflate, which would drop the dictionary
+    """
+
+    def __init__(
+        self,
+        deflate: PerMessageDeflate,
+        name: str,
+        threshold: int,
+        skip_ciphertext: bool,
+        dictionary: Optional[bytes] = None,
+    ):
+        self.deflate = deflate
+        self.name = name
+        self.threshold = threshold
+        self.skip_ciphertext = skip_ciphertext
+        self.dictionary = dictionary
+        self.reset_decoder = False
+        if dictionary is not None:
+            self.reset_decoder = deflate.remote_no_context_takeover
+            deflate.remote_no_context_takeover = False
+            deflate.decoder = self.new_decoder()
+        self.compressing = False
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def __repr__(self) -> str:
+        return f"SelectiveDeflate({self.name}, {self.deflate!r})"
+
+    def new_decoder(self):
+        return zlib.decompressobj(
+            wbits=-self.deflate.remote_max_window_bits, zdict=self.dictionary
+        )
+
+    def decode(self, frame: frames.Frame, *, max_size: Optional[int] = None) -> frames.Frame:
+        if self.reset_decoder and frame.rsv1 and frame.opcode in frames.DATA_OPCODES:
+            self.deflate.decoder = self.new_decoder()
+        return self.deflate.decode(frame, max_size=max_size)
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not frames.OP_CONT:
+            self.compressing = is_compressible(frame.data, self.threshold, self.skip_ciphertext)
+        self.raw_bytes += len(frame.data)
+        if self.compressing:
+            frame = self.deflate.encode(frame)
+        self.sent_bytes += len(frame.data)
+        return frame
+
+
+def deflate_options(settings: dict, dictionary: Optional[bytes] = None) -> dict:
+    compress_settings = {"memLevel": settings["memory_level"], "level": settings["level"]}
+    if dictionary is not None:
+        compress_settings["zdict"] = dictionary
+    return {
+        "server_max_window_bits": settings["window_bits"],
+        "client_max_window_bits": settings["window_bits"],
+        "compress_settings": compress_settings,
+    }
+
+
+def accepted_deflate(accepted_extensions) -> bool:
+    # both extensions use the rsv1 bit, only one of them can be accepted
+    return any(
+        other.name in (DEFLATE_EXTENSION, PRESET_DEFLATE_EXTENSION)
+        for other in accepted_extensions
+    )
+
+
+class ServerDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, name: str, settings: dict, dictionary: Optional[bytes] = None):
+        super().__init__(**deflate_options(settings, dictionary))
+        self.name = name
+        self.threshold = settings["threshold"]
+        self.skip_ciphertext = settings["skip_ciphertext"]
+        self.dictionary = dictionary
+
+    def process_request_params(self, params, accepted_extensions):
+        if accepted_deflate(accepted_extensions):
+            raise NegotiationError(f"skipped {self.name}, compression already accepted")
+        response_params, deflate = super().process_request_params(params, accepted_extensions)
+        return response_params, SelectiveDeflate(
+            deflate, self.name, self.threshold, self.skip_ciphertext, self.dictionary
+        )
+
+
+class ClientDeflateFactory(ClientPerMessageDeflateFactory):
+    def __init__(self, name: str, settings: dict, dictionary: Optional[bytes] = None):
+        super().__init__(**deflate_options(settings, dictionary))
+        self.name = name
+        self.threshold = settings["threshold"]
+        self.skip_ciphertext = settings["skip_ciphertext"]
+        self.dictionary = dictionary
+
+    def process_response_params(self, params, accepted_extensions):
+        if accepted_deflate(accepted_extensions):
+            raise NegotiationError(f"received {self.name}, compression already accepted")
+        deflate = super().process_response_params(params, accepted_extensions)
+        return SelectiveDeflate(
+            deflate, self.name, self.threshold, self.skip_ciphertext, self.dictionary
+        )
+
+
+def server_extensions(settings: dict) -> Optional[List[ServerDeflateFactory]]:
+    """
+    Extensions for websockets.serve, the preset dictionary is preferred
+    when offered by the peer, other peers get plain permessage-deflate
+    """
+    if not settings["enabled"]:
+        return None
+    extensions = [ServerDeflateFactory(DEFLATE_EXTENSION, settings)]
+    if settings["preset_dictionary"]:
+        extensions.insert(
+            0, ServerDeflateFactory(PRESET_DEFLATE_EXTENSION, settings, PRESENCE_DICTIONARY)
+        )
+    return extensions
+
+
+def client_extensions(settings: dict) -> Optional[List[ClientDeflateFactory]]:
+    """
+    Extensions for websockets.connect, offering the preset dictionary first.
+    None if disabled, an empty list would send an empty extension header.
+    """
+    if not settings["enabled"]:
+        return None
+    extensions = [ClientDeflateFactory(DEFLATE_EXTENSION, settings)]
+    if settings["preset_dictionary"]:
+        extensions.insert(
+            0, ClientDeflateFactory(PRESET_DEFLATE_EXTENSION, settings, PRESENCE_DICTIONARY)
+        )
+    return extensions
@@ -0,0 +1,136 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Reload of server_config.yaml while running, without dropping clients or
+# the links to peers which stay in the config:
+#   kill -HUP <pid of secure_chatapp.py>
+
+import asyncio
+import logging
+import signal
+from typing import List
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# settings read once at start, a change is reported and applied by restart
+RESTART_SETTINGS = (
+    "server_name",
+    "chat_server.host",
+    "chat_server.port",
+    "chat_server.unix_path",
+    "chat_server.unix_mode",
+    "chat_server.tls",
+    "chat_server.binary_frames",
+    "chat_server.compression",
+    "exchange_server.host",
+    "exchange_server.port",
+    "exchange_server.unix_path",
+    "exchange_server.unix_mode",
+    "exchange_server.tls.enabled",
+    "exchange_server.tls.cert_file",
+    "exchange_server.tls.key_file",
+    "exchange_server.reliable_delivery",
+    "journal",
+    "blob_store",
+    "recorder",
+    "peer_state",
+)
+
+
+def read_config(path: str) -> dict:
+    """
+    Read server config
+
+    Raises:
+        OSError if the file cannot be read, ValueError if it is not a yaml
+        mapping
+    """
+    with open(path, "r") as f:
+        try:
+            config = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ValueError(f"invalid yaml: {e}")
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} is not a mapping")
+    return config
+
+
+def setting(config: dict, name: str):
+    """
+    Value of dotted setting name, None if not set
+    """
+    value = config
+    for key in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key, None)
+    return value
+
+
+def restart_settings_changed(old_config: dict, new_config: dict) -> List[str]:
+    return [name for name in RESTART_SETTINGS if setting(old_config, name) != setting(new_config, name)]
+
+
+class ConfigReloader:
+    """
+    ConfigReloader applies server config again on SIGHUP. Remote servers
+    added are connected and removed ones disconnected, the others keep
+    their links. Tunables such as rate limits, outbound queues, overload
+    and tracing are applied in place.
+
+    Attributes:
+    - path: server config file
+    - reloads: completed reloads
+    - lock: serialises reloads, a signal arriving during a reload starts
+      another one after it
+
+    Assumptions:
+    - a config which cannot be read is not applied, the running config
+      is kept
+    - RESTART_SETTINGS are kept until the server is restarted
+    """
+
+    def __init__(self, chat_server, exchange_server, path: str = "server_config.yaml"):
+        self.chat_server = chat_server
+        self.exchange_server = exchange_server
+        self.path = path
+        self.reloads = 0
+        self.lock = asyncio.Lock()
+
+    def install(self):
+        """
+        Reload on SIGHUP, where the platform supports it
+        """
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, lambda: asyncio.ensure_future(self.reload())
+            )
+        except (AttributeError, NotImplementedError):
+            logger.warning("SIGHUP is not supported, config reload is disabled")
+
+    async def reload(self) -> bool:
+        """
+        Read config and apply it, return False if it cannot be read
+        """
+        async with self.lock:
+            try:
+                config = read_config(self.path)
+            except (OSError, ValueError) as e:
+                logger.error(f"config not reloaded: {e}")
+                return False
+            changed = restart_settings_changed(self.chat_server.config, config)
+            if changed:
+                logger.warning(f"changed settings applied after restart: {', '.join(changed)}")
+            added, removed = await self.exchange_server.reload(config)
+            await self.chat_server.reload(config)
+            self.reloads += 1
+            logger.info(f"config reloaded, remote servers added: {added}, removed: {removed}")
+            return True
@@ -14,10 +14,60 @@ import os
 import sys
 import json
 from dataclasses import dataclass
-from typing import List
+from typing import Iterable, List, Optional
 import websockets
 import asyncio
+import ssl
+import time
 import uuid
+import base64
+import binascii
+import weakref
+from roster import RosterIndex
+from rooms import RoomIndex, is_valid_room_name
+from reliable import ReliableLink
+from blob_store import blob_hash
+from recorder import LINK_PEER
+from compression import client_extensions, compression_settings, server_extensions
+from traffic import LANE_CHAT, LANE_CONTROL, LANE_FILE, OutboxFull, PriorityOutbox, outbox_settings
+from unix_socket import bind_unix_socket, unix_socket_settings
+from tls import client_ssl_context, server_ssl_context, tls_settings
+from overload import limits_settings, receive_limits
+from tracing import current_span, current_trace, mark
+from peer_state import PeerStateStore, peer_state_settings
+
+
+# optional protocol features supported by this server, advertised in hello,
+# "reliable" only to peers with a ReliableLink, see hello_features
+FEATURES = ["reliable", "blob", "batch"]
+
+# maximum file transfers waiting for chunks from peer servers
+MAX_PENDING_TRANSFERS = 64
+
+# seconds between attempts to connect to a remote server, doubled after
+# each failure, so that peers restarting together find each other quickly
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10
+
+# keys of a remote_servers entry addressing the peer, a peer with any of
+# them changed by reload is reconnected
+PEER_ADDRESS_KEYS = ("host", "port", "unix_path", "tls")
+
+# outbound traffic class of exchange json by tag, other tags are chat
+EXCHANGE_LANES = {
+    "check": LANE_CONTROL,
+    "checked": LANE_CONTROL,
+    "attendance": LANE_CONTROL,
+    "presence": LANE_CONTROL,
+    "presence_current": LANE_CONTROL,
+    "hello": LANE_CONTROL,
+    "ack": LANE_CONTROL,
+    "room_membership": LANE_CONTROL,
+    "blob_want": LANE_CONTROL,
+    "file": LANE_FILE,
+    "multi_file": LANE_FILE,
+    "blob": LANE_FILE,
+}
 
 
 log_directory = "log"
@@ -62,49 +112,117 @@ class Presence:
 
     Assumptions:
     - publickey is in PEM format generated by RSA2048
+    - slotted, as there is one per online user of the federation
     """
+    __slots__ = ("nickname", "jid", "publickey")
     nickname: str
     jid: str
     publickey: str
 
 
-# Json wrapper for messsage
-def message_json(sender: str, recipient: str, info: str) -> str:
+def interned_presence(nickname: str, jid: str, publickey: str) -> Presence:
+    """
+    Presence with interned strings, so that a nickname, jid or public key
+    announced again, or by several servers, is stored once
+    """
+    return Presence(sys.intern(nickname), sys.intern(jid), sys.intern(publickey))
+
+
+# Json wrapper for messsage, trace is the hex trace id of a sampled message
+def message_json(sender: str, recipient: str, info: str, trace: Optional[str] = None) -> str:
+    exchange = {
+        "tag": "message",
+        "from": sender,
+        "to": recipient,
+        "info": info,
+    }
+    if trace is not None:
+        exchange["trace"] = trace
+    return json.dumps(exchange)
+
+
+# Json of message to multiple receipients on the same server. The message is
+# encrypted once, keys holds the content key wrapped for each receipient in
+# format { <jid>: <wrapped_key> }
+def multi_message_json(sender: str, keys: dict, info: str, trace: Optional[str] = None) -> str:
+    exchange = {
+        "tag": "multi_message",
+        "from": sender,
+        "keys": keys,
+        "info": info,
+    }
+    if trace is not None:
+        exchange["trace"] = trace
+    return json.dumps(exchange)
+
+
+# Json to broadcast message
+def broadcast_json(sender: str, info: str) -> str:
     return json.dumps(
         {
             "tag": "message",
             "from": sender,
-            "to": recipient,
+            "to": "public",
             "info": info,
         }
     )
 
 
-# Json to broadcast message
-def broadcast_json(sender: str, info: str) -> str:
+# Json to send file
+def file_json(
+    sender: str, recipient: str, filename: str, encoded_file: str, trace: Optional[str] = None
+) -> str:
+    exchange = {
+        "tag": "file",
+        "from": sender,
+        "to": recipient,
+        "filename": filename,
+        "info": encoded_file,
+    }
+    if trace is not None:
+        exchange["trace"] = trace
+    return json.dumps(exchange)
+
+
+# Json of file kept in blob store, referencing its chunks by hash. Chunks
+# are fetched with blob_want only if the receiving server does not hold them.
+# keys holds the file key wrapped for each receipient { <jid>: <wrapped_key> }
+def file_ref_json(sender: str, keys: dict, filename: str, manifest: List[str]) -> str:
     return json.dumps(
         {
-            "tag": "message",
+            "tag": "file_ref",
             "from": sender,
-            "to": "public",
-            "info": info,
+            "keys": keys,
+            "filename": filename,
+            "manifest": manifest,
         }
     )
 
 
-# Json to send file
-def file_json(sender: str, recipient: str, filename: str, encoded_file: str) -> str:
+# Json of file sent inline to a server without blob store, with the file key
+# wrapped for each of its receipients { <jid>: <wrapped_key> }
+def multi_file_json(sender: str, keys: dict, filename: str, encoded_file: str) -> str:
     return json.dumps(
         {
-            "tag": "file",
+            "tag": "multi_file",
             "from": sender,
-            "to": recipient,
+            "keys": keys,
             "filename": filename,
             "info": encoded_file,
         }
     )
 
 
+# Json request for chunks missing in local blob store
+def blob_want_json(hashes: List[str]) -> str:
+    return json.dumps({"tag": "blob_want", "hashes": hashes})
+
+
+# Json of a chunk in blob store, in base64
+def blob_json(chunk_hash: str, encoded_chunk: str) -> str:
+    return json.dumps({"tag": "blob", "hash": chunk_hash, "info": encoded_chunk})
+
+
 # Json to check if server is online
 # if is_response is True, it will generate response for check request from other server
 def check_json(is_response=False) -> str:
@@ -114,8 +232,9 @@ def check_json(is_response=False) -> str:
         return json.dumps({"tag": "check"})
 
 
-# Json containing list of presence, which represents online users and corresponding public keys
-def presence_json(presence_list: List[Presence]) -> str:
+# Json containing list of presence, which represents online users and corresponding public keys,
+# version identifies the list, so that a server restarted with it only needs a confirmation
+def presence_json(presence_list: Iterable[Presence], version: Optional[str] = None) -> str:
     formated_presence_list = [
         dict(
             {
@@ -126,11 +245,55 @@ def presence_json(presence_list: List[Presence]) -> str:
         )
         for presence in presence_list
     ]
+    if version is not None:
+        return json.dumps({"tag": "presence", "presence": formated_presence_list, "version": version})
     return json.dumps({"tag": "presence", "presence": formated_presence_list})
 
 
-# Json request for server presence list
-def attendance_json() -> str:
+# Json answering attendance carrying the current presence version
+def presence_current_json(version: str) -> str:
+    return json.dumps({"tag": "presence_current", "version": version})
+
+
+# Json announcing local members of a room, sent to all servers on change
+def room_membership_json(room: str, members: List[str]) -> str:
+    return json.dumps(
+        {
+            "tag": "room_membership",
+            "room": room,
+            "members": members,
+        }
+    )
+
+
+# Json of room message, sent once to each server hosting room members
+def room_message_json(sender: str, room: str, info: str) -> str:
+    return json.dumps(
+        {
+            "tag": "room_message",
+            "from": sender,
+            "room": room,
+            "info": info,
+        }
+    )
+
+
+# Json to advertise supported features to peer server after connection
+def hello_json(server_name: str, features: List[str]) -> str:
+    return json.dumps({"tag": "hello", "server": server_name, "features": features})
+
+
+# Json of exchange json queued together for a peer advertising "batch", the
+# frames are already serialised so they are joined without parsing again
+def batch_json(frames: List[str]) -> str:
+    return '{"tag": "batch", "frames": [' + ", ".join(frames) + "]}"
+
+
+# Json request for server presence list, version is the presence version
+# restored from peer state, which the peer confirms instead of sending the list
+def attendance_json(version: Optional[str] = None) -> str:
+    if version is not None:
+        return json.dumps({"tag": "attendance", "version": version})
     return json.dumps({"tag": "attendance"})
 
 
@@ -143,6 +306,22 @@ def parse_json(json_str: str) -> dict:
         return {}
 
 
+# Tag of exchange json built by the json helpers above, which put tag first
+def json_tag(data: str) -> str:
+    if not data.startswith('{"tag": "'):
+        return ""
+    return data[9:data.find('"', 9)]
+
+
+# Decode base64 data of exchange json, None if it is not base64
+def decode_info(info) -> Optional[bytes]:
+    try:
+        return base64.b64decode(info, validate=True)
+    except (binascii.Error, TypeError):
+        logger.warning("Incorrect base64 data")
+        return None
+
+
 class ExchangeServer:
     """
     The ExchangeServer class handle websocket communication with peer server.
@@ -152,8 +331,46 @@ class ExchangeServer:
     Attributes:
     - presence: a dict of presence with format:
         { <server_name>: { <jid>: Presence } }
+    - roster: RosterIndex over all presences for LIST queries from clients
+    - rooms: RoomIndex of room membership across local and remote servers
     - remote_servers: a dict of remote server with format:
-        { <server_name>: { name, host, port, request_websocket, websocket } }
+        { <server_name>: { name, host, port, unix_path, tls, request_websocket, websocket, features } }
+      where unix_path replaces host and port of a peer on the same host,
+      and tls connects to the peer with wss
+    - links: a dict of ReliableLink for sequenced delivery with format:
+        { <server_name>: ReliableLink }
+    - pending_transfers: a dict of file_ref waiting for chunks with format:
+        { <transfer_id>: { server, from, keys, filename, manifest, missing } }
+    - outboxes: PriorityOutbox of each peer websocket, batching json for
+        peers advertising "batch"
+    - recorder: TrafficRecorder shared with chat server, None if disabled
+    - unix_listener: websockets.unix_serve of peers on the same host,
+        created by start_server, None if no unix_path is configured
+    - tls: TLS settings of wss connections to peers
+    - tls_contexts: ResumingSSLContext of each peer connected with wss, in
+        format { <server_name>: ResumingSSLContext }
+    - limits: frame size and read ahead limits of peer links, see
+        limits_settings
+    - overload: OverloadController shared with chat server, None if
+        disabled
+    - exchange_server_config: exchange_server section of the config last
+        applied, for links of remote servers added later
+    - connect_tasks: task connecting to each remote server, in format
+        { <server_name>: asyncio.Task }, cancelled when the server is
+        removed from config. None until connect_remote_servers.
+    - presence_epoch: random id of the local presences of this run, the
+        presence version announced to peers is <presence_epoch>.<changes>
+    - peer_versions: presence version of each remote server, in format
+        { <server_name>: version }, None for peers not announcing one
+    - stale_presences: names of remote servers whose presences are restored
+        from peer state and not yet confirmed, dropped after stale_timeout
+    - peer_state: PeerStateStore of snapshots of remote presences, None if
+        disabled
+    - peer_last_seen: wall clock of last snapshot while each remote server
+        was connected
+    - tracer: Tracer shared with chat server, None if disabled. Messages,
+        multi messages and files of a traced client frame carry its trace
+        id to the peer, which continues the trace.
     - chat_server: ChatServer instance to control message forwarding to local
         client
 
@@ -161,46 +378,51 @@ class ExchangeServer:
     def __init__(self):
         # presences is in format {server_name: {client_jid: Presence}}
         self.presences = {}
+        self.roster = RosterIndex()
+        self.rooms = RoomIndex()
         self.remote_servers = {}
+        self.links = {}
+        self.connect_tasks = None
+        self.exchange_server_config = {}
+        self.pending_transfers = {}
+        self.outboxes = weakref.WeakKeyDictionary()
+        self.outbox_settings = {}
+        self.batch_settings = {}
+        self.compression = compression_settings({})
+        self.tls = None
+        self.tls_contexts = {}
+        self.limits = limits_settings({})
+        self.overload = None
+        self.recorder = None
+        self.tracer = None
+        self.unix_listener = None
+        self.presence_epoch = uuid.uuid4().hex[:8]
+        self.presence_changes = 0
+        self.peer_versions = {}
+        self.stale_presences = set()
+        self.peer_state = None
+        self.peer_last_seen = {}
         self.server_name = "s4"
 
     def set_chat_server(self, chat_server):
         self.chat_server = chat_server
 
+    def presence_version(self) -> str:
+        return f"{self.presence_epoch}.{self.presence_changes}"
+
     # broadcasting presence to all remote servers if connected
     async def broadcast_presence(self):
-        for remote_server in self.remote_servers.values():
-            try:
-                if remote_server.get("request_websocket", None):
-                    await remote_server["request_websocket"].send(
-                        presence_json(
-                            list(self.presences.get("LOCAL", {}).values()))
-                    )
-                elif remote_server.get("websocket", None):
-                    await remote_server["websocket"].send(
-                        presence_json(
-                            list(self.presences.get("LOCAL", {}).values()))
-                    )
-            except Exception as e:
-                logger.error(f"unable to broadcast presence to {remote_server}: {e}")
-                self.reset_request_websocket(remote_server.get("name", None))
+        self.presence_changes += 1
+        data = presence_json(self.presences.get("LOCAL", {}).values(), self.presence_version())
+        for remote_server in list(self.remote_servers.values()):
+            await self.send_to_server(remote_server, data)
 
     # broadcasting message to all remote servers if connected
     async def broadcast_message(self, sender: str, msg: str):
         logger.debug(f'broadcasting message from {sender}: {msg}')
-        for remote_server in self.remote_servers.values():
-            try:
-                if remote_server.get("request_websocket", None):
-                    await remote_server["request_websocket"].send(
-                        broadcast_json(sender, msg)
-                    )
-                elif remote_server.get("websocket", None):
-                    await remote_server["websocket"].send(
-                        broadcast_json(sender, msg)
-                    )
-            except Exception as e:
-                logger.error(f"unable to broadcast message to {remote_server}: {e}")
-                self.reset_request_websocket(remote_server.get("name", None))
+        data = broadcast_json(sender, msg)
+        for remote_server in list(self.remote_servers.values()):
+            await self.send_reliable(remote_server, data)
 
     # send message to target server
     async def send_message_to_server(
@@ -209,20 +431,88 @@ class ExchangeServer:
         remote_server = self.remote_servers.get(target_server, None)
         logger.debug(f"sending message to {remote_server}")
         if remote_server:
-            try:
-                if remote_server.get("request_websocket", None):
-                    await remote_server["request_websocket"].send(
-                        message_json(
-                            sender, f"{target_client}@{target_server}", msg)
-                    )
-                elif remote_server.get("websocket", None):
-                    await remote_server["websocket"].send(
-                        message_json(
-                            sender, f"{target_client}@{target_server}", msg)
-                    )
-            except Exception as e:
-                logger.error(f"unable to send message to {remote_server}: {e}")
-                self.reset_request_websocket(remote_server.get("name", None))
+            await self.send_reliable(
+                remote_server,
+                message_json(sender, f"{target_client}@{target_server}", msg, current_trace()),
+            )
+            mark("send")
+
+    # send one message for all receipients hosted by target server
+    async def send_multi_message_to_server(
+        self, sender: str, target_server: str, keys: dict, info: str
+    ):
+        remote_server = self.remote_servers.get(target_server, None)
+        logger.debug(f"sending message to {len(keys)} receipients on {target_server}")
+        if remote_server:
+            await self.send_reliable(
+                remote_server, multi_message_json(sender, keys, info, current_trace())
+            )
+            mark("send")
+
+    # send file reference for all receipients hosted by target server, the
+    # file itself to a server without blob store
+    async def send_file_ref_to_server(
+        self, sender: str, target_server: str, keys: dict, filename: str, manifest: List[str]
+    ) -> bool:
+        remote_server = self.remote_servers.get(target_server, None)
+        if not remote_server:
+            return False
+        logger.debug(f"sending file {filename} from {sender} to {target_server}")
+        if "blob" in remote_server.get("features", []):
+            await self.send_reliable(
+                remote_server, file_ref_json(sender, keys, filename, manifest)
+            )
+            return True
+        file_data = self.chat_server.blob_store.assemble(manifest)
+        if file_data is None:
+            logger.warning(f"file {filename} from {sender} is no longer available")
+            return False
+        await self.send_reliable(
+            remote_server,
+            multi_file_json(sender, keys, filename, base64.b64encode(file_data).decode("utf-8")),
+        )
+        return True
+
+    async def request_missing_chunks(self, remote_server: dict, transfer_id: str, transfer: dict):
+        """
+        Keep file transfer until its missing chunks are received from remote
+        server, dropping the oldest transfer beyond MAX_PENDING_TRANSFERS
+        """
+        self.pending_transfers[transfer_id] = transfer
+        while len(self.pending_transfers) > MAX_PENDING_TRANSFERS:
+            dropped_id = next(iter(self.pending_transfers))
+            dropped = self.pending_transfers.pop(dropped_id)
+            logger.warning(f"dropping file {dropped['filename']} from {dropped['from']}")
+        await self.send_to_server(remote_server, blob_want_json(sorted(transfer["missing"])))
+
+    def file_transfer(self, remote_server: dict, exchange: dict, manifest: List[str]) -> dict:
+        """
+        File transfer of file_ref or multi_file exchange to local receipients
+        """
+        return {
+            "server": remote_server["name"],
+            "from": exchange.get("from", None),
+            "keys": {
+                jid: key
+                for jid, key in exchange["keys"].items()
+                if jid.endswith(f"@{self.server_name}")
+            },
+            "filename": os.path.basename(
+                exchange.get("filename", f"{str(uuid.uuid4())}.tmp")
+            ).replace(" ", "_"),
+            "manifest": manifest,
+            "missing": set(self.chat_server.blob_store.missing(manifest)),
+        }
+
+    async def complete_file_transfer(self, transfer: dict):
+        for exchange_to, wrapped_key in transfer["keys"].items():
+            wrapped_key = decode_info(wrapped_key)
+            if wrapped_key is None:
+                continue
+            await self.chat_server.deliver_file_ref(
+                transfer["from"], exchange_to.split("@")[0],
+                transfer["filename"], transfer["manifest"], wrapped_key
+            )
 
     # send file to target server, similar to message
     async def send_file_to_server(
@@ -236,28 +526,124 @@ class ExchangeServer:
         remote_server = self.remote_servers.get(target_server, None)
         logger.debug(f"sending file from {sender} to {remote_server}")
         if remote_server:
-            try:
-                if remote_server.get("request_websocket", None):
-                    await remote_server["request_websocket"].send(
-                        file_json(
-                            sender,
-                            f"{target_client}@{target_server}",
-                            filename,
-                            encrypted_file_data,
-                        )
-                    )
-                elif remote_server.get("websocket", None):
-                    await remote_server["websocket"].send(
-                        file_json(
-                            sender,
-                            f"{target_client}@{target_server}",
-                            filename,
-                            encrypted_file_data,
-                        )
-                    )
-            except Exception as e:
-                logger.error(f"unable to send file to {remote_server}: {e}")
-                self.reset_request_websocket(remote_server.get("name", None))
+            await self.send_reliable(
+                remote_server,
+                file_json(
+                    sender,
+                    f"{target_client}@{target_server}",
+                    filename,
+                    encrypted_file_data,
+                    current_trace(),
+                ),
+            )
+            mark("send")
+
+    # websocket to given remote server, prefer proactive connection
+    def get_remote_websocket(self, remote_server: dict):
+        if remote_server.get("request_websocket", None):
+            return remote_server["request_websocket"]
+        return remote_server.get("websocket", None)
+
+    async def send_on(self, websocket, data: str):
+        """
+        Queue exchange json on the outbound lane of its traffic class
+
+        Raises:
+            OutboxFull if peer does not keep up, ConnectionError if closed
+        """
+        tag = json_tag(data)
+        if self.recorder is not None:
+            self.recorder.record_peer_out(websocket, tag, len(data))
+        self.get_outbox(websocket).put(data, EXCHANGE_LANES.get(tag, LANE_CHAT))
+
+    def get_outbox(self, websocket) -> PriorityOutbox:
+        outbox = self.outboxes.get(websocket, None)
+        if outbox is None:
+            outbox = PriorityOutbox(websocket, **self.outbox_settings)
+            self.outboxes[websocket] = outbox
+        return outbox
+
+    def enable_batch(self, websocket):
+        """
+        Coalesce exchange json queued for websocket into batch json, after
+        the peer advertised "batch". Queued json wait at most batch_window
+        before sent, which bounds the latency added by batching.
+        """
+        if not self.batch_settings:
+            return
+        outbox = self.get_outbox(websocket)
+        outbox.batch = batch_json
+        outbox.batch_window = self.batch_settings["batch_window"]
+        outbox.max_batch_bytes = self.batch_settings["max_batch_bytes"]
+
+    # send exchange json to given remote server if connected
+    async def send_to_server(self, remote_server: dict, data: str):
+        try:
+            websocket = self.get_remote_websocket(remote_server)
+            if websocket:
+                await self.send_on(websocket, data)
+        except OutboxFull as e:
+            logger.warning(f"dropping {json_tag(data)} to {remote_server.get('name', None)}: {e}")
+        except Exception as e:
+            logger.error(f"unable to send to {remote_server}: {e}")
+            self.reset_request_websocket(remote_server.get("name", None))
+
+    async def send_raw(self, server_name: str, data: str) -> bool:
+        """
+        Send exchange json for ReliableLink, return False if not connected
+        """
+        remote_server = self.remote_servers.get(server_name, None)
+        websocket = self.get_remote_websocket(remote_server) if remote_server else None
+        if not websocket:
+            return False
+        await self.send_on(websocket, data)
+        return True
+
+    async def send_reliable(self, remote_server: dict, data: str):
+        """
+        Send message through the ReliableLink of remote server if it supports
+        acknowledgement, otherwise send it directly
+        """
+        link = self.links.get(remote_server.get("name", None), None)
+        if link is None or "reliable" not in remote_server.get("features", []):
+            await self.send_to_server(remote_server, data)
+        elif not link.enqueue(data):
+            logger.error(f"unable to send to {remote_server['name']}: send queue is full")
+
+    async def join_room(self, room: str, jid: str):
+        """
+        Add local client to room, announce the new membership to all servers
+        and to local room members
+        """
+        if self.rooms.join(room, jid):
+            await self.broadcast_room_membership(room)
+            await self.chat_server.push_room_members(room)
+
+    async def leave_room(self, room: str, jid: str):
+        if self.rooms.leave(room, jid):
+            await self.broadcast_room_membership(room)
+            await self.chat_server.push_room_members(room)
+
+    async def leave_all_rooms(self, jid: str):
+        for room in self.rooms.rooms_of(jid):
+            await self.leave_room(room, jid)
+
+    async def broadcast_room_membership(self, room: str):
+        data = room_membership_json(room, sorted(self.rooms.local_members(room)))
+        for remote_server in list(self.remote_servers.values()):
+            await self.send_to_server(remote_server, data)
+
+    async def send_room_message(self, sender: str, room: str, info: str):
+        """
+        Send room message once to every server hosting room members, and
+        deliver it to local room members
+        """
+        data = room_message_json(sender, room, info)
+        for server_name in self.rooms.remote_servers(room):
+            remote_server = self.remote_servers.get(server_name, None)
+            if remote_server:
+                await self.send_reliable(remote_server, data)
+        await self.chat_server.deliver_room_message(room, sender, info)
 
     async def update_presence(
         self, server_name: str, client_jid: str, nickname: str, publickey: str
@@ -270,41 +656,39 @@ class ExchangeServer:
         """
         if server_name == "LOCAL":
             client_jid = f"{client_jid}@{self.server_name}"
+        presence = interned_presence(nickname, client_jid, publickey)
         target_server_presences = self.presences.get(server_name, dict())
-        target_server_presences.update(
-            {client_jid: Presence(nickname, client_jid, publickey)}
-        )
+        target_server_presences.update({client_jid: presence})
         self.presences[server_name] = target_server_presences
-        # flatten to presence list as [ {nickname, jid, publickeypem}, ...]
-        flatten_presence = [
-            value
-            for sublist in self.presences.values()
-            for value in sublist.values()
-        ]
+        self.roster.add(presence)
         if server_name == "LOCAL":
             await self.broadcast_presence()
-            await self.chat_server.broadcast_presence(presence_json(flatten_presence))
-        else:
-            await self.chat_server.broadcast_presence(presence_json(flatten_presence))
+        await self.chat_server.broadcast_presence()
 
     async def update_group_presence(
-        self, server_name: str, presence_list: List[Presence]
+        self, server_name: str, presence_list: Iterable[Presence], version: Optional[str] = None
     ):
         """
         update group presence by replacing the corresponding server_name's
-        value
+        value. Servers announce their full presence list on every change,
+        so unchanged presences keep their object and roster entry.
+        Restored presences of the server are replaced as well.
         """
+        self.peer_versions[server_name] = version
+        self.stale_presences.discard(server_name)
+        old_presence_dict = self.presences.get(server_name, {})
         group_presence_dict = {}
+        changed = []
         for presence in presence_list:
-            group_presence_dict.update({presence.jid: presence})
-        self.presences[server_name] = group_presence_dict
-        # flatten to presence list as [ {nickname, jid, publickeypem}, ...]
-        flatten_presence = [
-            value
-            for sublist in self.presences.values()
-            for value in sublist.values()
-        ]
-        await self.chat_server.broadcast_presence(presence_json(flatten_presence))
+            old_presence = old_presence_dict.get(presence.jid, None)
+            if old_presence == presence:
+                presence = old_presence
+            else:
+                changed.append(presence)
+            group_presence_dict[presence.jid] = presence
+        self.presences[sys.intern(server_name)] = group_presence_dict
+        self.roster.replace(old_presence_dict.keys() - group_presence_dict.keys(), changed)
+        await self.chat_server.broadcast_presence()
 
     async def remove_presence(self, server_name: str, client_jid: str):
         """
@@ -314,14 +698,10 @@ class ExchangeServer:
         target_server_presence = self.presences.get(server_name, dict())
         target_server_presence.pop(client_jid, None)
         self.presences[server_name] = target_server_presence
+        self.roster.remove(client_jid)
         if server_name == "LOCAL":
             await self.broadcast_presence()
-            flatten_presence = [
-                value
-                for sublist in self.presences.values()
-                for value in sublist.values()
-            ]
-            await self.chat_server.broadcast_presence(presence_json(flatten_presence))
+            await self.chat_server.broadcast_presence()
 
     def get_presences(self) -> dict:
         return self.presences
@@ -332,35 +712,60 @@ class ExchangeServer:
             self.remote_servers[server_name][
                 "request_websocket"
             ] = None
+            # unacked messages may be lost with the connection
+            if server_name in self.links:
+                self.links[server_name].connection_changed()
 
     async def reset_websocket(self, server_ip: str):
         matched_remote_servers = [
             server
             for server in self.remote_servers.values()
-            if server["host"] == server_ip
+            if server.get("host", None) == server_ip
         ]
         if len(matched_remote_servers) < 1:
             return
-        remote_server = matched_remote_servers[0]
+        await self.reset_server_websocket(matched_remote_servers[0]["name"])
+
+    async def reset_server_websocket(self, server_name: str):
+        remote_server = self.remote_servers.get(server_name, None)
+        if remote_server is None:
+            return
         remote_server["websocket"] = None
         self.remote_servers[remote_server["name"]] = remote_server
+        if remote_server["name"] in self.links:
+            self.links[remote_server["name"]].connection_changed()
         await self.update_group_presence(remote_server["name"], [])
+        for room in self.rooms.remove_server(remote_server["name"]):
+            await self.chat_server.push_room_members(room)
 
     async def exchange_handler(self, websocket, server_name=None):
         """
         Core handler for websocket and request websocket. Handles
         according to received json tag
         """
+        # peer accepted on the unix socket, identified by name instead of address
+        unix_server_name = None
         try:
             remote_address = websocket.remote_address
             # Difference handling for proactive connection and accepted connection
             if isinstance(websocket, websockets.WebSocketServerProtocol):
                 # accepted connection 
-                matched_remote_servers = [
-                    server
-                    for server in self.remote_servers.values()
-                    if server["host"] == remote_address[0]
-                ]
+                if remote_address:
+                    matched_remote_servers = [
+                        server
+                        for server in self.remote_servers.values()
+                        if server.get("host", None) == remote_address[0]
+                    ]
+                else:
+                    # accepted on unix socket, where access is limited by the
+                    # mode of the socket file. The peer names itself in hello,
+                    # which is handled below once the peer is known.
+                    hello = parse_json(str(await websocket.recv()))
+                    matched_remote_servers = [
+                        server
+                        for server in self.remote_servers.values()
+                        if hello.get("tag", None) == "hello" and server["name"] == hello.get("server", None)
+                    ]
                 # disconnect if unknown server
                 if not matched_remote_servers:
                     logger.warning(
@@ -372,6 +777,8 @@ class ExchangeServer:
                 # assoicate the websocket with remote server
                 remote_server["websocket"] = websocket
                 logger.info(f"accepted connection from {remote_server}")
+                if not remote_address:
+                    unix_server_name = remote_server["name"]
             else:
                 # proactive connection 
                 matched_remote_servers = [
@@ -382,82 +789,28 @@ class ExchangeServer:
                 remote_server = matched_remote_servers[0]
                 remote_server["request_websocket"] = websocket
             self.remote_servers[remote_server["name"]] = remote_server
+            if self.recorder is not None:
+                self.recorder.record_open(
+                    LINK_PEER, websocket, self.recorder.server_id(remote_server["name"])
+                )
+            if unix_server_name is not None:
+                await self.handle_exchange(websocket, remote_server, hello)
             async for message in websocket:
                 try:
                     logger.debug(f"Received from exchange server: {message}")
                     exchange = parse_json(str(message))
-                    exchange_type = exchange.get("tag", None)
-                    # similar handling for message and file
-                    if exchange_type == "message" or exchange_type == "file":
-                        exchange_from = exchange.get("from", None)
-                        exchange_to = exchange.get("to", None)
-                        exchange_info = exchange.get("info", None)
-
-                        # broadcast message from remote, forward to local clients
-                        if exchange_to == 'public':
-                            if exchange_type == "message":
-                                await self.chat_server.send_message_to_all_clients(exchange_info, exchange_from)
-                                continue
-
-                        # message validation on sender, receipient, and message
-                        if not exchange_from or not exchange_to or not exchange_info:
-                            logger.warning(
-                                f"Incorrect message format: {message}")
-                            continue
-
-                        # obtaining receipient information
-                        to_array = exchange_to.split("@")
-                        if len(to_array) < 2:
-                            logger.warning(
-                                f"Incorrect receipent format: {exchange_to}")
-                            continue
-                        to_client = to_array[0]
-                        to_server = to_array[1]
-                        if to_server != self.server_name:
-                            logger.warning(
-                                f"Invalid receipent server: {to_server}")
-                            continue
-
-                        # check if receipient is in local presences 
-                        if self.presences["LOCAL"].get(exchange_to, None):
-                            logger.debug(f"forwarding to client {exchange_to}")
-                            if exchange_type == "message":
-                                await self.chat_server.send_message_to_client(
-                                    exchange_info, exchange_from, to_client
-                                )
-                            elif exchange_type == "file":
-                                exchange_filename = exchange.get(
-                                    "filename", f"{str(uuid.uuid4())}.tmp"
-                                ).replace(" ", "_")
-                                await self.chat_server.handle_file_transfer(
-                                    exchange_from, to_client, exchange_filename, exchange_info
+                    # exchange json coalesced by peer server
+                    if exchange.get("tag", None) == "batch":
+                        for batched_exchange in exchange.get("frames", []):
+                            if self.recorder is not None:
+                                self.recorder.record_peer_in(
+                                    remote_server["name"], batched_exchange, len(json.dumps(batched_exchange))
                                 )
-                        else:
-                            logger.warning(f"User {exchange_to} not presence")
-                            continue
-
-                    # responsee for server alive check
-                    elif exchange_type == "check":
-                        # logger.debug(f"sending checked to {websocket.remote_address}")
-                        await websocket.send(check_json(True))
-
-                    # resposne local presence for attendence request 
-                    elif exchange_type == "attendance":
-                        await websocket.send(
-                            presence_json(
-                                list(self.presences.get("LOCAL", {}).values())
-                            )
-                        )
-
-                    # if received presence, update corresponding server's presence
-                    elif exchange_type == "presence":
-                        presence_list = [
-                            Presence(
-                                presence["nickname"], presence["jid"], presence["publickey"])
-                            for presence in exchange.get("presence", [])
-                        ]
-                        await self.update_group_presence(remote_server["name"], presence_list)
-                        logger.debug(f"updated presence: {self.presences}")
+                            await self.handle_traced_exchange(websocket, remote_server, batched_exchange)
+                    else:
+                        if self.recorder is not None:
+                            self.recorder.record_peer_in(remote_server["name"], exchange, len(message))
+                        await self.handle_traced_exchange(websocket, remote_server, exchange)
                 except json.JSONDecodeError:
                     logger.warning(f"incorrect json format: {message}")
         except websockets.exceptions.ConnectionClosedOK:
@@ -465,16 +818,303 @@ class ExchangeServer:
             logger.info(f"Server {remote_address} closed the connection.")
             if len(remote_address) > 0:
                 await self.reset_websocket(remote_address[0])
+            elif unix_server_name is not None:
+                await self.reset_server_websocket(unix_server_name)
         except websockets.exceptions.ConnectionClosedError as e:
             remote_address = websocket.remote_address
             logger.error(f"Connection {remote_address} closed with error: {e.code}, {e.reason}")
             if len(remote_address) > 0:
                 await self.reset_websocket(remote_address[0])
+            elif unix_server_name is not None:
+                await self.reset_server_websocket(unix_server_name)
         except Exception as e:
             remote_address = websocket.remote_address
             logger.error(f"An error occurred: {str(e)}")
             if len(remote_address) > 0:
                 await self.reset_websocket(remote_address[0])
+            elif unix_server_name is not None:
+                await self.reset_server_websocket(unix_server_name)
+        if self.recorder is not None:
+            self.recorder.record_close(LINK_PEER, websocket)
+
+    async def handle_traced_exchange(self, websocket, remote_server: dict, exchange: dict):
+        """
+        Handle exchange json, continuing the trace of json carrying a trace id
+        """
+        trace = exchange.get("trace", None) if self.tracer is not None else None
+        if not isinstance(trace, str):
+            await self.handle_exchange(websocket, remote_server, exchange)
+            return
+        try:
+            trace_id = bytes.fromhex(trace)
+        except ValueError:
+            logger.warning(f"invalid trace id from {remote_server['name']}: {trace[:40]}")
+            await self.handle_exchange(websocket, remote_server, exchange)
+            return
+        span = self.tracer.start(trace_id, "peer", str(exchange.get("tag", None)))
+        token = current_span.set(span)
+        try:
+            await self.handle_exchange(websocket, remote_server, exchange)
+        finally:
+            current_span.reset(token)
+            self.tracer.finish(span)
+
+    async def handle_exchange(self, websocket, remote_server: dict, exchange: dict):
+        """
+        Handle exchange json received from remote server according to its tag
+        """
+        exchange_type = exchange.get("tag", None)
+        link = self.links.get(remote_server["name"], None)
+
+        # sequenced message from peer, drop duplicates of retransmission
+        if "seq" in exchange and link is not None:
+            if not link.accept(exchange.get("epoch", None), exchange["seq"]):
+                logger.debug(f"duplicate seq {exchange['seq']} from {remote_server['name']}")
+                return
+
+        # similar handling for message and file
+        if exchange_type == "message" or exchange_type == "file":
+            exchange_from = exchange.get("from", None)
+            exchange_to = exchange.get("to", None)
+            exchange_info = exchange.get("info", None)
+
+            # broadcast message from remote, forward to local clients
+            if exchange_to == 'public':
+                if exchange_type == "message":
+                    # fan out to all clients is shed first under overload
+                    if self.overload is not None and not self.overload.admit("broadcast"):
+                        logger.debug(f"overloaded, dropped broadcast from {exchange_from}")
+                        return
+                    await self.chat_server.send_message_to_all_clients(exchange_info, exchange_from)
+                    return
+
+            # message validation on sender, receipient, and message
+            if not exchange_from or not exchange_to or not exchange_info:
+                logger.warning(
+                    f"Incorrect message format: {exchange}")
+                return
+
+            # obtaining receipient information
+            to_array = exchange_to.split("@")
+            if len(to_array) < 2:
+                logger.warning(
+                    f"Incorrect receipent format: {exchange_to}")
+                return
+            to_client = to_array[0]
+            to_server = to_array[1]
+            if to_server != self.server_name:
+                logger.warning(
+                    f"Invalid receipent server: {to_server}")
+                return
+
+            # chat server passes encrypted data in binary
+            exchange_data = decode_info(exchange_info)
+            if exchange_data is None:
+                return
+
+            # forward to local receipient, which is queued by chat server if offline
+            if not self.presences.get("LOCAL", {}).get(exchange_to, None):
+                logger.info(f"User {exchange_to} not presence")
+            logger.debug(f"forwarding to client {exchange_to}")
+            mark("route")
+            if exchange_type == "message":
+                await self.chat_server.send_message_to_client(
+                    exchange_data, exchange_from, to_client
+                )
+            elif exchange_type == "file":
+                exchange_filename = exchange.get(
+                    "filename", f"{str(uuid.uuid4())}.tmp"
+                ).replace(" ", "_")
+                await self.chat_server.handle_file_transfer(
+                    exchange_from, to_client, exchange_filename, exchange_data
+                )
+
+        # message to multiple local receipients, fan out to each of them
+        elif exchange_type == "multi_message":
+            exchange_from = exchange.get("from", None)
+            exchange_keys = exchange.get("keys", None)
+            exchange_info = exchange.get("info", None)
+            if not exchange_from or not isinstance(exchange_keys, dict) or not exchange_info:
+                logger.warning(f"Incorrect message format: {exchange}")
+                return
+            exchange_data = decode_info(exchange_info)
+            if exchange_data is None:
+                return
+            mark("route")
+            for exchange_to, wrapped_key in exchange_keys.items():
+                to_array = exchange_to.split("@")
+                wrapped_key = decode_info(wrapped_key)
+                if len(to_array) < 2 or to_array[1] != self.server_name or wrapped_key is None:
+                    logger.warning(f"Invalid receipient: {exchange_to}")
+                    continue
+                await self.chat_server.send_multi_message_to_client(
+                    exchange_data, wrapped_key, exchange_from, to_array[0]
+                )
+
+        # file referenced by chunk hashes, fetch chunks not in blob store
+        elif exchange_type == "file_ref":
+            exchange_keys = exchange.get("keys", None)
+            manifest = exchange.get("manifest", None)
+            if not isinstance(exchange_keys, dict) or not isinstance(manifest, list):
+                logger.warning(f"Incorrect file_ref format: {str(exchange)[:200]}")
+                return
+            transfer = self.file_transfer(remote_server, exchange, manifest)
+            if transfer["missing"]:
+                await self.request_missing_chunks(
+                    remote_server, str(uuid.uuid4()), transfer
+                )
+            else:
+                await self.complete_file_transfer(transfer)
+
+        # file sent inline by server not relaying file references to us
+        elif exchange_type == "multi_file":
+            exchange_keys = exchange.get("keys", None)
+            exchange_info = exchange.get("info", None)
+            if not exchange.get("from", None) or not isinstance(exchange_keys, dict) or not exchange_info:
+                logger.warning(f"Incorrect multi_file format: {str(exchange)[:200]}")
+                return
+            exchange_data = decode_info(exchange_info)
+            if exchange_data is None:
+                return
+            mark("route")
+            manifest = self.chat_server.blob_store.put_chunks(exchange_data)
+            await self.complete_file_transfer(self.file_transfer(remote_server, exchange, manifest))
+
+        # peer server requests chunks it does not hold
+        elif exchange_type == "blob_want":
+            for chunk_hash in exchange.get("hashes", []):
+                chunk = self.chat_server.blob_store.get(chunk_hash)
+                if chunk is None:
+                    logger.warning(f"requested chunk {chunk_hash} not found")
+                    continue
+                await self.send_on(
+                    websocket,
+                    blob_json(chunk_hash, base64.b64encode(chunk).decode("utf-8"))
+                )
+
+        # chunk requested from peer server, complete waiting transfers
+        elif exchange_type == "blob":
+            chunk_hash = exchange.get("hash", None)
+            if not isinstance(chunk_hash, str):
+                logger.warning(f"Incorrect blob format: {str(exchange)[:200]}")
+                return
+            chunk = decode_info(exchange.get("info", None))
+            if chunk is None:
+                return
+            if blob_hash(chunk) != chunk_hash:
+                logger.warning(f"chunk does not match hash {chunk_hash}")
+                return
+            self.chat_server.blob_store.put(chunk)
+            for transfer_id, transfer in list(self.pending_transfers.items()):
+                transfer["missing"].discard(chunk_hash)
+                if not transfer["missing"]:
+                    del self.pending_transfers[transfer_id]
+                    await self.complete_file_transfer(transfer)
+
+        # peer server acknowledges sequenced messages
+        elif exchange_type == "ack":
+            if link is not None:
+                link.ack(exchange.get("epoch", None), exchange.get("ack", 0))
+
+        # peer server advertises its features, reply to accepted connection
+        elif exchange_type == "hello":
+            remote_server["features"] = exchange.get("features", [])
+            if "batch" in remote_server["features"]:
+                self.enable_batch(websocket)
+            if isinstance(websocket, websockets.WebSocketServerProtocol):
+                await self.send_on(websocket, hello_json(self.server_name, self.hello_features(remote_server["name"])))
+            if link is not None and "reliable" in remote_server["features"]:
+                link.connection_changed()
+            elif link is not None and (link.next_seq > 1 or link.peer_epoch is not None):
+                # peer no longer acknowledges, restart link without its seq
+                # and send what is unacked directly
+                name = remote_server["name"]
+                self.links[name] = self.create_link(name, self.exchange_server_config)
+                for data in link.take_unacked():
+                    await self.send_to_server(remote_server, data)
+            # chunk requests may be lost with previous connection
+            for transfer in self.pending_transfers.values():
+                if transfer["server"] == remote_server["name"]:
+                    await self.send_on(websocket, blob_want_json(sorted(transfer["missing"])))
+
+        # responsee for server alive check
+        elif exchange_type == "check":
+            # logger.debug(f"sending checked to {websocket.remote_address}")
+            await self.send_on(websocket, check_json(True))
+
+        # resposne local presence and room membership for attendence request 
+        elif exchange_type == "attendance":
+            if exchange.get("version", None) == self.presence_version():
+                # restarted peer restored the current list
+                await self.send_on(websocket, presence_current_json(self.presence_version()))
+            else:
+                await self.send_on(
+                    websocket,
+                    presence_json(self.presences.get("LOCAL", {}).values(), self.presence_version())
+                )
+            for room in self.rooms.local_rooms():
+                await self.send_on(
+                    websocket,
+                    room_membership_json(
+                        room, sorted(self.rooms.local_members(room))
+                    )
+                )
+
+        # room members hosted by remote server, only accept its own clients
+        elif exchange_type == "room_membership":
+            room = exchange.get("room", "")
+            if not is_valid_room_name(room):
+                logger.warning(f"Invalid room name: {room}")
+                return
+            members = [
+                jid
+                for jid in exchange.get("members", [])
+                if jid.endswith(f"@{remote_server['name']}")
+            ]
+            self.rooms.set_server_members(remote_server["name"], room, members)
+            await self.chat_server.push_room_members(room)
+
+        # room message from remote member, forward to local room members
+        elif exchange_type == "room_message":
+            room = exchange.get("room", "")
+            exchange_from = exchange.get("from", None)
+            exchange_info = exchange.get("info", None)
+            room_servers = self.rooms.members.get(room, {})
+            if exchange_from not in room_servers.get(remote_server["name"], set()):
+                logger.warning(f"{exchange_from} is not a member of room {room}")
+                return
+            if not exchange_info:
+                logger.warning(f"Incorrect room message format: {exchange}")
+                return
+            await self.chat_server.deliver_room_message(
+                room, exchange_from, exchange_info
+            )
+
+        # if received presence, update corresponding server's presence
+        elif exchange_type == "presence":
+            presence_list = [
+                interned_presence(
+                    presence["nickname"], presence["jid"], presence["publickey"])
+                for presence in exchange.get("presence", [])
+            ]
+            await self.update_group_presence(
+                remote_server["name"], presence_list, exchange.get("version", None)
+            )
+            logger.debug(f"updated presence of {remote_server['name']}: {len(presence_list)} users")
+
+        # restored presences are confirmed by peer
+        elif exchange_type == "presence_current":
+            server_name = remote_server["name"]
+            if server_name not in self.stale_presences:
+                return
+            if exchange.get("version", None) == self.peer_versions.get(server_name, None):
+                self.stale_presences.discard(server_name)
+                logger.info(
+                    f"restored presence of {server_name} confirmed: "
+                    f"{len(self.presences.get(server_name, {}))} users"
+                )
+            else:
+                await self.send_on(websocket, attendance_json())
 
     def start_server(self) -> websockets.serve:
         """
@@ -489,50 +1129,297 @@ class ExchangeServer:
         remote_server_list = config.get("remote_servers", [])
         logger.debug(remote_server_list)
         logger.debug(config)
-        self.remote_servers = {
-            remote_server["name"]: remote_server for remote_server in remote_server_list
-        }
         self.server_name = config.get("server_name", "s4")
         exchange_server_config = config.get("exchange_server", {})
         host = exchange_server_config.get("host", "localhost")
         port = exchange_server_config.get("port", 5555)
-        return websockets.serve(self.exchange_handler, host, port)
+        self.configure(config)
+        for remote_server in remote_server_list:
+            self.add_remote_server(remote_server)
+        peer_state_config = peer_state_settings(config.get("peer_state", {}))
+        if peer_state_config is not None:
+            self.peer_state = PeerStateStore(**peer_state_config)
+            self.restore_peer_state(self.peer_state.load(self.server_name))
+            self.peer_state.start(self.server_name, self.peer_snapshot)
+        listener_tls = tls_settings(exchange_server_config.get("tls", {}))
+        unix_settings = unix_socket_settings(exchange_server_config)
+        if unix_settings is not None:
+            self.unix_listener = websockets.unix_serve(
+                self.exchange_handler, sock=bind_unix_socket(**unix_settings),
+                compression=None, extensions=server_extensions(self.compression),
+                **receive_limits(self.limits),
+            )
+            logger.info(f"Exchange server listening at {unix_settings['path']}")
+        return websockets.serve(
+            self.exchange_handler, host, port,
+            compression=None, extensions=server_extensions(self.compression),
+            ssl=server_ssl_context(listener_tls) if listener_tls is not None else None,
+            **receive_limits(self.limits),
+        )
+
+    def configure(self, config: dict):
+        """
+        Apply settings of config which may change while running, at start
+        and at reload. Listeners, compression and limits of frames apply to
+        connections made afterwards.
+        """
+        exchange_server_config = config.get("exchange_server", {})
+        self.exchange_server_config = exchange_server_config
+        # the budget is shared with chat server, which sets it at start
+        self.outbox_settings = {
+            **outbox_settings(config.get("outbound", {})),
+            "budget": self.outbox_settings.get("budget", None),
+        }
+        self.limits = limits_settings(config.get("limits", {}))
+        self.compression = compression_settings(exchange_server_config.get("compression", {}))
+        # ca_file and check_hostname also apply to peers with tls when the
+        # listener itself does not use TLS
+        tls = tls_settings({**exchange_server_config.get("tls", {}), "enabled": True})
+        if tls != self.tls:
+            # new verification settings for the next connections
+            self.tls = tls
+            self.tls_contexts = {}
+        # coalesce exchange json for peers advertising "batch"
+        self.batch_settings = {}
+        if exchange_server_config.get("batch_frames", True):
+            self.batch_settings = {
+                "batch_window": exchange_server_config.get("batch_window_us", 1000) / 1000000,
+                "max_batch_bytes": exchange_server_config.get("max_batch_bytes", 65536),
+            }
+        for outbox in self.outboxes.values():
+            outbox.update(**self.outbox_settings)
+            if outbox.batch is not None and self.batch_settings:
+                outbox.batch_window = self.batch_settings["batch_window"]
+                outbox.max_batch_bytes = self.batch_settings["max_batch_bytes"]
+        for link in self.links.values():
+            link.window = exchange_server_config.get("reliable_window", 64)
+            link.max_pending = exchange_server_config.get("reliable_max_pending", 4096)
+            link.ack_delay = exchange_server_config.get("ack_delay_ms", 20) / 1000
+
+    def add_remote_server(self, remote_server: dict):
+        """
+        Add remote server of config, connected by connect_remote_servers
+        at start or right away once running
+        """
+        remote_server = dict(remote_server)
+        server_name = remote_server["name"]
+        self.remote_servers[server_name] = remote_server
+        # acknowledged delivery, only used with peers advertising "reliable"
+        if self.exchange_server_config.get("reliable_delivery", True):
+            self.links[server_name] = self.create_link(server_name, self.exchange_server_config)
+        if self.connect_tasks is not None:
+            self.connect_tasks[server_name] = asyncio.ensure_future(self.connect_websocket(remote_server))
+
+    async def remove_remote_server(self, server_name: str):
+        """
+        Disconnect remote server removed from config, and forget its
+        presence and room members
+        """
+        remote_server = self.remote_servers.pop(server_name)
+        if self.connect_tasks is not None and server_name in self.connect_tasks:
+            task = self.connect_tasks.pop(server_name)
+            task.cancel()
+        link = self.links.pop(server_name, None)
+        if link is not None:
+            link.close()
+        self.tls_contexts.pop(server_name, None)
+        for key in ("request_websocket", "websocket"):
+            websocket = remote_server.get(key, None)
+            if websocket is not None:
+                await websocket.close()
+        await self.update_group_presence(server_name, [])
+        self.presences.pop(server_name, None)
+        self.peer_versions.pop(server_name, None)
+        self.peer_last_seen.pop(server_name, None)
+        for room in self.rooms.remove_server(server_name):
+            await self.chat_server.push_room_members(room)
+
+    async def reload(self, config: dict):
+        """
+        Apply changed config while running: remote servers added are
+        connected, removed ones disconnected, and those with a changed
+        address reconnected. Links to other servers are left as they are.
+
+        Returns:
+            (names of servers added, names of servers removed)
+        """
+        self.configure(config)
+        configured = {
+            remote_server["name"]: remote_server for remote_server in config.get("remote_servers", [])
+        }
+        removed = [
+            server_name
+            for server_name, remote_server in self.remote_servers.items()
+            if server_name not in configured
+            or any(remote_server.get(key) != configured[server_name].get(key) for key in PEER_ADDRESS_KEYS)
+        ]
+        for server_name in removed:
+            logger.info(f"removing remote server {server_name}")
+            await self.remove_remote_server(server_name)
+        added = [server_name for server_name in configured if server_name not in self.remote_servers]
+        for server_name in added:
+            logger.info(f"adding remote server {server_name}")
+            self.add_remote_server(configured[server_name])
+        return added, removed
+
+    def restore_peer_state(self, peers: dict):
+        """
+        Restore presences of configured remote servers from snapshot, as
+        stale until the peer confirms their version or stale_timeout
+        """
+        for server_name, peer in peers.items():
+            remote_server = self.remote_servers.get(server_name, None)
+            if remote_server is None:
+                continue
+            try:
+                presence_list = [
+                    interned_presence(nickname, jid, publickey)
+                    for nickname, jid, publickey in peer["presence"]
+                    if jid.endswith(f"@{server_name}")
+                ]
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"peer state of {server_name} is not valid")
+                continue
+            self.presences[sys.intern(server_name)] = {presence.jid: presence for presence in presence_list}
+            self.roster.replace([], presence_list)
+            self.peer_versions[server_name] = peer.get("version", None)
+            self.stale_presences.add(server_name)
+            if "last_seen" in peer:
+                self.peer_last_seen[server_name] = peer["last_seen"]
+            # messages to restored users wait in the reliable link until connected
+            remote_server.setdefault("features", peer.get("features", []))
+            logger.info(f"restored presence of {server_name}: {len(presence_list)} users")
+        if self.stale_presences:
+            asyncio.get_running_loop().call_later(
+                self.peer_state.stale_timeout, lambda: asyncio.ensure_future(self.expire_stale_presences())
+            )
+
+    async def expire_stale_presences(self):
+        """
+        Drop restored presences of remote servers which did not confirm them
+        """
+        for server_name in list(self.stale_presences):
+            logger.info(f"restored presence of {server_name} not confirmed, dropped")
+            await self.update_group_presence(server_name, [])
+
+    def peer_snapshot(self) -> dict:
+        """
+        Presences, presence version and features of remote servers for
+        peer state
+        """
+        peers = {}
+        for server_name, remote_server in self.remote_servers.items():
+            presences = self.presences.get(server_name, {})
+            if not presences:
+                continue
+            if self.get_remote_websocket(remote_server) is not None:
+                self.peer_last_seen[server_name] = time.time()
+            peers[server_name] = {
+                "version": self.peer_versions.get(server_name, None),
+                "features": list(remote_server.get("features", [])),
+                "last_seen": self.peer_last_seen.get(server_name, None),
+                "presence": [
+                    [presence.nickname, presence.jid, presence.publickey] for presence in presences.values()
+                ],
+            }
+        return peers
+
+    def hello_features(self, server_name: str) -> List[str]:
+        """
+        Features advertised to remote server, a peer without ReliableLink
+        would not be acknowledged and must not send sequenced messages
+        """
+        return [
+            feature for feature in FEATURES
+            if feature != "reliable" or server_name in self.links
+        ]
+
+    def tls_context(self, server_name: str):
+        """
+        Client context of peer, kept across reconnections so that they
+        resume the TLS session
+        """
+        if server_name not in self.tls_contexts:
+            self.tls_contexts[server_name] = client_ssl_context(self.tls or tls_settings({"enabled": True}))
+        return self.tls_contexts[server_name]
+
+    def create_link(self, server_name: str, exchange_server_config: dict) -> ReliableLink:
+        return ReliableLink(
+            server_name,
+            lambda data: self.send_raw(server_name, data),
+            window=exchange_server_config.get("reliable_window", 64),
+            max_pending=exchange_server_config.get("reliable_max_pending", 4096),
+            ack_delay=exchange_server_config.get("ack_delay_ms", 20) / 1000,
+        )
 
     async def connect_websocket(self, remote_server):
         """
         check connection to given remote server endpoint every 10 seconds.
-        If not connected, try to connect, else do nothing
+        If not connected, try to connect, else do nothing. Failed attempts
+        are retried after RECONNECT_INITIAL_DELAY, doubled up to
+        RECONNECT_MAX_DELAY.
         """
+        delay = RECONNECT_INITIAL_DELAY
         try:
             while True:
                 request_websocket = remote_server.get(
                     "request_websocket", None)
-                request_ws_url = f"ws://{remote_server['host']}:{remote_server['port']}"
-                # request_ws_url = f"wss://{remote_server['host']}"
+                unix_path = remote_server.get("unix_path", None)
+                tls_context = None
+                if unix_path:
+                    request_ws_url = f"ws+unix:{unix_path}"
+                elif remote_server.get("tls", False):
+                    request_ws_url = f"wss://{remote_server['host']}:{remote_server['port']}"
+                    tls_context = self.tls_context(remote_server["name"])
+                else:
+                    request_ws_url = f"ws://{remote_server['host']}:{remote_server['port']}"
                 if not request_websocket or request_websocket.closed:
+                    if unix_path:
+                        # peer on the same host, the host in the uri is not used
+                        connect = websockets.unix_connect(
+                            unix_path, "ws://localhost/",
+                            compression=None, extensions=client_extensions(self.compression),
+                            **receive_limits(self.limits),
+                        )
+                    else:
+                        connect = websockets.connect(
+                            request_ws_url,
+                            compression=None,
+                            extensions=client_extensions(self.compression),
+                            ssl=tls_context,
+                            **receive_limits(self.limits),
+                        )
                     try:
-                        async with websockets.connect(
-                            request_ws_url
-                        ) as request_websocket:
+                        async with connect as request_websocket:
+                            if tls_context is not None:
+                                # resumed by the next reconnection
+                                tls_context.remember(request_websocket)
                             self.remote_servers[remote_server["name"]][
                                 "request_websocket"
                             ] = request_websocket
                             logger.info(f"Connection to {request_ws_url} successfully, sending attendance")
-                            await request_websocket.send(attendance_json())
+                            await self.send_on(request_websocket, hello_json(self.server_name, self.hello_features(remote_server["name"])))
+                            # restored presences only need to be confirmed
+                            version = None
+                            if remote_server["name"] in self.stale_presences:
+                                version = self.peer_versions.get(remote_server["name"], None)
+                            await self.send_on(request_websocket, attendance_json(version))
+                            delay = RECONNECT_INITIAL_DELAY
                             await self.exchange_handler(
                                 request_websocket, remote_server["name"]
                             )
                     except websockets.WebSocketException as e:
                         self.reset_request_websocket(remote_server["name"])
                         logger.warning(f"Connection to {request_ws_url} failed: {e}")
-                    except ConnectionRefusedError as e:
+                    except (ConnectionRefusedError, FileNotFoundError, PermissionError, ssl.SSLError) as e:
                         self.reset_request_websocket(remote_server["name"])
                         logger.warning(f"Connection to {request_ws_url} failed: {e}")
                     except TimeoutError as e:
                         self.reset_request_websocket(remote_server["name"])
                         logger.warning(f"Connection timeout {request_ws_url} failed: {e}")
                     finally:
-                        await asyncio.sleep(10)
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, RECONNECT_MAX_DELAY)
                 else:
                     await asyncio.sleep(10)
         except asyncio.CancelledError:
@@ -540,9 +1427,12 @@ class ExchangeServer:
 
     def connect_remote_servers(self):
         """
-        Create tasks to proactively connect to remote servers
+        Create tasks to proactively connect to remote servers, servers
+        added by reload are connected by tasks created then
         """
-        tasks = []
+        self.connect_tasks = {}
         for remote_server in self.remote_servers.values():
-            tasks.append(self.connect_websocket(remote_server))
-        return tasks
+            self.connect_tasks[remote_server["name"]] = asyncio.ensure_future(
+                self.connect_websocket(remote_server)
+            )
+        return list(self.connect_tasks.values())
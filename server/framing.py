@@ -0,0 +1,466 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Framing of the client <-> chat server link.
+# The same file is used by server and client, keep both copies identical.
+
+import base64
+import binascii
+import json
+import struct
+from enum import IntEnum
+from typing import List, Sequence
+
+# websocket subprotocol offered by client, the server selects it if it
+# supports binary frames, otherwise both sides fall back to text commands
+BINARY_SUBPROTOCOL = "spchat.binary.v1"
+# binary frames, and the server may coalesce frames into BATCH frames
+BATCH_SUBPROTOCOL = "spchat.batch.v1"
+BINARY_SUBPROTOCOLS = (BATCH_SUBPROTOCOL, BINARY_SUBPROTOCOL)
+
+VERSION = 1
+
+# frame header: version, type, flags, number of fields
+HEADER = struct.Struct("!BBBH")
+# length prefix of each field
+FIELD_LENGTH = struct.Struct("!H")
+# length prefix of each frame in BATCH payload
+BATCH_LENGTH = struct.Struct("!I")
+
+# BROADCAST from a client of another server
+FLAG_REMOTE = 0x01
+# last field is the trace id of a sampled message, see tracing.py
+FLAG_TRACE = 0x02
+
+# first word of text commands carried by COMMAND frames
+COMMANDS = ("LIST", "COUNT", "SUBSCRIBE", "UNSUBSCRIBE", "JOIN", "LEAVE")
+
+# text protocol commands written as /<command in lower case>, so that chat
+# text starting with the same word is broadcast. Chat text starting with /
+# is escaped as //. LIST and FILE predate them and are written as is.
+COMMAND_PREFIX = "/"
+PREFIXED_COMMANDS = ("COUNT", "SUBSCRIBE", "UNSUBSCRIBE", "JOIN", "LEAVE", "MULTI", "MULTIFILE", "ROOM")
+
+
+class FrameType(IntEnum):
+    """
+    Frame types, with fields and payload from client / to client.
+    Ciphertext and keys are raw bytes, not base64.
+    """
+    # plain text line from server / payload: text
+    NOTICE = 1
+    # from client: () / to client: (sender,) ; payload: text
+    BROADCAST = 2
+    # from client: (target,) / to client: (sender, target) ; payload: ciphertext
+    DIRECT = 3
+    # from client: (jid, key, jid, key, ...) / to client: (sender, key) ; payload: ciphertext
+    MULTI = 4
+    # from client: (filename, jid, key, jid, key, ...) / to client: (sender, filename, key) ; payload: ciphertext
+    FILE = 5
+    # RSA encrypted file, from client: (target, filename) / to client: (sender, filename) ; payload: ciphertext
+    LEGACY_FILE = 6
+    # from client: (room,) ; payload: encrypted room message
+    ROOM = 7
+    # from client, payload: text command starting with one of COMMANDS
+    COMMAND = 8
+    # to client, payload: json text (presence, roster, room)
+    JSON = 9
+    # server internal file reference: (sender, filename, key, chunk_hash, ...)
+    FILE_REF = 10
+    # to client of BATCH_SUBPROTOCOL, payload: frames each prefixed by 4 byte length
+    BATCH = 11
+
+
+class Frame:
+    """
+    A typed frame of the client link.
+
+    Attributes:
+    - type: FrameType
+    - fields: sequence of bytes-like fields
+    - payload: bytes-like payload
+    - flags: bit flags, e.g. FLAG_REMOTE
+    - trace: trace id of a sampled message, None if not traced. It is
+      sent as last field with FLAG_TRACE, and is not in fields.
+
+    Assumptions:
+    - decoded fields and payload are memoryview slices of the received
+      data, nothing is copied until a field is converted to str
+    """
+    __slots__ = ("type", "fields", "payload", "flags", "trace", "_encoded", "_text")
+
+    def __init__(
+        self, frame_type: FrameType, fields: Sequence = (), payload=b"", flags: int = 0, trace=None
+    ):
+        self.type = frame_type
+        self.fields = fields
+        self.payload = payload
+        self.flags = flags
+        self.trace = trace
+        self._encoded = None
+        self._text = None
+
+    def field(self, index: int) -> str:
+        return str(self.fields[index], "utf-8")
+
+    def text(self) -> str:
+        return str(self.payload, "utf-8")
+
+    def encode(self) -> bytes:
+        """
+        Encode to binary frame, cached so that a frame sent to many clients
+        is encoded once
+        """
+        if self._encoded is None:
+            fields = self.fields
+            flags = self.flags & ~FLAG_TRACE
+            if self.trace is not None:
+                fields = list(fields) + [self.trace]
+                flags |= FLAG_TRACE
+            parts = [HEADER.pack(VERSION, self.type, flags, len(fields))]
+            for field in fields:
+                parts.append(FIELD_LENGTH.pack(len(field)))
+                parts.append(field)
+            parts.append(self.payload)
+            self._encoded = b"".join(parts)
+        return self._encoded
+
+    @classmethod
+    def decode(cls, data) -> "Frame":
+        """
+        Decode binary frame without copying fields and payload
+
+        Raises:
+            ValueError if the frame is malformed or of unsupported version
+        """
+        view = memoryview(data)
+        if len(view) < HEADER.size:
+            raise ValueError("frame too short")
+        version, frame_type, flags, field_count = HEADER.unpack_from(view, 0)
+        if version != VERSION:
+            raise ValueError(f"unsupported frame version {version}")
+        offset = HEADER.size
+        fields = []
+        for _ in range(field_count):
+            if offset + FIELD_LENGTH.size > len(view):
+                raise ValueError("frame too short")
+            (length,) = FIELD_LENGTH.unpack_from(view, offset)
+            offset += FIELD_LENGTH.size
+            if offset + length > len(view):
+                raise ValueError("frame too short")
+            fields.append(view[offset:offset + length])
+            offset += length
+        trace = None
+        if flags & FLAG_TRACE:
+            if not fields:
+                raise ValueError("trace field missing")
+            trace = bytes(fields.pop())
+            flags &= ~FLAG_TRACE
+        return cls(FrameType(frame_type), fields, view[offset:], flags, trace)
+
+
+def is_binary(subprotocol) -> bool:
+    return subprotocol in BINARY_SUBPROTOCOLS
+
+
+def batch_frames(frames_data: Sequence) -> bytes:
+    """
+    Pack encoded frames into one BATCH frame
+    """
+    parts = [HEADER.pack(VERSION, FrameType.BATCH, 0, 0)]
+    for data in frames_data:
+        parts.append(BATCH_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def split_batch(frame: Frame) -> List[Frame]:
+    """
+    Decode frames packed in BATCH frame without copying
+
+    Raises:
+        ValueError if a frame is malformed
+    """
+    view = memoryview(frame.payload)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if offset + BATCH_LENGTH.size > len(view):
+            raise ValueError("batch too short")
+        (length,) = BATCH_LENGTH.unpack_from(view, offset)
+        offset += BATCH_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("batch too short")
+        frames.append(Frame.decode(view[offset:offset + length]))
+        offset += length
+    return frames
+
+
+def text_field(value: str) -> bytes:
+    return value.encode("utf-8")
+
+
+def pairs_to_fields(keys: dict) -> List[bytes]:
+    """
+    Flatten { <jid>: <raw key> } into [jid, key, jid, key, ...]
+    """
+    fields = []
+    for jid, key in keys.items():
+        fields.append(text_field(jid))
+        fields.append(key)
+    return fields
+
+
+def fields_to_pairs(fields: Sequence) -> dict:
+    if len(fields) % 2:
+        raise ValueError("unpaired key field")
+    return {
+        str(fields[i], "utf-8"): fields[i + 1]
+        for i in range(0, len(fields), 2)
+    }
+
+
+def b64(data) -> str:
+    return base64.b64encode(data).decode("utf-8")
+
+
+def unb64(data: str, error: str) -> bytes:
+    """
+    Decode base64 of text protocol
+
+    Raises:
+        ValueError with given error if data is not base64
+    """
+    try:
+        return base64.b64decode(data, validate=True)
+    except binascii.Error:
+        raise ValueError(error)
+
+
+def notice_frame(text: str) -> Frame:
+    return Frame(FrameType.NOTICE, (), text_field(text))
+
+
+def json_frame(json_str: str) -> Frame:
+    return Frame(FrameType.JSON, (), text_field(json_str))
+
+
+# Text protocol from client to server
+
+def command_to_text(frame: Frame) -> str:
+    """
+    Render frame from client as legacy text command
+    """
+    if frame.type == FrameType.DIRECT:
+        return f"@{frame.field(0)} {b64(frame.payload)}"
+    if frame.type == FrameType.MULTI:
+        keys = fields_to_pairs(frame.fields)
+        return "/multi " + json.dumps(
+            {"keys": {jid: b64(key) for jid, key in keys.items()}, "info": b64(frame.payload)}
+        )
+    if frame.type == FrameType.FILE:
+        keys = fields_to_pairs(frame.fields[1:])
+        return "/multifile " + json.dumps(
+            {
+                "keys": {jid: b64(key) for jid, key in keys.items()},
+                "filename": frame.field(0),
+                "info": b64(frame.payload),
+            }
+        )
+    if frame.type == FrameType.LEGACY_FILE:
+        return f"FILE {frame.field(0)} {frame.field(1)} {b64(frame.payload)}"
+    if frame.type == FrameType.ROOM:
+        return f"/room {frame.field(0)} {frame.text()}"
+    text = frame.text()
+    if frame.type == FrameType.COMMAND:
+        command, _, arguments = text.partition(" ")
+        if command in PREFIXED_COMMANDS:
+            return f"{COMMAND_PREFIX}{command.lower()} {arguments}".rstrip(" ")
+    elif text.startswith(COMMAND_PREFIX):
+        return COMMAND_PREFIX + text
+    return text
+
+
+def parse_command(message: str) -> Frame:
+    """
+    Parse legacy text command from client
+
+    Expected format:
+        @<user>@<server_name> <message>
+        /multi {"keys": {<jid>: <wrapped_key>}, "info": <message>}
+        /multifile {"keys": {<jid>: <wrapped_key>}, "filename": <name>, "info": <filedata>}
+        FILE <user>@<server_name> <filename> <filedata>
+        /room <room> <payload>
+        LIST ...
+        /count|/subscribe|/unsubscribe|/join|/leave ...
+        //<message> as broadcast message starting with /
+        anything else as broadcast message
+
+    Raises:
+        ValueError with the reason if the command is malformed
+    """
+    if message.startswith("@"):
+        parts = message.split(" ", 1)
+        if len(parts) < 2:
+            raise ValueError("Invalid direct message")
+        return Frame(
+            FrameType.DIRECT,
+            (text_field(parts[0][1:]),),
+            unb64(parts[1], "Invalid direct message"),
+        )
+    if message.startswith(COMMAND_PREFIX * 2):
+        # escaped chat text
+        return Frame(FrameType.BROADCAST, (), text_field(message[len(COMMAND_PREFIX):]))
+    if message.startswith(COMMAND_PREFIX):
+        command, _, arguments = message[len(COMMAND_PREFIX):].partition(" ")
+        if command.upper() in PREFIXED_COMMANDS:
+            return parse_prefixed_command(command.upper(), arguments)
+        # unknown command, e.g. /shrug, is chat text
+        return Frame(FrameType.BROADCAST, (), text_field(message))
+    if message.startswith("FILE "):
+        parts = message.split(" ", 3)
+        if len(parts) < 4:
+            raise ValueError("Invalid FILE command")
+        _, target, file_name, file_data = parts
+        return Frame(
+            FrameType.LEGACY_FILE,
+            (text_field(target), text_field(file_name)),
+            unb64(file_data, "Invalid FILE command"),
+        )
+    if message.split(" ", 1)[0] == "LIST":
+        return Frame(FrameType.COMMAND, (), text_field(message))
+    return Frame(FrameType.BROADCAST, (), text_field(message))
+
+
+def parse_prefixed_command(command: str, arguments: str) -> Frame:
+    """
+    Parse text command of PREFIXED_COMMANDS, without its prefix
+
+    Raises:
+        ValueError with the reason if the command is malformed
+    """
+    if command in ("MULTI", "MULTIFILE"):
+        try:
+            content = json.loads(arguments)
+            keys = {jid: base64.b64decode(key, validate=True) for jid, key in content["keys"].items()}
+            info = base64.b64decode(content["info"], validate=True)
+            if command == "MULTI":
+                return Frame(FrameType.MULTI, pairs_to_fields(keys), info)
+            return Frame(
+                FrameType.FILE, [text_field(content["filename"])] + pairs_to_fields(keys), info
+            )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise ValueError(f"Invalid {command} command")
+    if command == "ROOM":
+        parts = arguments.split(" ", 1)
+        if len(parts) < 2:
+            raise ValueError("Invalid ROOM command")
+        return Frame(FrameType.ROOM, (text_field(parts[0]),), text_field(parts[1]))
+    return Frame(FrameType.COMMAND, (), text_field(f"{command} {arguments}".rstrip(" ")))
+
+
+# Text protocol from server to client
+
+def frame_to_text(frame: Frame) -> str:
+    """
+    Render frame to client as legacy text, cached so that a frame sent to
+    many clients is rendered once
+    """
+    if frame._text is not None:
+        return frame._text
+    if frame.type == FrameType.BROADCAST:
+        if frame.flags & FLAG_REMOTE:
+            text = f"BROADCAST from {frame.field(0)}: {frame.text()}"
+        else:
+            text = f"{frame.field(0)}: {frame.text()}"
+    elif frame.type == FrameType.DIRECT:
+        text = f"@{frame.field(0)} to {frame.field(1)}: {b64(frame.payload)}"
+    elif frame.type == FrameType.MULTI:
+        text = json.dumps(
+            {
+                "tag": "multi_message",
+                "from": frame.field(0),
+                "key": b64(frame.fields[1]),
+                "info": b64(frame.payload),
+            }
+        )
+    elif frame.type == FrameType.FILE:
+        text = json.dumps(
+            {
+                "tag": "multi_file",
+                "from": frame.field(0),
+                "filename": frame.field(1),
+                "key": b64(frame.fields[2]),
+                "info": b64(frame.payload),
+            }
+        )
+    elif frame.type == FrameType.LEGACY_FILE:
+        text = f"FILE {frame.field(0)} {b64(frame.payload)} {frame.field(1)}"
+    else:
+        text = frame.text()
+    frame._text = text
+    return text
+
+
+def parse_server_text(message: str) -> Frame:
+    """
+    Parse legacy text from server
+
+    Raises:
+        ValueError if the message is malformed
+    """
+    if message.startswith("FILE "):
+        parts = message.split(" ", 3)
+        if len(parts) < 4:
+            raise ValueError("Incorrect FILE message format")
+        _, sender, file_data, file_name = parts
+        return Frame(
+            FrameType.LEGACY_FILE,
+            (text_field(sender), text_field(file_name)),
+            unb64(file_data, "Incorrect FILE message format"),
+        )
+    if message.startswith("{"):
+        content = json.loads(message)
+        tag = content.get("tag", None)
+        if tag == "multi_message":
+            return Frame(
+                FrameType.MULTI,
+                (text_field(content["from"]), base64.b64decode(content["key"])),
+                base64.b64decode(content["info"]),
+            )
+        if tag == "multi_file":
+            return Frame(
+                FrameType.FILE,
+                (
+                    text_field(content["from"]),
+                    text_field(content["filename"]),
+                    base64.b64decode(content["key"]),
+                ),
+                base64.b64decode(content["info"]),
+            )
+        return json_frame(message)
+    msg_split = message.split(": ", 1)
+    if len(msg_split) < 2:
+        return notice_frame(message)
+    sender, text = msg_split
+    if sender.startswith("@") and " to " in sender:
+        sender, target = sender[1:].split(" to ", 1)
+        return Frame(
+            FrameType.DIRECT,
+            (text_field(sender), text_field(target)),
+            unb64(text, "Incorrect message format"),
+        )
+    if sender.startswith("BROADCAST from "):
+        return Frame(
+            FrameType.BROADCAST,
+            (text_field(sender[len("BROADCAST from "):]),),
+            text_field(text),
+            FLAG_REMOTE,
+        )
+    return Frame(FrameType.BROADCAST, (text_field(sender),), text_field(text))
@@ -0,0 +1,383 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict, deque
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# record header: crc32, type, timestamp, recipient length, payload length
+RECORD_HEADER = struct.Struct("!IBdHI")
+
+# record holding a message for recipient
+RECORD_MESSAGE = 1
+# record marking messages of recipient up to a position as delivered
+RECORD_CONSUMED = 2
+
+# payload of RECORD_CONSUMED: segment id and offset of last delivered message
+POSITION = struct.Struct("!IQ")
+
+SEGMENT_SUFFIX = ".seg"
+
+# seconds between retention checks after commits
+RETENTION_INTERVAL = 60
+
+
+def encode_record(record_type: int, timestamp: float, recipient: str, payload: bytes) -> bytes:
+    recipient_bytes = recipient.encode("utf-8")
+    body = RECORD_HEADER.pack(0, record_type, timestamp, len(recipient_bytes), len(payload))[4:]
+    crc = zlib.crc32(payload, zlib.crc32(recipient_bytes, zlib.crc32(body)))
+    return b"".join([struct.pack("!I", crc), body, recipient_bytes, payload])
+
+
+def decode_record(buffer, offset: int):
+    """
+    Decode record at offset of buffer.
+
+    Returns:
+        (record_type, timestamp, recipient, payload memoryview, next_offset)
+        or None if the record is incomplete or corrupted
+    """
+    if offset + RECORD_HEADER.size > len(buffer):
+        return None
+    crc, record_type, timestamp, recipient_length, payload_length = RECORD_HEADER.unpack_from(buffer, offset)
+    recipient_start = offset + RECORD_HEADER.size
+    payload_start = recipient_start + recipient_length
+    next_offset = payload_start + payload_length
+    if next_offset > len(buffer):
+        return None
+    view = memoryview(buffer)
+    if zlib.crc32(view[offset + 4:next_offset]) != crc:
+        return None
+    recipient = bytes(view[recipient_start:payload_start]).decode("utf-8")
+    return record_type, timestamp, recipient, view[payload_start:next_offset], next_offset
+
+
+class MessageJournal:
+    """
+    MessageJournal durably queues messages for offline recipients in
+    append-only segment files, and replays them in order when the recipient
+    comes back.
+
+    Appends are collected for commit_interval and written with a single
+    write and fsync (group commit). Replay reads the referenced segments
+    through mmap in file order.
+
+    Attributes:
+    - directory: directory of segment files, named <segment_id>.seg
+    - segments: OrderedDict of segment size with format:
+        { <segment_id>: size }
+    - index: dict of undelivered messages with format:
+        { <recipient>: deque([(segment_id, offset, timestamp), ...]) }
+    - batch: list of records waiting for group commit
+    - on_drop: called with each message dropped undelivered by retention,
+      None if not needed
+
+    Assumptions:
+    - records are never modified, delivered messages are released by a
+      RECORD_CONSUMED record and their segment is deleted once no earlier
+      segment holds undelivered messages
+    """
+
+    def __init__(
+        self,
+        directory: str = "journal",
+        segment_bytes: int = 16 * 1024 * 1024,
+        max_total_bytes: int = 256 * 1024 * 1024,
+        max_age: float = 7 * 24 * 3600,
+        max_messages_per_user: int = 1000,
+        commit_interval: float = 0.005,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_total_bytes = max_total_bytes
+        self.max_age = max_age
+        self.max_messages_per_user = max_messages_per_user
+        self.commit_interval = commit_interval
+        self.segments = OrderedDict()
+        self.index = {}
+        self.batch = []
+        self.flush_task = None
+        self.active_file = None
+        self.last_retention = 0
+        self.on_drop = None
+
+    def open(self):
+        """
+        Rebuild index by scanning every segment, then open the last segment
+        for appending
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        segment_ids = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for segment_id in segment_ids:
+            self.segments[segment_id] = self._scan_segment(segment_id)
+        if not self.segments:
+            self.segments[1] = 0
+        self.active_file = open(self._segment_path(self.active_id), "ab")
+        self.enforce_retention()
+        logger.info(f"journal opened with {self.pending_total()} undelivered messages")
+
+    def close(self):
+        if self.active_file:
+            self.active_file.close()
+            self.active_file = None
+
+    @property
+    def active_id(self) -> int:
+        return next(reversed(self.segments))
+
+    def pending_count(self, recipient: str) -> int:
+        return len(self.index.get(recipient, ()))
+
+    def pending_total(self) -> int:
+        return sum(len(entries) for entries in self.index.values())
+
+    async def append(self, recipient: str, payload: bytes) -> bool:
+        """
+        Durably queue message for recipient.
+
+        Returns:
+            True once the message is written and synced to disk
+        """
+        return await self._commit(RECORD_MESSAGE, recipient, payload)
+
+    def pending_messages(self) -> List[bytes]:
+        """
+        Return undelivered messages of every recipient, read at start
+        """
+        entries = [entry for entries in self.index.values() for entry in entries]
+        return [message for _, message in self._read_entries(entries)]
+
+    async def read(self, recipient: str) -> List[Tuple[tuple, bytes]]:
+        """
+        Return undelivered messages of recipient in order, as list of
+        (position, message)
+        """
+        entries = list(self.index.get(recipient, ()))
+        if not entries:
+            return []
+        return await asyncio.to_thread(self._read_entries, entries)
+
+    async def consume(self, recipient: str, position: tuple):
+        """
+        Mark messages of recipient up to position (returned by read) as
+        delivered
+        """
+        if await self._commit(RECORD_CONSUMED, recipient, POSITION.pack(*position)):
+            self._release(recipient, position)
+
+    def _release(self, recipient: str, position: tuple):
+        entries = self.index.get(recipient, deque())
+        while entries and entries[0][:2] <= tuple(position):
+            entries.popleft()
+        if not entries:
+            self.index.pop(recipient, None)
+
+    async def _commit(self, record_type: int, recipient: str, payload: bytes) -> bool:
+        future = asyncio.get_running_loop().create_future()
+        timestamp = time.time()
+        self.batch.append(
+            (encode_record(record_type, timestamp, recipient, payload), record_type, timestamp, recipient, future)
+        )
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
+        """
+        Write every batched record with one write and one fsync, records
+        appended during the write are committed by the next round
+        """
+        try:
+            await asyncio.sleep(self.commit_interval)
+            while self.batch:
+                batch, self.batch = self.batch, []
+                data = b"".join(record for record, *_ in batch)
+                try:
+                    if self.segments[self.active_id] >= self.segment_bytes:
+                        self._roll_segment()
+                    segment_id = self.active_id
+                    offset = self.segments[segment_id]
+                    await asyncio.to_thread(self._write, self.active_file, data)
+                except OSError as e:
+                    logger.error(f"unable to write journal: {e}")
+                    self._resolve(batch, False)
+                    continue
+                self.segments[segment_id] = offset + len(data)
+                dropped = []
+                for record, record_type, timestamp, recipient, future in batch:
+                    if record_type == RECORD_MESSAGE:
+                        dropped += self._index_message(recipient, segment_id, offset, timestamp)
+                    offset += len(record)
+                try:
+                    if dropped and self.on_drop is not None:
+                        for _, message in await asyncio.to_thread(self._read_entries, dropped):
+                            self.on_drop(message)
+                except Exception as e:
+                    logger.error(f"unable to pass dropped journal messages: {e}")
+                finally:
+                    self._resolve(batch, True)
+            if time.monotonic() - self.last_retention > RETENTION_INTERVAL:
+                self.enforce_retention()
+        finally:
+            self.flush_task = None
+            if self.batch:
+                # records appended while the flush failed
+                self.flush_task = asyncio.ensure_future(self._flush())
+
+    @staticmethod
+    def _resolve(batch: list, result: bool):
+        """
+        Set result of every record of batch, appenders cancelled meanwhile
+        are skipped
+        """
+        for *_, future in batch:
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _write(file, data: bytes):
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+    def _index_message(self, recipient: str, segment_id: int, offset: int, timestamp: float) -> list:
+        """
+        Index message, return entries dropped beyond the per user limit
+        """
+        entries = self.index.setdefault(recipient, deque())
+        entries.append((segment_id, offset, timestamp))
+        dropped = []
+        # drop the oldest message beyond the per user limit
+        while len(entries) > self.max_messages_per_user:
+            dropped.append(entries.popleft())
+        return dropped
+
+    def _roll_segment(self):
+        self.active_file.close()
+        segment_id = self.active_id + 1
+        self.segments[segment_id] = 0
+        self.active_file = open(self._segment_path(segment_id), "ab")
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.directory, f"{segment_id:08d}{SEGMENT_SUFFIX}")
+
+    def _scan_segment(self, segment_id: int) -> int:
+        """
+        Index records of segment in order, truncating an incomplete tail
+
+        Returns:
+            size of valid records in segment
+        """
+        path = self._segment_path(segment_id)
+        size = os.path.getsize(path)
+        if size == 0:
+            return 0
+        offset = 0
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            while offset < size:
+                record = decode_record(buffer, offset)
+                if record is None:
+                    break
+                record_type, timestamp, recipient, payload, next_offset = record
+                if record_type == RECORD_MESSAGE:
+                    self._index_message(recipient, segment_id, offset, timestamp)
+                elif record_type == RECORD_CONSUMED:
+                    self._release(recipient, POSITION.unpack(payload))
+                payload.release()
+                offset = next_offset
+        if offset < size:
+            logger.warning(f"truncating incomplete journal record in {path} at {offset}")
+            with open(path, "r+b") as file:
+                file.truncate(offset)
+        return offset
+
+    def _read_entries(self, entries: list) -> List[Tuple[tuple, bytes]]:
+        """
+        Read entries segment by segment, in increasing offset order
+        """
+        messages = []
+        entries_by_segment = OrderedDict()
+        for segment_id, offset, _ in entries:
+            entries_by_segment.setdefault(segment_id, []).append(offset)
+        for segment_id, offsets in entries_by_segment.items():
+            with open(self._segment_path(segment_id), "rb") as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for offset in offsets:
+                    record = decode_record(buffer, offset)
+                    if record is None:
+                        logger.error(f"corrupted journal record at {segment_id}:{offset}")
+                        continue
+                    payload = record[3]
+                    messages.append(((segment_id, offset), bytes(payload)))
+                    payload.release()
+        return messages
+
+    def enforce_retention(self):
+        """
+        Drop messages older than max_age, then delete segments from the
+        oldest one while they hold no undelivered message or the journal
+        exceeds max_total_bytes
+        """
+        self.last_retention = time.monotonic()
+        expire_before = time.time() - self.max_age
+        dropped = []
+        for recipient in list(self.index):
+            entries = self.index[recipient]
+            while entries and entries[0][2] < expire_before:
+                dropped.append(entries.popleft())
+            if not entries:
+                del self.index[recipient]
+        self._notify_dropped(dropped)
+
+        live_segments = {
+            segment_id for entries in self.index.values() for segment_id, _, _ in entries
+        }
+        total_bytes = sum(self.segments.values())
+        while len(self.segments) > 1:
+            segment_id = next(iter(self.segments))
+            if segment_id in live_segments and total_bytes <= self.max_total_bytes:
+                break
+            if segment_id in live_segments:
+                logger.warning(f"journal exceeds {self.max_total_bytes} bytes, dropping segment {segment_id}")
+                self._notify_dropped(self._drop_segment_entries(segment_id))
+            total_bytes -= self.segments.pop(segment_id)
+            os.remove(self._segment_path(segment_id))
+
+    def _notify_dropped(self, entries: list):
+        """
+        Pass dropped messages to on_drop, before their segment is deleted
+        """
+        if entries and self.on_drop is not None:
+            for _, message in self._read_entries(entries):
+                self.on_drop(message)
+
+    def _drop_segment_entries(self, segment_id: int) -> list:
+        dropped = []
+        for recipient in list(self.index):
+            entries = deque()
+            for entry in self.index[recipient]:
+                (dropped if entry[0] == segment_id else entries).append(entry)
+            if entries:
+                self.index[recipient] = entries
+            else:
+                del self.index[recipient]
+        return dropped
@@ -0,0 +1,181 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Limits on connections and buffered bytes, and shedding of low priority
+# work when the server falls behind, so that direct messages keep their
+# latency under load.
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from traffic import LANE_FILE, MemoryBudget
+
+logger = logging.getLogger(__name__)
+
+# all work admitted
+LEVEL_NORMAL = 0
+# new file relays refused
+LEVEL_SHED_FILES = 1
+# broadcasts also refused, from clients and from peers
+LEVEL_SHED_BROADCASTS = 2
+
+LEVEL_NAMES = ("normal", "shedding files", "shedding files and broadcasts")
+
+# work refused from the given level on
+SHED_LEVELS = {
+    "file": LEVEL_SHED_FILES,
+    "broadcast": LEVEL_SHED_BROADCASTS,
+}
+
+
+def limits_settings(limits_config: dict) -> dict:
+    """
+    Connection and memory limits from limits section of config
+    """
+    return {
+        "max_connections": limits_config.get("max_connections", 5000),
+        "max_frame_bytes": limits_config.get("max_frame_bytes", 1024 * 1024),
+        "receive_queue_frames": limits_config.get("receive_queue_frames", 8),
+        "max_file_bytes": limits_config.get("max_file_bytes", 256 * 1024 * 1024),
+        "max_outbound_bytes": limits_config.get("max_outbound_bytes", 1024 * 1024 * 1024),
+    }
+
+
+def receive_limits(limits: dict) -> dict:
+    """
+    Arguments of websockets.serve and connect bounding the frames read
+    ahead of each connection to max_frame_bytes * receive_queue_frames
+    """
+    return {"max_size": limits["max_frame_bytes"], "max_queue": limits["receive_queue_frames"]}
+
+
+def overload_settings(overload_config: dict) -> Optional[dict]:
+    """
+    OverloadController arguments from overload section of config, None if
+    disabled
+    """
+    if not overload_config.get("enabled", True):
+        return None
+    return {
+        "interval": overload_config.get("interval_ms", 100) / 1000,
+        "max_loop_lag": overload_config.get("max_loop_lag_ms", 100) / 1000,
+        "max_rss_bytes": overload_config.get("max_rss_bytes", 0),
+        "recover_ratio": overload_config.get("recover_ratio", 0.5),
+    }
+
+
+def resident_bytes() -> Optional[int]:
+    """
+    Resident memory of the process, None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class OverloadController:
+    """
+    OverloadController samples event loop lag, resident memory and bytes
+    waiting in outboxes, and sets the level of work refused. Pressure is the
+    largest ratio of a sample to its limit: files are shed from pressure 1,
+    broadcasts as well from pressure 2. A level is left once pressure falls
+    below recover_ratio of the level entry, so that it does not flap.
+
+    Attributes:
+    - budget: MemoryBudget of outboxes of clients and peers
+    - level: LEVEL_* of work currently refused
+    - pressure: pressure of last sample
+    - loop_lag: seconds the last sample woke up late
+    - rss_bytes: resident memory at last sample, None if not known
+    - shed: count of refused work per kind, in format { <kind>: count }
+
+    Assumptions:
+    - limits of 0 are not checked
+    - direct messages, presence and control traffic are never shed
+    """
+
+    def __init__(
+        self,
+        budget: MemoryBudget,
+        max_file_bytes: int = 256 * 1024 * 1024,
+        max_outbound_bytes: int = 1024 * 1024 * 1024,
+        interval: float = 0.1,
+        max_loop_lag: float = 0.1,
+        max_rss_bytes: int = 0,
+        recover_ratio: float = 0.5,
+    ):
+        self.budget = budget
+        self.max_file_bytes = max_file_bytes
+        self.max_outbound_bytes = max_outbound_bytes
+        self.interval = interval
+        self.max_loop_lag = max_loop_lag
+        self.max_rss_bytes = max_rss_bytes
+        self.recover_ratio = recover_ratio
+        self.level = LEVEL_NORMAL
+        self.pressure = 0.0
+        self.loop_lag = 0.0
+        self.rss_bytes = None
+        self.shed = {kind: 0 for kind in SHED_LEVELS}
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.sample(time.perf_counter() - start - self.interval, resident_bytes())
+
+    def sample(self, loop_lag: float, rss_bytes: Optional[int]):
+        self.loop_lag = loop_lag
+        self.rss_bytes = rss_bytes
+        ratios = [0.0]
+        if self.max_loop_lag > 0:
+            ratios.append(loop_lag / self.max_loop_lag)
+        if self.max_rss_bytes > 0 and rss_bytes is not None:
+            ratios.append(rss_bytes / self.max_rss_bytes)
+        if self.max_outbound_bytes > 0:
+            ratios.append(self.budget.total_bytes / self.max_outbound_bytes)
+        self.pressure = max(ratios)
+        level = max(self.level, min(LEVEL_SHED_BROADCASTS, int(self.pressure)))
+        # one level at a time, each once recovered
+        while level > LEVEL_NORMAL and self.pressure < level * self.recover_ratio:
+            level -= 1
+        if level != self.level:
+            log = logger.warning if level > self.level else logger.info
+            log(
+                f"overload {LEVEL_NAMES[level]}: pressure {self.pressure:.2f}, loop lag "
+                f"{loop_lag * 1000:.0f}ms, outbound {self.budget.total_bytes} bytes, rss {rss_bytes}"
+            )
+            self.level = level
+
+    def admit(self, kind: str, size: int = 0) -> bool:
+        """
+        Return if work of kind, with size bytes of file data, is accepted.
+        Files are also refused while the file bytes waiting in outboxes
+        would exceed max_file_bytes.
+        """
+        admitted = self.level < SHED_LEVELS[kind]
+        if admitted and kind == "file" and self.max_file_bytes > 0:
+            admitted = self.budget.lane_bytes[LANE_FILE] + size <= self.max_file_bytes
+        if not admitted:
+            self.shed[kind] += 1
+        return admitted
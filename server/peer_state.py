@@ -0,0 +1,177 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Snapshot of remote presences and peer link metadata, so that a restarted
+# server knows the federation roster before its peers answer. Restored
+# presences are provisional until the peer confirms their version.
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# format of snapshot file, snapshots of other formats are not restored
+SNAPSHOT_FORMAT = 1
+
+
+def peer_state_settings(peer_state_config: dict) -> Optional[dict]:
+    """
+    PeerStateStore arguments from peer_state section of config, None if
+    disabled
+    """
+    if not peer_state_config.get("enabled", True):
+        return None
+    return {
+        "path": peer_state_config.get("path", "state/peers.json"),
+        "interval": peer_state_config.get("snapshot_interval_s", 30),
+        "max_age": peer_state_config.get("max_age_s", 3600),
+        "stale_timeout": peer_state_config.get("stale_timeout_s", 30),
+    }
+
+
+def peer_versions(peers: dict) -> dict:
+    """
+    State of each peer compared between snapshots, its presences stand for
+    the version of a peer announcing none
+    """
+    return {
+        server_name: (
+            peer.get("version", None),
+            peer.get("features", []),
+            None if peer.get("version", None) else peer.get("presence", []),
+        )
+        for server_name, peer in peers.items()
+    }
+
+
+class PeerStateStore:
+    """
+    PeerStateStore writes a snapshot of peer state every interval and at
+    exit, and reads the last one at start. The snapshot is in format
+        { format, server_name, saved, peers: { <server_name>: {
+            version, features, last_seen, presence: [[nickname, jid, publickey]] } } }
+    where version is the presence version announced by the peer.
+
+    Attributes:
+    - path: snapshot file
+    - interval: seconds between snapshots
+    - max_age: seconds after which a snapshot is too old to restore
+    - stale_timeout: seconds restored presences are kept without the peer
+      confirming them
+    - saves: snapshots written
+    - saved_versions: peer_versions of the last snapshot written
+
+    Assumptions:
+    - a snapshot is taken on the event loop and written from a worker
+      thread, it is skipped while no peer version changed, unless the last
+      one is half of max_age old
+    - a snapshot is written to a temporary file and renamed, so that a
+      crash while writing leaves the previous snapshot
+    - the snapshot holds public keys only, which peers announce to every
+      server anyway
+    """
+
+    def __init__(self, path: str, interval: float = 30, max_age: float = 3600, stale_timeout: float = 30):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.stale_timeout = stale_timeout
+        self.saves = 0
+        self.saved_versions = None
+        self.saved = 0
+        self.server_name = None
+        self.snapshot = None
+        self.task = None
+
+    def load(self, server_name: str) -> dict:
+        """
+        Peers of the last snapshot of server_name, empty if there is none,
+        it cannot be read or it is older than max_age
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"peer state {self.path} not restored: {e}")
+            return {}
+        if not isinstance(state, dict) or state.get("format", None) != SNAPSHOT_FORMAT:
+            logger.warning(f"peer state {self.path} not restored: unknown format")
+            return {}
+        if state.get("server_name", None) != server_name:
+            logger.warning(f"peer state {self.path} is of server {state.get('server_name', None)}")
+            return {}
+        age = time.time() - state.get("saved", 0)
+        if age > self.max_age:
+            logger.info(f"peer state {self.path} not restored, saved {age:.0f}s ago")
+            return {}
+        return state.get("peers", {})
+
+    def save(self, server_name: str, peers: dict):
+        state = {"format": SNAPSHOT_FORMAT, "server_name": server_name, "saved": time.time(), "peers": peers}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temporary_path, self.path)
+        self.saved_versions = peer_versions(peers)
+        self.saved = state["saved"]
+        self.saves += 1
+
+    def start(self, server_name: str, snapshot: Callable[[], dict]):
+        """
+        Save snapshot() every interval and at exit
+        """
+        self.server_name = server_name
+        self.snapshot = snapshot
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        atexit.register(self.close)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def close(self):
+        """
+        Save last snapshot, at exit the event loop may already be closed
+        """
+        if self.snapshot is not None:
+            try:
+                self.save(self.server_name, self.snapshot())
+            except OSError as e:
+                logger.error(f"unable to save peer state: {e}")
+            self.snapshot = None
+
+    def changed(self, peers: dict) -> bool:
+        """
+        Return if peers differ from the last snapshot, or it is old enough
+        to be refreshed before it expires
+        """
+        return peer_versions(peers) != self.saved_versions or time.time() - self.saved > self.max_age / 2
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            peers = self.snapshot()
+            if not self.changed(peers):
+                continue
+            try:
+                await asyncio.to_thread(self.save, self.server_name, peers)
+            except OSError as e:
+                logger.error(f"unable to save peer state: {e}")
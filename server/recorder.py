@@ -0,0 +1,311 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Trace of frames through ChatServer and ExchangeServer, replayed by
+# replay.py for capacity testing. Only metadata is recorded, replay sends
+# random bytes of the recorded size in place of payloads.
+
+import atexit
+import logging
+import os
+import struct
+import time
+import weakref
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from framing import COMMANDS, Frame, FrameType
+
+logger = logging.getLogger(__name__)
+
+TRACE_MAGIC = b"SPTRACE1"
+# trace header: magic, wall clock microseconds at start of recording
+TRACE_HEADER = struct.Struct("!8sQ")
+# record: microseconds since start, event, link, kind, detail, size,
+# sender id, recipient id
+TRACE_RECORD = struct.Struct("!QBBBBIII")
+
+# frame received
+EVENT_IN = 0
+# frame queued for sending
+EVENT_OUT = 1
+# client authenticated or peer identified, sender is its id
+EVENT_OPEN = 2
+# connection of sender closed
+EVENT_CLOSE = 3
+# first use of an id: kind is ID_*, sender is the id, recipient is the
+# server id of a remote user
+EVENT_DEFINE = 4
+
+LINK_CLIENT = 0
+LINK_PEER = 1
+
+ID_LOCAL_USER = 0
+ID_REMOTE_USER = 1
+ID_SERVER = 2
+ID_ROOM = 3
+
+# kind of records of the client link is FrameType, of the peer link the
+# index of the exchange json tag, 0 for unknown tags
+EXCHANGE_TAGS = (
+    "", "message", "multi_message", "file", "file_ref", "blob_want", "blob", "check", "checked",
+    "presence", "room_membership", "room_message", "hello", "attendance", "ack", "batch",
+)
+EXCHANGE_KINDS = {tag: kind for kind, tag in enumerate(EXCHANGE_TAGS) if tag}
+
+# detail of message on peer link sent to all clients
+DETAIL_PUBLIC = 1
+# detail of COMMAND frame not starting with one of COMMANDS
+DETAIL_UNKNOWN_COMMAND = 255
+
+# frames to client with jid of sender as first field
+SENDER_FRAME_TYPES = (
+    FrameType.BROADCAST, FrameType.DIRECT, FrameType.MULTI, FrameType.FILE,
+    FrameType.LEGACY_FILE, FrameType.FILE_REF,
+)
+
+
+def recorder_settings(recorder_config: dict) -> Optional[dict]:
+    """
+    TrafficRecorder arguments from recorder section of config, None if
+    recording is disabled
+    """
+    if not recorder_config.get("enabled", False):
+        return None
+    return {
+        "path": time.strftime(recorder_config.get("path", "traces/%Y%m%d-%H%M%S.trace")),
+        "max_bytes": recorder_config.get("max_bytes", 256 * 1024 * 1024),
+    }
+
+
+class TraceRecord(NamedTuple):
+    time: float
+    event: int
+    link: int
+    kind: int
+    detail: int
+    size: int
+    sender: int
+    recipient: int
+
+
+class Trace(NamedTuple):
+    """
+    Trace read from file
+
+    Attributes:
+    - started: wall clock seconds at start of recording
+    - ids: kind of each id with format:
+        { <id>: (ID_*, server id of remote user) }
+    - records: TraceRecord in order of time, without EVENT_DEFINE
+    """
+    started: float
+    ids: Dict[int, Tuple[int, int]]
+    records: List[TraceRecord]
+
+
+def read_trace(path: str) -> Trace:
+    """
+    Read trace written by TrafficRecorder, a partly written last record is
+    ignored
+
+    Raises:
+        ValueError if the file is not a trace
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(f"{path} is not a trace")
+    magic, started = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError(f"{path} is not a trace")
+    ids = {}
+    records = []
+    end = len(data) - (len(data) - TRACE_HEADER.size) % TRACE_RECORD.size
+    for values in TRACE_RECORD.iter_unpack(data[TRACE_HEADER.size:end]):
+        record = TraceRecord(values[0] / 1e6, *values[1:])
+        if record.event == EVENT_DEFINE:
+            ids[record.sender] = (record.kind, record.recipient)
+        else:
+            records.append(record)
+    return Trace(started / 1e6, ids, records)
+
+
+class TrafficRecorder:
+    """
+    TrafficRecorder appends fixed size records of frames received and sent
+    on client and peer links to a trace file. Users, servers and rooms are
+    replaced by ids, defined at first use by their kind only, so that the
+    trace holds no names, text or ciphertext.
+
+    Attributes:
+    - ids: id of each name with format:
+        { (ID_*, name): id }
+    - connections: id of user or server of each websocket
+    - buffer: records not yet written
+    - written_bytes: bytes written to trace file
+
+    Assumptions:
+    - records are written once flush_bytes are buffered or flush_interval
+      passed since the last write, and at exit
+    - recording stops once the trace reaches max_bytes
+    - frame sizes are of the encoded frame or json, without websocket
+      framing and compression
+    """
+
+    def __init__(
+        self,
+        path: str,
+        server_name: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        flush_bytes: int = 64 * 1024,
+        flush_interval: float = 1.0,
+    ):
+        self.path = path
+        self.server_name = server_name
+        self.max_bytes = max_bytes
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.ids = {}
+        self.connections = weakref.WeakKeyDictionary()
+        self.buffer = bytearray()
+        self.written_bytes = 0
+        self.flushed = time.monotonic()
+        self.started = time.monotonic_ns() // 1000
+        self.file = None
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "wb")
+        self.buffer += TRACE_HEADER.pack(TRACE_MAGIC, time.time_ns() // 1000)
+        atexit.register(self.close)
+        logger.info(f"recording traffic to {self.path}")
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def flush(self):
+        if self.buffer and self.file is not None:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.written_bytes += len(self.buffer)
+        self.buffer = bytearray()
+        self.flushed = time.monotonic()
+
+    def record(
+        self, event: int, link: int, kind: int, size: int,
+        sender: int = 0, recipient: int = 0, detail: int = 0,
+    ):
+        if self.file is None:
+            return
+        timestamp = time.monotonic_ns() // 1000 - self.started
+        self.buffer += TRACE_RECORD.pack(timestamp, event, link, kind, detail, size, sender, recipient)
+        if len(self.buffer) >= self.flush_bytes or time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+            if self.written_bytes >= self.max_bytes:
+                logger.warning(f"trace {self.path} reached {self.max_bytes} bytes, recording stopped")
+                self.close()
+
+    def name_id(self, id_kind: int, name: str, server: int = 0) -> int:
+        key = (id_kind, name)
+        name_id = self.ids.get(key, None)
+        if name_id is None:
+            # 0 stands for no sender or recipient
+            name_id = self.ids[key] = len(self.ids) + 1
+            self.record(EVENT_DEFINE, 0, id_kind, 0, name_id, server)
+        return name_id
+
+    def server_id(self, server_name: str) -> int:
+        return self.name_id(ID_SERVER, server_name)
+
+    def room_id(self, room: str) -> int:
+        return self.name_id(ID_ROOM, room)
+
+    def user_id(self, jid: str) -> int:
+        """
+        Id of user given as <username> or <username>@<server_name>, a
+        local user has the same id in both forms
+        """
+        username, _, server_name = jid.partition("@")
+        if not server_name or server_name == self.server_name:
+            return self.name_id(ID_LOCAL_USER, username)
+        return self.name_id(ID_REMOTE_USER, jid, self.server_id(server_name))
+
+    def field_user_id(self, frame: Frame, index: int) -> int:
+        if len(frame.fields) <= index:
+            return 0
+        return self.user_id(frame.field(index))
+
+    def record_open(self, link: int, websocket, connection_id: int):
+        self.connections[websocket] = connection_id
+        self.record(EVENT_OPEN, link, 0, 0, connection_id)
+
+    def record_close(self, link: int, websocket):
+        self.record(EVENT_CLOSE, link, 0, 0, self.connections.pop(websocket, 0))
+
+    def record_client_in(self, username: str, frame: Frame, size: int):
+        """
+        Record frame from client, with its first receipient and the number
+        of receipients of MULTI and FILE as detail
+        """
+        recipient = 0
+        detail = 0
+        if frame.type in (FrameType.DIRECT, FrameType.LEGACY_FILE):
+            recipient = self.field_user_id(frame, 0)
+        elif frame.type == FrameType.MULTI:
+            recipient = self.field_user_id(frame, 0)
+            detail = min(255, len(frame.fields) // 2)
+        elif frame.type == FrameType.FILE:
+            recipient = self.field_user_id(frame, 1)
+            detail = min(255, (len(frame.fields) - 1) // 2)
+        elif frame.type == FrameType.ROOM and frame.fields:
+            recipient = self.room_id(frame.field(0))
+        elif frame.type == FrameType.COMMAND:
+            command, _, argument = frame.text().partition(" ")
+            detail = COMMANDS.index(command) if command in COMMANDS else DETAIL_UNKNOWN_COMMAND
+            if command in ("JOIN", "LEAVE"):
+                recipient = self.room_id(argument.strip())
+        self.record(EVENT_IN, LINK_CLIENT, frame.type, size, self.user_id(username), recipient, detail)
+
+    def record_client_out(self, websocket, frame: Frame, size: int):
+        sender = self.field_user_id(frame, 0) if frame.type in SENDER_FRAME_TYPES else 0
+        self.record(EVENT_OUT, LINK_CLIENT, frame.type, size, sender, self.connections.get(websocket, 0))
+
+    def record_peer_in(self, server_name: str, exchange: dict, size: int):
+        """
+        Record exchange json from peer, with its local receipient, or the
+        number of receipients of multi_message and file_ref as detail
+        """
+        tag = exchange.get("tag", None)
+        recipient = 0
+        detail = 0
+        if tag in ("message", "file"):
+            exchange_to = exchange.get("to", None)
+            if exchange_to == "public":
+                detail = DETAIL_PUBLIC
+            elif isinstance(exchange_to, str):
+                recipient = self.user_id(exchange_to)
+        elif tag in ("multi_message", "file_ref") and isinstance(exchange.get("keys", None), dict):
+            detail = min(255, len(exchange["keys"]))
+        elif tag in ("room_membership", "room_message") and isinstance(exchange.get("room", None), str):
+            recipient = self.room_id(exchange["room"])
+        self.record(
+            EVENT_IN, LINK_PEER, EXCHANGE_KINDS.get(tag, 0), size,
+            self.server_id(server_name), recipient, detail,
+        )
+
+    def record_peer_out(self, websocket, tag: str, size: int):
+        self.record(
+            EVENT_OUT, LINK_PEER, EXCHANGE_KINDS.get(tag, 0), size, 0, self.connections.get(websocket, 0)
+        )
@@ -0,0 +1,212 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+# Json to acknowledge every sequenced message up to seq (cumulative)
+def ack_json(epoch: str, seq: int) -> str:
+    return json.dumps({"tag": "ack", "epoch": epoch, "ack": seq})
+
+
+def sequenced_json(data: str, epoch: str, seq: int) -> str:
+    """
+    Append epoch and seq to an exchange json object without re-encoding it
+    """
+    return f'{data[:-1]}, "epoch": "{epoch}", "seq": {seq}}}'
+
+
+class ReliableLink:
+    """
+    ReliableLink gives at-least-once delivery of exchange messages to one
+    peer server. Messages are numbered, sent without waiting for each ack
+    as long as the in-flight window is not full, and kept until the peer
+    acknowledges them. Unacked messages are sent again after the connection
+    is lost or re-established, and the peer drops the duplicates.
+
+    Attributes:
+    - server_name: name of peer server
+    - epoch: random id of this sender, so that the peer can tell a restart
+        from a duplicate
+    - pending: deque of (seq, data) waiting to be sent
+    - in_flight: OrderedDict of { seq: data } sent but not acknowledged
+    - peer_epoch: epoch of peer sender
+    - received_seq: every message of peer_epoch up to this seq is received
+    - received_ahead: set of seq received after a gap
+
+    Assumptions:
+    - send_frame returns False if there is no connection to the peer, and
+      raises if sending failed
+    """
+
+    def __init__(
+        self,
+        server_name: str,
+        send_frame: Callable[[str], Awaitable[bool]],
+        window: int = 64,
+        max_pending: int = 4096,
+        ack_delay: float = 0.02,
+    ):
+        self.server_name = server_name
+        self.send_frame = send_frame
+        self.window = window
+        self.max_pending = max_pending
+        self.ack_delay = ack_delay
+        self.epoch = uuid.uuid4().hex
+        self.next_seq = 1
+        self.pending = deque()
+        self.in_flight = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.pump_task = None
+        self.peer_epoch = None
+        self.received_seq = 0
+        self.received_ahead = set()
+        self.unacked_received = 0
+        self.ack_handle = None
+
+    def enqueue(self, data: str) -> bool:
+        """
+        Queue exchange json for delivery, return False if the queue is full
+        """
+        if len(self.pending) + len(self.in_flight) >= self.max_pending:
+            return False
+        seq = self.next_seq
+        self.next_seq += 1
+        self.pending.append((seq, sequenced_json(data, self.epoch, seq)))
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.ensure_future(self.pump())
+        self.wakeup.set()
+        return True
+
+    async def pump(self):
+        """
+        Send pending messages while the in-flight window allows
+        """
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending and len(self.in_flight) < self.window:
+                seq, data = self.pending.popleft()
+                self.in_flight[seq] = data
+                try:
+                    sent = await self.send_frame(data)
+                except Exception as e:
+                    logger.warning(f"unable to send seq {seq} to {self.server_name}: {e}")
+                    sent = False
+                if not sent:
+                    # wait for reconnection, then send unacked messages again
+                    self.requeue()
+                    break
+
+    def requeue(self):
+        """
+        Move unacked messages back to the front of pending queue
+        """
+        self.pending.extendleft(reversed(list(self.in_flight.items())))
+        self.in_flight.clear()
+
+    def connection_changed(self):
+        """
+        Called when a connection to peer is lost or established, every
+        unacked message is sent again
+        """
+        self.requeue()
+        self.wakeup.set()
+
+    def take_unacked(self) -> list:
+        """
+        Stop link and return messages not yet acknowledged, in order of seq
+        """
+        self.requeue()
+        unacked = [data for _, data in self.pending]
+        self.pending.clear()
+        self.close()
+        return unacked
+
+    def close(self):
+        """
+        Stop link of a peer removed from config, unacked messages are dropped
+        """
+        if self.pump_task is not None:
+            self.pump_task.cancel()
+            self.pump_task = None
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if self.pending or self.in_flight:
+            logger.warning(f"dropping {len(self.pending) + len(self.in_flight)} messages to {self.server_name}")
+        self.pending.clear()
+        self.in_flight.clear()
+
+    def ack(self, epoch: str, seq: int):
+        """
+        Release every message up to seq acknowledged by the peer
+        """
+        if epoch != self.epoch:
+            return
+        while self.in_flight and next(iter(self.in_flight)) <= seq:
+            self.in_flight.popitem(last=False)
+        while self.pending and self.pending[0][0] <= seq:
+            self.pending.popleft()
+        self.wakeup.set()
+
+    def accept(self, epoch: str, seq: int) -> bool:
+        """
+        Record sequenced message received from peer.
+
+        Returns:
+            True if the message is new, False if it is a duplicate
+        """
+        if epoch != self.peer_epoch:
+            # new peer sender, its first message is the oldest unacked one
+            self.peer_epoch = epoch
+            self.received_seq = seq - 1
+            self.received_ahead.clear()
+        is_new = seq > self.received_seq and seq not in self.received_ahead
+        if is_new:
+            self.received_ahead.add(seq)
+            while self.received_seq + 1 in self.received_ahead:
+                self.received_seq += 1
+                self.received_ahead.discard(self.received_seq)
+        # duplicates are acknowledged too, the previous ack may be lost
+        self.schedule_ack()
+        return is_new
+
+    def schedule_ack(self):
+        """
+        Acknowledge immediately every quarter window, otherwise after
+        ack_delay so that acks of a burst are combined
+        """
+        self.unacked_received += 1
+        if self.unacked_received >= max(1, self.window // 4):
+            self.send_ack()
+        elif self.ack_handle is None:
+            self.ack_handle = asyncio.get_running_loop().call_later(
+                self.ack_delay, self.send_ack
+            )
+
+    def send_ack(self):
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        self.unacked_received = 0
+        asyncio.ensure_future(self._send_ack(ack_json(self.peer_epoch, self.received_seq)))
+
+    async def _send_ack(self, data: str):
+        try:
+            await self.send_frame(data)
+        except Exception as e:
+            logger.warning(f"unable to send ack to {self.server_name}: {e}")
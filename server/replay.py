@@ -0,0 +1,558 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Replay of a trace recorded by TrafficRecorder against a chat server and
+# exchange server on loopback, run from server directory:
+#   python replay.py <trace> [--speed 1 10 max] [--seconds N]
+#
+# Clients and peer servers of the trace are simulated in this process.
+# They send random payloads of the recorded sizes at the recorded times
+# divided by speed, payloads start with the send time to measure latency.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import websockets
+import yaml
+
+from benchmark import print_table, random_public_key
+from chat_server import ChatServer
+from compression import compression_settings, server_extensions
+from exchange_server import (
+    ExchangeServer, Presence, broadcast_json, check_json, file_json, hello_json, message_json,
+    presence_json,
+)
+from framing import (
+    BATCH_SUBPROTOCOL, BINARY_SUBPROTOCOL, COMMANDS, Frame, FrameType, pairs_to_fields,
+    split_batch, text_field,
+)
+from recorder import (
+    DETAIL_PUBLIC, EVENT_CLOSE, EVENT_IN, EVENT_OPEN, EVENT_OUT, EXCHANGE_TAGS, ID_LOCAL_USER,
+    ID_REMOTE_USER, ID_ROOM, ID_SERVER, LINK_CLIENT, LINK_PEER, Trace, TraceRecord, read_trace,
+)
+
+# server name of the server under test
+REPLAY_SERVER = "replay"
+REPLAY_PASSWORD = "replay"
+# features of simulated peer servers, unsequenced so that no acks are due
+PEER_FEATURES = ["batch"]
+
+# frames carrying text, their payload is replayed as ascii
+TEXT_FRAME_TYPES = (FrameType.BROADCAST, FrameType.ROOM)
+# frames delivered with the payload sent, which gives their latency
+TIMED_FRAME_TYPES = (
+    FrameType.BROADCAST, FrameType.DIRECT, FrameType.MULTI, FrameType.FILE, FrameType.LEGACY_FILE,
+)
+
+# seconds between samples of outbox queues and event loop delay
+SAMPLE_INTERVAL = 0.01
+# run ends when nothing was delivered for this long after the last send
+SETTLE_SECONDS = 1.0
+MAX_SETTLE_SECONDS = 30.0
+
+
+def replay_name(ids: dict, name_id: int) -> str:
+    """
+    Name standing in for id of the trace, users of the server under test
+    are u<id>, peer servers p<id>
+    """
+    id_kind, server = ids.get(name_id, (ID_LOCAL_USER, 0))
+    if id_kind == ID_REMOTE_USER:
+        return f"u{name_id}@p{server}"
+    if id_kind == ID_SERVER:
+        return f"p{name_id}"
+    if id_kind == ID_ROOM:
+        return f"room{name_id}"
+    return f"u{name_id}"
+
+
+def timed_payload(size: int, text: bool = False) -> bytes:
+    """
+    Payload of size bytes starting with the send time, the rest random,
+    ascii for payloads the servers handle as text
+    """
+    stamp = f"{time.perf_counter():.6f} ".encode("ascii")
+    rest = max(0, size - len(stamp))
+    if text:
+        return stamp + base64.b64encode(os.urandom(rest * 3 // 4 + 3))[:rest]
+    return stamp + os.urandom(rest)
+
+
+def payload_time(payload) -> Optional[float]:
+    try:
+        return float(bytes(payload[:24]).partition(b" ")[0])
+    except ValueError:
+        return None
+
+
+def build_client_frame(record: TraceRecord, ids: dict, local_users: List[int]) -> Optional[Frame]:
+    """
+    Frame of client record with a timed payload making up the recorded
+    size, None if the frame is not replayed. Further receipients of MULTI
+    and FILE are other users of the trace.
+    """
+    kind = record.kind
+    recipient = replay_name(ids, record.recipient)
+    if kind == FrameType.COMMAND:
+        if record.detail >= len(COMMANDS):
+            return None
+        command = COMMANDS[record.detail]
+        if command in ("JOIN", "LEAVE"):
+            command = f"{command} {recipient}"
+        return Frame(FrameType.COMMAND, (), text_field(command))
+    if kind == FrameType.BROADCAST:
+        fields = ()
+    elif kind in (FrameType.DIRECT, FrameType.ROOM):
+        fields = (text_field(recipient),)
+    elif kind == FrameType.LEGACY_FILE:
+        fields = (text_field(recipient), text_field("replay.bin"))
+    elif kind in (FrameType.MULTI, FrameType.FILE):
+        others = [user for user in local_users if user not in (record.sender, record.recipient)]
+        targets = [recipient] + [f"u{user}" for user in others[:max(0, record.detail - 1)]]
+        fields = pairs_to_fields({target: os.urandom(256) for target in targets})
+        if kind == FrameType.FILE:
+            fields = [text_field("replay.bin")] + fields
+    else:
+        return None
+    overhead = len(Frame(kind, fields).encode())
+    return Frame(kind, fields, timed_payload(record.size - overhead, kind in TEXT_FRAME_TYPES))
+
+
+def presence_pool(peer: str, count: int) -> List[Presence]:
+    return [Presence(f"g{i}", f"g{i}@{peer}", random_public_key()) for i in range(count)]
+
+
+def build_peer_json(record: TraceRecord, ids: dict, pool: List[Presence]) -> Optional[str]:
+    """
+    Exchange json of peer record of about the recorded size, None if it is
+    not replayed. Presence lists are the first users of the peer's pool
+    fitting the recorded size, so that users join and leave as it changes.
+    """
+    tag = EXCHANGE_TAGS[record.kind] if record.kind < len(EXCHANGE_TAGS) else ""
+    peer = replay_name(ids, record.sender)
+    sender = f"guest@{peer}"
+    if tag == "message" and record.detail == DETAIL_PUBLIC:
+        overhead = len(broadcast_json(sender, ""))
+        return broadcast_json(sender, timed_payload(record.size - overhead, True).decode("ascii"))
+    if tag in ("message", "file"):
+        target = f"{replay_name(ids, record.recipient)}@{REPLAY_SERVER}"
+        if tag == "message":
+            overhead = len(message_json(sender, target, ""))
+        else:
+            overhead = len(file_json(sender, target, "replay.bin", ""))
+        info = base64.b64encode(timed_payload((record.size - overhead) * 3 // 4)).decode("ascii")
+        if tag == "message":
+            return message_json(sender, target, info)
+        return file_json(sender, target, "replay.bin", info)
+    if tag == "presence":
+        if not pool:
+            pool.extend(presence_pool(peer, 1))
+        entry_bytes = len(presence_json(pool[:1])) - len(presence_json([]))
+        count = max(0, round((record.size - len(presence_json([]))) / entry_bytes))
+        if len(pool) < count:
+            pool.extend(presence_pool(peer, count)[len(pool):])
+        return presence_json(pool[:count])
+    return None
+
+
+class ReplayStats:
+    """
+    Measurements of one replay run
+
+    Attributes:
+    - latencies: seconds from send to delivery of timed payloads
+    - send_lags: seconds frames were sent later than scheduled
+    - sent, received, skipped: frames sent by and received by simulated
+      clients and peers, and records which are not replayed
+    - client_queued, peer_queued: samples of most bytes waiting in an
+      outbox of the servers under test
+    - loop_lags: samples of event loop delay
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.send_lags = []
+        self.sent = 0
+        self.received = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_delivery = time.perf_counter()
+        self.client_queued = [0]
+        self.peer_queued = [0]
+        self.loop_lags = [0.0]
+
+    def delivered(self, payload_sent: Optional[float]):
+        self.received += 1
+        self.last_delivery = time.perf_counter()
+        if payload_sent is not None:
+            self.latencies.append(self.last_delivery - payload_sent)
+
+
+class ReplayClient:
+    """
+    ReplayClient logs in as a user of the trace and sends its records in
+    order, a user blocked by the server delays only its own frames
+    """
+
+    def __init__(self, username: str, port: int, stats: ReplayStats, build):
+        self.username = username
+        self.port = port
+        self.stats = stats
+        self.build = build
+        self.websocket = None
+        self.receiver = None
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            scheduled, record = await self.queue.get()
+            try:
+                if record.event == EVENT_OPEN:
+                    await self.open()
+                elif record.event == EVENT_CLOSE:
+                    await self.close()
+                else:
+                    frame = self.build(record)
+                    if frame is None:
+                        self.stats.skipped += 1
+                        continue
+                    if self.websocket is None:
+                        await self.open()
+                    self.stats.send_lags.append(time.perf_counter() - scheduled)
+                    await self.websocket.send(frame.encode())
+                    self.stats.sent += 1
+            except (websockets.ConnectionClosed, OSError, ConnectionError):
+                self.stats.errors += 1
+                self.websocket = None
+            finally:
+                self.queue.task_done()
+
+    async def open(self):
+        if self.websocket is not None:
+            return
+        websocket = await websockets.connect(
+            f"ws://localhost:{self.port}", subprotocols=[BATCH_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+            max_size=None,
+        )
+        await websocket.recv()
+        await websocket.send(self.username)
+        await websocket.recv()
+        await websocket.send(REPLAY_PASSWORD)
+        reply = await websocket.recv()
+        if reply != "Authentication successful":
+            await websocket.close()
+            raise ConnectionError(f"{self.username}: {reply}")
+        await websocket.send(random_public_key())
+        self.websocket = websocket
+        self.receiver = asyncio.ensure_future(self.receive(websocket))
+
+    async def receive(self, websocket):
+        try:
+            async for message in websocket:
+                if isinstance(message, str):
+                    continue
+                frame = Frame.decode(message)
+                for received in split_batch(frame) if frame.type == FrameType.BATCH else [frame]:
+                    timed = received.type in TIMED_FRAME_TYPES
+                    self.stats.delivered(payload_time(received.payload) if timed else None)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def close(self):
+        if self.websocket is None:
+            return
+        await self.websocket.close()
+        await self.receiver
+        self.websocket = None
+
+
+class ReplayPeer:
+    """
+    ReplayPeer stands in for a peer server of the trace, the exchange
+    server under test connects to it as to a configured remote server
+    """
+
+    def __init__(self, name: str, stats: ReplayStats, build, compression: dict):
+        self.name = name
+        self.stats = stats
+        self.build = build
+        self.compression = compression
+        self.websocket = None
+        self.connected = asyncio.Event()
+        self.queue = asyncio.Queue()
+        self.server = None
+        self.port = 0
+        self.task = None
+
+    async def start(self):
+        self.server = await websockets.serve(
+            self.handler, "127.0.0.1", 0, max_size=None,
+            compression=None, extensions=server_extensions(self.compression),
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.task = asyncio.ensure_future(self.run())
+
+    async def handler(self, websocket):
+        self.websocket = websocket
+        await websocket.send(hello_json(self.name, PEER_FEATURES))
+        self.connected.set()
+        try:
+            async for message in websocket:
+                exchange = json.loads(message)
+                for received in exchange["frames"] if exchange["tag"] == "batch" else [exchange]:
+                    if received["tag"] == "check":
+                        await websocket.send(check_json(True))
+                    self.stats.delivered(self.payload_sent(received))
+        except websockets.ConnectionClosed:
+            pass
+
+    @staticmethod
+    def payload_sent(exchange: dict) -> Optional[float]:
+        info = exchange.get("info", None)
+        if exchange["tag"] != "message" or not isinstance(info, str):
+            return None
+        if exchange.get("to", None) == "public":
+            return payload_time(info.encode("utf-8"))
+        return payload_time(base64.b64decode(info[:32]))
+
+    async def run(self):
+        while True:
+            scheduled, record = await self.queue.get()
+            try:
+                data = self.build(record)
+                if data is None:
+                    self.stats.skipped += 1
+                    continue
+                await self.connected.wait()
+                self.stats.send_lags.append(time.perf_counter() - scheduled)
+                await self.websocket.send(data)
+                self.stats.sent += 1
+            except websockets.ConnectionClosed:
+                self.stats.errors += 1
+            finally:
+                self.queue.task_done()
+
+    async def close(self):
+        self.task.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def replay_config(base_config: dict, peers: Dict[str, "ReplayPeer"], rate_limits: bool) -> dict:
+    """
+    Config of the server under test: deployed settings with loopback
+    ports, simulated peers as remote servers, and the recorder disabled
+    """
+    config = dict(base_config)
+    config["server_name"] = REPLAY_SERVER
+    config["chat_server"] = dict(config.get("chat_server", {}), host="localhost", port=0)
+    config["exchange_server"] = dict(config.get("exchange_server", {}), host="localhost", port=0)
+    config["remote_servers"] = [
+        {"name": name, "host": "127.0.0.1", "port": peer.port} for name, peer in peers.items()
+    ]
+    config["journal"] = dict(config.get("journal", {}), directory="journal")
+    config["blob_store"] = dict(config.get("blob_store", {}), directory="blobs")
+    config["recorder"] = {"enabled": False}
+    if not rate_limits:
+        config["rate_limits"] = {
+            "messages_per_second": 0, "broadcasts_per_second": 0, "file_bytes_per_second": 0,
+        }
+    return config
+
+
+async def sample_queues(chat_server: ChatServer, exchange_server: ExchangeServer, stats: ReplayStats):
+    """
+    Sample the largest outbox of clients and of peers, and how late the
+    event loop wakes up
+    """
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        stats.loop_lags.append(time.perf_counter() - start - SAMPLE_INTERVAL)
+        stats.client_queued.append(
+            max((outbox.queued_bytes for outbox in chat_server.outboxes.values()), default=0)
+        )
+        stats.peer_queued.append(
+            max((outbox.queued_bytes for outbox in exchange_server.outboxes.values()), default=0)
+        )
+
+
+def percentile(samples: list, fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+async def run_replay(trace: Trace, records: List[TraceRecord], speed: Optional[float], base_config: dict, rate_limits: bool) -> list:
+    """
+    Replay records at speed times the recorded pace, as fast as possible if
+    speed is None, against servers started in a scratch directory
+    """
+    stats = ReplayStats()
+    ids = trace.ids
+    local_users = sorted(name_id for name_id, (id_kind, _) in ids.items() if id_kind == ID_LOCAL_USER)
+    pools = {}
+
+    def build_peer(record):
+        return build_peer_json(record, ids, pools.setdefault(record.sender, []))
+
+    peers = {
+        f"p{name_id}": ReplayPeer(
+            f"p{name_id}", stats, build_peer,
+            compression_settings(base_config.get("exchange_server", {}).get("compression", {})),
+        )
+        for name_id, (id_kind, _) in ids.items() if id_kind == ID_SERVER
+    }
+    for peer in peers.values():
+        await peer.start()
+
+    with open("theaccounts.txt", "w") as f:
+        password = hashlib.sha256(REPLAY_PASSWORD.encode()).hexdigest()
+        for user in local_users:
+            f.write(f"u{user}::{password}\n")
+    with open("server_config.yaml", "w") as f:
+        yaml.safe_dump(replay_config(base_config, peers, rate_limits), f)
+
+    exchange_server = ExchangeServer()
+    chat_server = ChatServer()
+    exchange_server.set_chat_server(chat_server)
+    chat_server.set_exchange_server(exchange_server)
+    exchange_listener = await exchange_server.start_server()
+    chat_listener = await chat_server.start_server()
+    chat_port = chat_listener.sockets[0].getsockname()[1]
+    connectors = [asyncio.ensure_future(task) for task in exchange_server.connect_remote_servers()]
+    await asyncio.wait_for(asyncio.gather(*(peer.connected.wait() for peer in peers.values())), 10)
+
+    clients = {
+        name_id: ReplayClient(
+            f"u{name_id}", chat_port, stats, lambda record: build_client_frame(record, ids, local_users)
+        )
+        for name_id in local_users
+    }
+    sampler = asyncio.ensure_future(sample_queues(chat_server, exchange_server, stats))
+
+    start = time.perf_counter()
+    first = records[0].time if records else 0.0
+    for record in records:
+        if record.event == EVENT_OUT:
+            continue
+        scheduled = start
+        if speed is not None:
+            scheduled = start + (record.time - first) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if record.link == LINK_CLIENT and record.sender in clients:
+            clients[record.sender].queue.put_nowait((scheduled, record))
+        elif record.link == LINK_PEER and f"p{record.sender}" in peers:
+            peers[f"p{record.sender}"].queue.put_nowait((scheduled, record))
+    for sender in list(clients.values()) + list(peers.values()):
+        await sender.queue.join()
+    sent_seconds = time.perf_counter() - start
+    settle_start = time.perf_counter()
+    while (
+        time.perf_counter() - stats.last_delivery < SETTLE_SECONDS
+        and time.perf_counter() - settle_start < MAX_SETTLE_SECONDS
+    ):
+        await asyncio.sleep(0.1)
+
+    sampler.cancel()
+    for client in clients.values():
+        client.task.cancel()
+        if client.websocket is not None:
+            await client.close()
+    for connector in connectors:
+        connector.cancel()
+    for peer in peers.values():
+        await peer.close()
+    chat_listener.close()
+    exchange_listener.close()
+    await chat_listener.wait_closed()
+    await exchange_listener.wait_closed()
+    if chat_server.journal is not None:
+        chat_server.journal.close()
+
+    traced_out = sum(1 for record in records if record.event == EVENT_OUT)
+    return [
+        "max" if speed is None else f"{speed:g}x",
+        stats.sent,
+        f"{stats.sent / sent_seconds:.0f}",
+        traced_out,
+        stats.received,
+        f"{statistics.median(stats.latencies) * 1000:.1f}" if stats.latencies else "-",
+        f"{percentile(stats.latencies, 0.99) * 1000:.1f}",
+        f"{max(stats.latencies, default=0) * 1000:.1f}",
+        f"{percentile(stats.send_lags, 0.99) * 1000:.1f}" if speed is not None else "-",
+        f"{max(stats.client_queued) / 1024:.0f}",
+        f"{max(stats.peer_queued) / 1024:.0f}",
+        f"{percentile(stats.loop_lags, 0.99) * 1000:.1f}",
+        stats.skipped,
+        stats.errors,
+    ]
+
+
+def replayed_records(trace: Trace, seconds: Optional[float]) -> List[TraceRecord]:
+    """
+    Records sent by simulated clients and peers, and traffic sent by the
+    recording server for comparison, within the first seconds of the trace
+    """
+    records = [
+        record for record in trace.records
+        if record.event in (EVENT_IN, EVENT_OUT)
+        or (record.link == LINK_CLIENT and record.event in (EVENT_OPEN, EVENT_CLOSE))
+    ]
+    if seconds is not None and records:
+        records = [record for record in records if record.time - records[0].time <= seconds]
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay recorded traffic against loopback servers")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", nargs="+", default=["1", "10", "max"], help="multiples of recorded pace, or max")
+    parser.add_argument("--seconds", type=float, default=None, help="replay only the first seconds of the trace")
+    parser.add_argument("--config", default="server_config.yaml", help="deployed config to replay against")
+    parser.add_argument("--no-rate-limits", action="store_true")
+    args = parser.parse_args()
+    # server modules log to console at debug level
+    logging.disable(logging.CRITICAL)
+    trace = read_trace(args.trace)
+    records = replayed_records(trace, args.seconds)
+    with open(args.config, "r") as f:
+        base_config = yaml.safe_load(f) or {}
+    rows = []
+    directory = os.getcwd()
+    for speed in args.speed:
+        with tempfile.TemporaryDirectory() as scratch:
+            os.chdir(scratch)
+            try:
+                rows.append(asyncio.run(run_replay(
+                    trace, records, None if speed == "max" else float(speed), base_config,
+                    not args.no_rate_limits,
+                )))
+            finally:
+                os.chdir(directory)
+    print_table(
+        ["speed", "sent", "sent/s", "traced out", "received", "p50 ms", "p99 ms", "max ms",
+         "send lag p99 ms", "client queue KiB", "peer queue KiB", "loop lag p99 ms", "skipped", "errors"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
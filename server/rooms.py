@@ -0,0 +1,158 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import json
+import re
+from typing import List, Set
+
+# room name allowed in JOIN, LEAVE and ROOM commands
+ROOM_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+def is_valid_room_name(room: str) -> bool:
+    return bool(ROOM_NAME_PATTERN.match(room))
+
+
+class RoomIndex:
+    """
+    RoomIndex holds the membership of every named room, grouped by the
+    server hosting the member, so that a room message is only delivered to
+    the servers and clients that belong to the room.
+
+    Attributes:
+    - members: a dict of room membership with format:
+        { <room>: { <server_name>: { <jid>, ... } } }
+    - user_rooms: a dict of joined rooms of local clients with format:
+        { <jid>: { <room>, ... } }
+
+    Assumptions:
+    - local members are stored under server name "LOCAL"
+    - empty rooms and servers without members are removed from the index
+    """
+
+    def __init__(self):
+        self.members = {}
+        self.user_rooms = {}
+
+    def join(self, room: str, jid: str) -> bool:
+        """
+        Add local client to room, return False if it is already a member
+        """
+        local_members = self.members.setdefault(room, {}).setdefault("LOCAL", set())
+        if jid in local_members:
+            return False
+        local_members.add(jid)
+        self.user_rooms.setdefault(jid, set()).add(room)
+        return True
+
+    def leave(self, room: str, jid: str) -> bool:
+        """
+        Remove local client from room, return False if it is not a member
+        """
+        local_members = self.members.get(room, {}).get("LOCAL", set())
+        if jid not in local_members:
+            return False
+        local_members.discard(jid)
+        self._discard_empty(room, "LOCAL")
+        joined_rooms = self.user_rooms.get(jid, set())
+        joined_rooms.discard(room)
+        if not joined_rooms:
+            self.user_rooms.pop(jid, None)
+        return True
+
+    def rooms_of(self, jid: str) -> Set[str]:
+        return set(self.user_rooms.get(jid, set()))
+
+    def set_server_members(self, server_name: str, room: str, jids: List[str]):
+        """
+        Replace members of room hosted by given remote server
+        """
+        if jids:
+            self.members.setdefault(room, {})[server_name] = set(jids)
+        else:
+            self.members.get(room, {}).pop(server_name, None)
+            self._discard_empty(room, server_name)
+
+    def remove_server(self, server_name: str) -> List[str]:
+        """
+        Remove all members hosted by given server, returning affected rooms
+        """
+        affected_rooms = [
+            room for room, servers in self.members.items() if server_name in servers
+        ]
+        for room in affected_rooms:
+            self.members[room].pop(server_name, None)
+            self._discard_empty(room, server_name)
+        return affected_rooms
+
+    def is_member(self, room: str, jid: str) -> bool:
+        return jid in self.members.get(room, {}).get("LOCAL", set())
+
+    def local_members(self, room: str) -> Set[str]:
+        return self.members.get(room, {}).get("LOCAL", set())
+
+    def remote_servers(self, room: str) -> List[str]:
+        """
+        Return remote server names hosting at least one member of room
+        """
+        return [
+            server_name
+            for server_name in self.members.get(room, {})
+            if server_name != "LOCAL"
+        ]
+
+    def all_members(self, room: str) -> List[str]:
+        return sorted(
+            jid for jids in self.members.get(room, {}).values() for jid in jids
+        )
+
+    def local_rooms(self) -> List[str]:
+        return [room for room, servers in self.members.items() if "LOCAL" in servers]
+
+    def _discard_empty(self, room: str, server_name: str):
+        servers = self.members.get(room, None)
+        if servers is None:
+            return
+        if not servers.get(server_name, True):
+            servers.pop(server_name, None)
+        if not servers:
+            self.members.pop(room, None)
+
+
+# Json pushed to local room members when room membership changes.
+# jid is the jid of receiving client, members contains public keys so that
+# room key can be wrapped for every member
+def room_members_json(room: str, jid: str, presence_list: list) -> str:
+    return json.dumps(
+        {
+            "tag": "room_members",
+            "room": room,
+            "jid": jid,
+            "members": [
+                {
+                    "nickname": presence.nickname,
+                    "jid": presence.jid,
+                    "publickey": presence.publickey,
+                }
+                for presence in presence_list
+            ],
+        }
+    )
+
+
+# Json of room message delivered to local room members
+def room_delivery_json(room: str, sender: str, info: str) -> str:
+    return json.dumps(
+        {
+            "tag": "room_message",
+            "room": room,
+            "from": sender,
+            "info": info,
+        }
+    )
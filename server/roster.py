@@ -0,0 +1,179 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import json
+from bisect import bisect_left, insort
+from typing import Iterable, List, Tuple
+
+# upper bound appended to a prefix to find the end of its sorted range
+PREFIX_END = "\U0010ffff"
+
+# default and maximum page size of a LIST query
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _sort_key(text: str) -> str:
+    """
+    Casefolded text, which is text itself if it has no upper case, so that
+    the index does not hold a copy of every lower case jid and nickname
+    """
+    key = text.casefold()
+    return text if key == text else key
+
+
+def _prefix_range(keys: list, prefix: str) -> Tuple[int, int]:
+    """
+    Return [start, end) of the (<key>, <jid>) entries in sorted keys whose
+    key starts with prefix
+    """
+    start = bisect_left(keys, (prefix,))
+    end = bisect_left(keys, (prefix + PREFIX_END,))
+    return start, end
+
+
+class RosterIndex:
+    """
+    RosterIndex keeps every online presence (local and federated) in sorted
+    order so that LIST queries can be answered by prefix and page without
+    flattening the whole roster.
+
+    Attributes:
+    - presences: a dict of indexed presence with format:
+        { <jid>: Presence }
+    - jid_keys: sorted list of (<casefolded jid>, <jid>)
+    - nickname_keys: sorted list of (<casefolded nickname>, <jid>)
+
+    Assumptions:
+    - jid is unique across the federation
+    - prefix matching is case insensitive
+    """
+
+    def __init__(self):
+        self.presences = {}
+        self.jid_keys = []
+        self.nickname_keys = []
+
+    def __len__(self) -> int:
+        return len(self.presences)
+
+    def add(self, presence):
+        """
+        Index given presence, replacing any presence with the same jid
+        """
+        if presence.jid in self.presences:
+            self.remove(presence.jid)
+        self.presences[presence.jid] = presence
+        insort(self.jid_keys, (_sort_key(presence.jid), presence.jid))
+        insort(self.nickname_keys, (_sort_key(presence.nickname), presence.jid))
+
+    def remove(self, jid: str):
+        presence = self.presences.pop(jid, None)
+        if presence is None:
+            return
+        self._remove_key(self.jid_keys, (jid.casefold(), jid))
+        self._remove_key(self.nickname_keys, (presence.nickname.casefold(), jid))
+
+    def replace(self, old_jids: Iterable[str], presence_list: Iterable):
+        """
+        Replace a group of presences, e.g. all presences of a remote server
+        """
+        for jid in old_jids:
+            self.remove(jid)
+        for presence in presence_list:
+            self.add(presence)
+
+    def match(self, prefix: str = "") -> List[str]:
+        """
+        Return sorted jids whose jid or nickname starts with given prefix
+        """
+        if not prefix:
+            return [jid for _, jid in self.jid_keys]
+        prefix = prefix.casefold()
+        start, end = _prefix_range(self.jid_keys, prefix)
+        matched = {jid for _, jid in self.jid_keys[start:end]}
+        start, end = _prefix_range(self.nickname_keys, prefix)
+        matched.update(jid for _, jid in self.nickname_keys[start:end])
+        return sorted(matched, key=str.casefold)
+
+    def count(self, prefix: str = "") -> int:
+        if not prefix:
+            return len(self.presences)
+        return len(self.match(prefix))
+
+    def query(self, prefix: str = "", offset: int = 0, limit: int = DEFAULT_PAGE_SIZE):
+        """
+        Return (total, page) where page is the list of presences from offset
+        up to limit entries, among the presences matching prefix
+        """
+        offset = max(offset, 0)
+        limit = min(max(limit, 0), MAX_PAGE_SIZE)
+        if not prefix:
+            # no filtering, page directly over the sorted jid index
+            page = self.jid_keys[offset:offset + limit]
+            return len(self.presences), [self.presences[jid] for _, jid in page]
+        matched = self.match(prefix)
+        page = matched[offset:offset + limit]
+        return len(matched), [self.presences[jid] for jid in page]
+
+    @staticmethod
+    def _remove_key(keys: list, key: tuple):
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+
+# Json response for LIST query, a page of presences
+def roster_json(prefix: str, offset: int, total: int, presence_list: list) -> str:
+    return json.dumps(
+        {
+            "tag": "roster",
+            "prefix": prefix,
+            "offset": offset,
+            "total": total,
+            "presence": [
+                {
+                    "nickname": presence.nickname,
+                    "jid": presence.jid,
+                    "publickey": presence.publickey,
+                }
+                for presence in presence_list
+            ],
+        }
+    )
+
+
+# Json response for COUNT query
+def roster_count_json(prefix: str, count: int) -> str:
+    return json.dumps({"tag": "roster_count", "prefix": prefix, "count": count})
+
+
+def parse_roster_command(message: str) -> Tuple[str, str, int, int]:
+    """
+    Parse roster command from client.
+
+    Expected format:
+        LIST [prefix] [offset] [limit]
+        COUNT [prefix]
+        SUBSCRIBE [prefix]
+        UNSUBSCRIBE
+    where prefix "*" means every user.
+
+    Returns:
+        (command, prefix, offset, limit)
+
+    Raises:
+        ValueError if offset or limit is not an integer
+    """
+    parts = message.split()
+    command = parts[0].upper()
+    prefix = parts[1] if len(parts) > 1 and parts[1] != "*" else ""
+    offset = int(parts[2]) if len(parts) > 2 else 0
+    limit = int(parts[3]) if len(parts) > 3 else DEFAULT_PAGE_SIZE
+    return command, prefix, offset, limit
@@ -9,8 +9,10 @@
 
 from chat_server import ChatServer
 from exchange_server import ExchangeServer
+from config_reload import ConfigReloader
 
 import asyncio
+import signal
 
 
 async def main():
@@ -20,14 +22,32 @@ async def main():
     chat_server = ChatServer()
     exchange_server.set_chat_server(chat_server)
     chat_server.set_exchange_server(exchange_server)
-    await asyncio.gather(
-        exchange_server.start_server(),
-        chat_server.start_server(),
-        *exchange_server.connect_remote_servers()
-    )
+    listeners = [exchange_server.start_server(), chat_server.start_server()]
+    # unix socket listeners are created by start_server when configured
+    listeners += [
+        server.unix_listener
+        for server in (exchange_server, chat_server)
+        if server.unix_listener is not None
+    ]
+    # kill -HUP applies changed server_config.yaml
+    ConfigReloader(chat_server, exchange_server).install()
+    # connection tasks of removed servers are cancelled by reload, so
+    # they are not awaited here
+    exchange_server.connect_remote_servers()
+    await asyncio.gather(*listeners)
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
+    try:
+        # stopped by SIGTERM, so that peer state and traces are saved at exit
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    except (AttributeError, NotImplementedError):
+        pass
     loop.run_until_complete(main())
     loop.run_forever()
+    # tasks are cancelled, so that they do not outlive the loop
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
     loop.close()
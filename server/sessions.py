@@ -0,0 +1,122 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import json
+import secrets
+from collections import deque
+from typing import Optional
+
+
+# Json giving client the token to resume its session after disconnection,
+# valid until grace seconds after the connection is lost
+def session_json(token: str, grace: float) -> str:
+    return json.dumps({"tag": "session", "token": token, "grace": grace})
+
+
+class ClientConnection:
+    """
+    ClientConnection holds the state ChatServer keeps per logged in user,
+    it outlives the websocket when the session is resumed
+
+    Attributes:
+    - username: username of the client
+    - websocket: websocket of the client, or DetachedClient while its
+        session waits to be resumed
+    - roster_prefix: prefix of presence subscription, None if not subscribed
+
+    Assumptions:
+    - slotted, as there is one per connected client
+    """
+    __slots__ = ("username", "websocket", "roster_prefix")
+
+    def __init__(self, username: str, websocket):
+        self.username = username
+        self.websocket = websocket
+        self.roster_prefix = None
+
+
+class DetachedClient:
+    """
+    DetachedClient stands in for the websocket of a client which lost its
+    connection, until the client resumes its session or the grace period
+    ends. Frames sent to the client meanwhile are kept in a ring buffer.
+
+    Attributes:
+    - username: username of the client
+    - subprotocol: subprotocol of the lost connection
+    - pending_data: data queued on the lost connection but not yet sent,
+        as list of (lane, data) in the lost connection's protocol
+    - frames: deque of frames sent during grace period, oldest first
+    - dropped: number of frames dropped as the ring buffer was full
+    - expire_handle: timer ending the grace period
+
+    Assumptions:
+    - it replaces the websocket of ClientConnection, so that presence and
+      room membership are kept while the client is away
+    """
+
+    def __init__(self, username: str, subprotocol: Optional[str], max_frames: int):
+        self.username = username
+        self.subprotocol = subprotocol
+        self.pending_data = []
+        self.frames = deque(maxlen=max_frames)
+        self.dropped = 0
+        self.expire_handle = None
+
+    def buffer(self, frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+        self.frames.append(frame)
+
+    async def close(self):
+        pass
+
+
+class SessionRegistry:
+    """
+    SessionRegistry issues resume tokens to authenticated clients.
+
+    Attributes:
+    - tokens: a dict of valid tokens with format:
+        { <token>: <username> }
+    - user_tokens: a dict of the current token of each user with format:
+        { <username>: <token> }
+
+    Assumptions:
+    - a token is used once, resuming issues a new token
+    - a token is revoked when its session ends
+    """
+
+    def __init__(self):
+        self.tokens = {}
+        self.user_tokens = {}
+
+    def issue(self, username: str) -> str:
+        self.revoke(username)
+        token = secrets.token_urlsafe(32)
+        self.tokens[token] = username
+        self.user_tokens[username] = token
+        return token
+
+    def revoke(self, username: str):
+        token = self.user_tokens.pop(username, None)
+        if token is not None:
+            self.tokens.pop(token, None)
+
+    def has_session(self, username: str) -> bool:
+        return username in self.user_tokens
+
+    def redeem(self, token: str) -> Optional[str]:
+        """
+        Return username of token and revoke it, None if token is invalid
+        """
+        username = self.tokens.get(token, None)
+        if username is not None:
+            self.revoke(username)
+        return username
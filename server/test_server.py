@@ -1,11 +1,53 @@
+import asyncio
+import base64
+import os
+import ssl
+
+import pytest
+import websockets
+from websockets.exceptions import NegotiationError
+
+from chat_server import ChatServer
 from exchange_server import (
+    ExchangeServer,
     Presence,
+    interned_presence,
+    batch_json,
+    hello_json,
     message_json,
     check_json,
     presence_json,
     attendance_json,
     file_json,
+    multi_message_json,
     parse_json,
+    json_tag,
+)
+from roster import RosterIndex, roster_count_json, parse_roster_command
+from rooms import RoomIndex, is_valid_room_name
+from reliable import ReliableLink
+from journal import MessageJournal
+from blob_store import BlobStore, blob_hash
+from compression import (
+    PRESET_DEFLATE_EXTENSION, client_extensions, compression_settings, is_ciphertext, server_extensions,
+)
+from recorder import (
+    EVENT_CLOSE, EVENT_IN, EVENT_OPEN, EVENT_OUT, EXCHANGE_KINDS, ID_LOCAL_USER, ID_REMOTE_USER,
+    ID_ROOM, ID_SERVER, LINK_CLIENT, LINK_PEER, TraceRecord, TrafficRecorder, read_trace,
+)
+from benchmark import BASELINE_FILE, gate_regressions
+from replay import build_client_frame, build_peer_json, payload_time
+from sessions import ClientConnection, DetachedClient, SessionRegistry
+from traffic import DEFAULT_WEIGHTS, LANE_CHAT, LANE_CONTROL, LANE_FILE, MemoryBudget, OutboxFull, PriorityOutbox, RateLimiter, outbox_settings
+from overload import LEVEL_NORMAL, LEVEL_SHED_BROADCASTS, LEVEL_SHED_FILES, OverloadController
+from unix_socket import bind_unix_socket, unix_socket_settings
+from tls import client_ssl_context, generate_self_signed, server_ssl_context, tls_settings
+from tracing import Tracer, read_spans
+from config_reload import ConfigReloader, restart_settings_changed
+from peer_state import PeerStateStore
+from framing import (
+    BINARY_SUBPROTOCOL, FLAG_REMOTE, Frame, FrameType, b64, batch_frames, command_to_text, fields_to_pairs,
+    frame_to_text, parse_command, split_batch, text_field,
 )
 
 
@@ -26,6 +68,15 @@ def test_file_json():
     )
 
 
+def test_multi_message_json():
+    # one message for two receipients on the same server
+    message = multi_message_json("user1", {"user2@s1": "key2", "user3@s1": "key3"}, "abc")
+    assert (
+        message
+        == '{"tag": "multi_message", "from": "user1", "keys": {"user2@s1": "key2", "user3@s1": "key3"}, "info": "abc"}'
+    )
+
+
 def test_check_json():
     # reuqest check
     check = check_json()
@@ -88,3 +139,1068 @@ def test_parse_json():
         "tag": "presence",
         "presence": [{"nickname": "user1", "jid": "user1", "publickey": "key1"}],
     }
+
+
+def test_roster_index_query():
+    roster = RosterIndex()
+    roster.add(Presence("alice", "c1@s1", "key1"))
+    roster.add(Presence("bob", "c2@s1", "key2"))
+    roster.add(Presence("carol", "c10@s2", "key3"))
+
+    # no prefix, paginated over sorted jids
+    total, page = roster.query("", 0, 2)
+    assert total == 3
+    assert [presence.jid for presence in page] == ["c10@s2", "c1@s1"]
+    total, page = roster.query("", 2, 2)
+    assert [presence.jid for presence in page] == ["c2@s1"]
+
+    # prefix on jid and on nickname, case insensitive
+    assert roster.match("c1") == ["c10@s2", "c1@s1"]
+    assert roster.match("BO") == ["c2@s1"]
+    assert roster.count("c") == 3
+    assert roster.count("z") == 0
+
+    # replacing and removing presences
+    roster.replace(["c10@s2"], [Presence("dave", "c4@s2", "key4")])
+    assert roster.match("") == ["c1@s1", "c2@s1", "c4@s2"]
+    roster.remove("c1@s1")
+    assert roster.match("alice") == []
+    assert len(roster) == 2
+
+
+def test_roster_command():
+    assert parse_roster_command("LIST") == ("LIST", "", 0, 50)
+    assert parse_roster_command("LIST c1 10 5") == ("LIST", "c1", 10, 5)
+    assert parse_roster_command("LIST * 10") == ("LIST", "", 10, 50)
+    assert roster_count_json("c", 2) == '{"tag": "roster_count", "prefix": "c", "count": 2}'
+
+
+def test_room_index():
+    rooms = RoomIndex()
+    assert rooms.join("r1", "c1@s1")
+    assert not rooms.join("r1", "c1@s1")
+    rooms.join("r2", "c1@s1")
+    rooms.set_server_members("s2", "r1", ["c5@s2", "c6@s2"])
+    assert rooms.all_members("r1") == ["c1@s1", "c5@s2", "c6@s2"]
+    assert rooms.remote_servers("r1") == ["s2"]
+    assert rooms.remote_servers("r2") == []
+    assert rooms.rooms_of("c1@s1") == {"r1", "r2"}
+
+    # empty rooms are removed from the index
+    assert rooms.leave("r2", "c1@s1")
+    assert "r2" not in rooms.members
+    assert rooms.remove_server("s2") == ["r1"]
+    assert rooms.all_members("r1") == ["c1@s1"]
+    assert not is_valid_room_name("bad room")
+
+
+def test_reliable_link():
+    async def run():
+        sent = []
+        connected = [True]
+
+        async def send_frame(data):
+            if not connected[0]:
+                return False
+            sent.append(parse_json(data))
+            return True
+
+        link = ReliableLink("s2", send_frame, window=2)
+        for info in ["a", "b", "c"]:
+            assert link.enqueue(message_json("user1", "user2@s2", info))
+        await asyncio.sleep(0)
+        # only the window is in flight
+        assert [message["seq"] for message in sent] == [1, 2]
+
+        # cumulative ack opens the window
+        link.ack(link.epoch, 1)
+        await asyncio.sleep(0)
+        assert [message["seq"] for message in sent] == [1, 2, 3]
+
+        # unacked messages are sent again after reconnection
+        connected[0] = False
+        link.connection_changed()
+        await asyncio.sleep(0)
+        connected[0] = True
+        link.connection_changed()
+        await asyncio.sleep(0)
+        assert [message["seq"] for message in sent] == [1, 2, 3, 2, 3]
+        assert sent[-1]["info"] == "c"
+
+        # receiver drops duplicates, including out of order ones
+        receiver = ReliableLink("s1", send_frame)
+        assert [receiver.accept("e1", seq) for seq in [1, 3, 2, 2, 3, 4]] == [
+            True, True, True, False, False, True
+        ]
+        assert receiver.received_seq == 4
+        link.pump_task.cancel()
+
+        # "reliable" is only advertised to peers which are acknowledged
+        for reliable_delivery in (True, False):
+            _, exchange_server = chat_servers()
+            exchange_server.configure({"exchange_server": {"reliable_delivery": reliable_delivery}})
+            exchange_server.add_remote_server({"name": "s2", "host": "127.0.0.1", "port": 5556})
+            assert ("reliable" in exchange_server.hello_features("s2")) == reliable_delivery
+            assert "batch" in exchange_server.hello_features("s2")
+
+        # a reconnected peer no longer advertising "reliable" gets unacked
+        # messages once, without further retransmission
+        _, exchange_server = chat_servers()
+        exchange_server.server_name = "s1"
+        exchange_server.add_remote_server({"name": "s2", "host": "127.0.0.1", "port": 5556})
+        remote_server = exchange_server.remote_servers["s2"]
+        remote_server["features"] = ["reliable"]
+        await exchange_server.send_reliable(remote_server, message_json("c1@s1", "c2@s2", "lost"))
+        await asyncio.sleep(0)
+        old_link = exchange_server.links["s2"]
+        assert len(old_link.pending) == 1
+        peer = RecordingWebsocket()
+        remote_server["request_websocket"] = peer
+        await exchange_server.handle_exchange(peer, remote_server, parse_json(hello_json("s2", ["batch"])))
+        await exchange_server.get_outbox(peer).pump_task
+        assert [parse_json(data)["info"] for data in peer.sent] == ["lost"]
+        assert old_link.pump_task is None and not old_link.pending
+        link = exchange_server.links["s2"]
+        assert link is not old_link and link.next_seq == 1
+        await exchange_server.send_reliable(remote_server, message_json("c1@s1", "c2@s2", "direct"))
+        await exchange_server.get_outbox(peer).pump_task
+        assert "seq" not in parse_json(peer.sent[-1]) and link.next_seq == 1
+
+    asyncio.run(run())
+
+
+def test_message_journal(tmp_path):
+    async def run():
+        journal = MessageJournal(str(tmp_path), segment_bytes=64, commit_interval=0)
+        journal.open()
+        # concurrent appends are committed together
+        results = await asyncio.gather(
+            *[journal.append("c1", f"message {i}".encode()) for i in range(5)],
+            journal.append("c2", b"other"),
+        )
+        assert all(results)
+        assert journal.pending_count("c1") == 5
+        entries = await journal.read("c1")
+        assert [message for _, message in entries] == [f"message {i}".encode() for i in range(5)]
+
+        # message queued after read is not released by consume
+        await journal.append("c1", b"after read")
+        await journal.consume("c1", entries[-1][0])
+        assert [message for _, message in await journal.read("c1")] == [b"after read"]
+        journal.close()
+
+        # index is rebuilt from segments, delivered messages are not replayed
+        reopened = MessageJournal(str(tmp_path), segment_bytes=64)
+        reopened.open()
+        assert [message for _, message in await reopened.read("c1")] == [b"after read"]
+        assert [message for _, message in await reopened.read("c2")] == [b"other"]
+        assert sorted(reopened.pending_messages()) == [b"after read", b"other"]
+
+        # appender cancelled while waiting does not stop the others of the batch
+        reopened.commit_interval = 0.01
+        cancelled = asyncio.ensure_future(reopened.append("c1", b"cancelled"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        assert await asyncio.wait_for(reopened.append("c1", b"kept"), 1)
+        reopened.close()
+
+    asyncio.run(run())
+
+
+def test_message_journal_retention(tmp_path):
+    async def run():
+        journal = MessageJournal(str(tmp_path), segment_bytes=1, max_messages_per_user=2, commit_interval=0)
+        journal.open()
+        dropped = []
+        journal.on_drop = dropped.append
+        for i in range(4):
+            await journal.append("c1", f"message {i}".encode())
+        # only the latest messages are kept, older segments are deleted
+        entries = await journal.read("c1")
+        assert [message for _, message in entries] == [b"message 2", b"message 3"]
+        assert dropped == [b"message 0", b"message 1"]
+        journal.enforce_retention()
+        assert len(journal.segments) == 2
+        await journal.consume("c1", entries[-1][0])
+        journal.enforce_retention()
+        assert len(journal.segments) == 1
+        journal.close()
+
+    asyncio.run(run())
+
+
+def test_blob_store(tmp_path):
+    blob_store = BlobStore(str(tmp_path), chunk_bytes=4, memory_bytes=8, disk_bytes=12)
+    blob_store.open()
+    manifest = blob_store.put_chunks(b"aaaabbbbaaaacc")
+    # identical chunks are stored once
+    assert manifest[0] == manifest[2]
+    assert len(set(manifest)) == 3
+    assert blob_store.assemble(manifest) == b"aaaabbbbaaaacc"
+
+    # least recently used chunks are spilled to disk, then read back
+    blob_store.put(b"dddd")
+    blob_store.put(b"eeee")
+    assert blob_store.disk
+    assert blob_store.assemble(manifest) == b"aaaabbbbaaaacc"
+
+    # chunks are deleted beyond the disk cap
+    for data in [b"ffff", b"gggg", b"hhhh", b"iiii"]:
+        blob_store.put(data)
+    assert blob_store.missing(manifest)
+    assert blob_store.assemble(manifest) is None
+    assert blob_store.disk_size <= 12
+
+    # spilled chunks are available after restart
+    reopened = BlobStore(str(tmp_path), chunk_bytes=4)
+    reopened.open()
+    assert reopened.get(blob_hash(b"hhhh")) in (None, b"hhhh")
+    assert set(reopened.disk) == set(blob_store.disk)
+
+    # pinned chunks are kept beyond the disk cap until unpinned
+    pinned = BlobStore(str(tmp_path / "pinned"), chunk_bytes=4, memory_bytes=8, disk_bytes=0)
+    pinned.open()
+    manifest = pinned.put_chunks(b"aaaabbbb")
+    pinned.pin(manifest)
+    pinned.put(b"cccc")
+    assert pinned.assemble(manifest) == b"aaaabbbb"
+    pinned.unpin(manifest)
+    assert pinned.missing(manifest) and pinned.disk_size == 0
+
+
+# modules copied to client, which is run from its own directory
+SHARED_MODULES = ("framing.py", "compression.py", "tls.py", "tracing.py")
+
+
+def test_shared_modules_match_client():
+    server_directory = os.path.dirname(os.path.abspath(__file__))
+    client_directory = os.path.join(server_directory, "..", "client")
+    if not os.path.isdir(client_directory):
+        pytest.skip("client is not checked out")
+    for name in SHARED_MODULES:
+        with open(os.path.join(server_directory, name), "rb") as server_file, \
+                open(os.path.join(client_directory, name), "rb") as client_file:
+            assert server_file.read() == client_file.read(), f"{name} of server and client differ"
+
+
+def test_binary_frame():
+    frame = Frame(FrameType.DIRECT, (b"c1@s4", b"c2"), b"\x00ciphertext", FLAG_REMOTE)
+    data = frame.encode()
+    decoded = Frame.decode(data)
+    assert decoded.type == FrameType.DIRECT
+    assert decoded.flags == FLAG_REMOTE
+    assert (decoded.field(0), decoded.field(1)) == ("c1@s4", "c2")
+    # payload is a view of received data, not a copy
+    assert decoded.payload.obj is data
+    assert decoded.payload == b"\x00ciphertext"
+    assert decoded.trace is None
+
+    # trace id is carried as last field, which is not one of the fields
+    frame = Frame(FrameType.DIRECT, (b"c2",), b"ciphertext", FLAG_REMOTE, trace=b"\x01" * 8)
+    decoded = Frame.decode(frame.encode())
+    assert (decoded.trace, decoded.flags, len(decoded.fields)) == (b"\x01" * 8, FLAG_REMOTE, 1)
+
+    # truncated frame and unsupported version
+    for malformed in [b"", data[:8], b"\x02" + data[1:]]:
+        try:
+            Frame.decode(malformed)
+            assert False, malformed
+        except ValueError:
+            pass
+
+
+def test_text_command_frame():
+    # text commands are parsed into the same frames as binary clients send
+    direct = parse_command("@c2@s2 aGVsbG8=")
+    assert (direct.type, direct.field(0), bytes(direct.payload)) == (FrameType.DIRECT, "c2@s2", b"hello")
+    multi = parse_command('/multi {"keys": {"c1@s1": "a2V5"}, "info": "aGVsbG8="}')
+    assert fields_to_pairs(multi.fields) == {"c1@s1": b"key"}
+    join = parse_command("/join r1")
+    assert (join.type, join.text()) == (FrameType.COMMAND, "JOIN r1")
+    room = parse_command("/room r1 secret")
+    assert (room.type, room.field(0), room.text()) == (FrameType.ROOM, "r1", "secret")
+    # chat text starting with a command word is broadcast
+    for text in [
+        "LISTEN to me", "FILEs are great", "LEAVE now please", "JOIN us", "ROOM party hi",
+        "MULTI player", "COUNT on me", "SUBSCRIBE to my channel", "/shrug",
+    ]:
+        frame = parse_command(text)
+        assert (frame.type, frame.text()) == (FrameType.BROADCAST, text)
+    # chat text starting with / is escaped
+    for text in ["/join us", "//"]:
+        broadcast = Frame(FrameType.BROADCAST, (), text_field(text))
+        assert parse_command(command_to_text(broadcast)).text() == text
+    for frame in [join, room, Frame(FrameType.COMMAND, (), text_field("UNSUBSCRIBE"))]:
+        parsed = parse_command(command_to_text(frame))
+        assert (parsed.type, parsed.fields, parsed.text()) == (frame.type, frame.fields, frame.text())
+    for invalid in ["@c2 not base64!", "FILE c2 a.txt", '/multi {"keys": 1}', "/room r1"]:
+        try:
+            parse_command(invalid)
+            assert False, invalid
+        except ValueError:
+            pass
+
+    # frames to text clients keep the previous text format
+    assert frame_to_text(
+        Frame(FrameType.DIRECT, (text_field("c1"), text_field("c2")), b"hello")
+    ) == "@c1 to c2: aGVsbG8="
+    assert frame_to_text(
+        Frame(FrameType.BROADCAST, (text_field("c1@s1"),), b"hi", FLAG_REMOTE)
+    ) == "BROADCAST from c1@s1: hi"
+    assert frame_to_text(
+        Frame(FrameType.LEGACY_FILE, (text_field("c1"), text_field("a.txt")), b"hello")
+    ) == "FILE c1 aGVsbG8= a.txt"
+
+
+def test_rate_limiter():
+    limiter = RateLimiter({"message": (10, 2), "file_bytes": (1000, 1000), "broadcast": (0, 0)})
+    # burst is granted immediately, then one message per 1/rate second
+    assert limiter.reserve("c1", "message") == 0
+    assert limiter.reserve("c1", "message") == 0
+    assert 0.09 < limiter.reserve("c1", "message") <= 0.1
+    # budgets are per user and kind, disabled kinds are not limited
+    assert limiter.reserve("c2", "message") == 0
+    assert limiter.reserve("c1", "broadcast") == 0
+    # file larger than burst is accepted after waiting for its debt
+    assert 0.9 < limiter.reserve("c1", "file_bytes", 2000) <= 1.0
+
+
+class RecordingWebsocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+        await asyncio.sleep(0)
+
+    async def close(self):
+        pass
+
+
+def test_priority_outbox():
+    async def run():
+        websocket = RecordingWebsocket()
+        outbox = PriorityOutbox(websocket, weights=(8, 4, 1), quantum=100, max_queued_bytes=2000)
+        for i in range(4):
+            outbox.put(f"file{i}" + "x" * 395, LANE_FILE)
+        outbox.put("chat1", LANE_CHAT)
+        outbox.put("presence", LANE_CONTROL)
+        outbox.put("chat2", LANE_CHAT)
+        try:
+            outbox.put("x" * 500, LANE_FILE)
+            assert False
+        except OutboxFull:
+            pass
+        await outbox.pump_task
+        order = [data[:5] for data in websocket.sent]
+        # control and chat are not queued behind file data, which still completes in order
+        assert order[:3] == ["prese", "chat1", "chat2"]
+        assert order[3:] == ["file0", "file1", "file2", "file3"]
+
+    asyncio.run(run())
+
+
+def test_session_registry():
+    sessions = SessionRegistry()
+    token = sessions.issue("c1")
+    # a new token revokes the previous one
+    new_token = sessions.issue("c1")
+    assert sessions.redeem(token) is None
+    assert sessions.has_session("c1")
+    # a token is used once
+    assert sessions.redeem(new_token) == "c1"
+    assert sessions.redeem(new_token) is None
+    assert not sessions.has_session("c1")
+    sessions.issue("c2")
+    sessions.revoke("c2")
+    assert not sessions.has_session("c2")
+
+
+def test_detached_client():
+    detached = DetachedClient("c1", None, 2)
+    for i in range(3):
+        detached.buffer(Frame(FrameType.BROADCAST, (text_field("c2"),), text_field(f"m{i}")))
+    # oldest frame is dropped when ring buffer is full
+    assert [frame.text() for frame in detached.frames] == ["m1", "m2"]
+    assert detached.dropped == 1
+
+
+def test_priority_outbox_take_pending():
+    outbox = PriorityOutbox(RecordingWebsocket())
+    outbox.lanes[LANE_CHAT].append("chat1")
+    outbox.lanes[LANE_FILE].append("file1")
+    outbox.lanes[LANE_CONTROL].append("presence")
+    # frames queued on a lost connection are kept for the resumed session
+    assert outbox.take_pending() == [(LANE_CONTROL, "presence"), (LANE_CHAT, "chat1"), (LANE_FILE, "file1")]
+    assert outbox.closed
+
+
+
+class FailingWebsocket(RecordingWebsocket):
+    def __init__(self, fail_after: int):
+        super().__init__()
+        self.fail_after = fail_after
+        self.closed = False
+
+    async def send(self, data):
+        if len(self.sent) == self.fail_after:
+            raise ConnectionError("connection lost")
+        await super().send(data)
+
+    async def close(self):
+        self.closed = True
+
+
+def test_priority_outbox_send_error_keeps_frames():
+    async def run(batch):
+        websocket = FailingWebsocket(fail_after=1)
+        budget = MemoryBudget()
+        outbox = PriorityOutbox(websocket, batch=batch, max_batch_bytes=12, budget=budget)
+        for i in range(5):
+            outbox.put(f"chat{i}", LANE_CHAT)
+        await outbox.pump_task
+        assert websocket.closed and outbox.closed
+        # frame of the failed send is kept with the frames after it
+        sent = "+".join(websocket.sent).split("+")
+        pending = outbox.take_pending()
+        assert [data for _, data in pending] == [f"chat{i}" for i in range(len(sent), 5)]
+        assert all(lane == LANE_CHAT for lane, _ in pending)
+        assert budget.total_bytes == 0
+
+    asyncio.run(run(None))
+    asyncio.run(run(lambda frames: "+".join(frames)))
+
+def test_batch_frame():
+    frames = [
+        Frame(FrameType.BROADCAST, (text_field("c1"),), text_field("hi")).encode(),
+        Frame(FrameType.DIRECT, (text_field("c1"), text_field("c2")), b"\x00" * 300).encode(),
+    ]
+    batch = Frame.decode(batch_frames(frames))
+    assert batch.type == FrameType.BATCH
+    unpacked = split_batch(batch)
+    assert [frame.encode() for frame in unpacked] == frames
+    # frames are views of the batch, not copies
+    assert unpacked[1].payload.obj is batch.payload.obj
+    try:
+        split_batch(Frame.decode(batch_frames(frames)[:-1]))
+        assert False
+    except ValueError:
+        pass
+
+
+def test_priority_outbox_batch():
+    async def run():
+        websocket = RecordingWebsocket()
+        outbox = PriorityOutbox(websocket, batch=lambda frames: "+".join(frames), max_batch_bytes=20)
+        # frames queued in the same loop tick are coalesced, up to max_batch_bytes
+        for i in range(4):
+            outbox.put(f"chat{i}", LANE_CHAT)
+        outbox.put("presence", LANE_CONTROL)
+        outbox.put("x" * 20, LANE_FILE)
+        await outbox.pump_task
+        assert websocket.sent == ["presence+chat0+chat1", "chat2+chat3", "x" * 20]
+        assert outbox.sends == 3
+        # single frame is sent as is
+        outbox.put("chat4", LANE_CHAT)
+        await outbox.pump_task
+        assert websocket.sent[-1] == "chat4"
+
+    asyncio.run(run())
+
+
+def test_batch_json():
+    frames = [message_json("user1@s1", "user2@s2", "abc"), check_json()]
+    batch = batch_json(frames)
+    assert json_tag(batch) == "batch"
+    assert parse_json(batch) == {"tag": "batch", "frames": [parse_json(frame) for frame in frames]}
+
+
+class PeerWebsocket(RecordingWebsocket):
+    remote_address = ("127.0.0.1", 5555)
+
+    def __init__(self, messages):
+        super().__init__()
+        self.messages = messages
+
+    async def __aiter__(self):
+        for message in self.messages:
+            yield message
+
+
+def test_exchange_handler_batch():
+    async def run():
+        exchange_server = ExchangeServer()
+        exchange_server.remote_servers = {"s2": {"name": "s2", "host": "127.0.0.1", "port": 5555}}
+        exchange_server.batch_settings = {"batch_window": 0, "max_batch_bytes": 65536}
+        # json in batch are handled in order, as if received one by one
+        websocket = PeerWebsocket([
+            batch_json([hello_json("s2", ["batch"]), check_json(), check_json()])
+        ])
+        await exchange_server.exchange_handler(websocket, "s2")
+        assert exchange_server.remote_servers["s2"]["features"] == ["batch"]
+        # replies to peer advertising batch are coalesced as well
+        await exchange_server.outboxes[websocket].pump_task
+        assert websocket.sent == [batch_json([check_json(True), check_json(True)])]
+
+    asyncio.run(run())
+
+
+
+def test_exchange_skips_invalid_entries():
+    async def run():
+        chat_server, exchange_server = chat_servers()
+        chat_server.server_name = exchange_server.server_name = "s1"
+        remote_server = {"name": "s2", "host": "127.0.0.1", "port": 5556}
+        websocket = ClientWebsocket()
+        chat_server.clients["c2"] = ClientConnection("c2", websocket)
+        # a bad receipient does not stop delivery to the others
+        key = base64.b64encode(b"key").decode("utf-8")
+        await exchange_server.handle_exchange(websocket, remote_server, parse_json(multi_message_json(
+            "c1@s2", {"c3@s9": key, "c2@s1": key}, base64.b64encode(b"sealed").decode("utf-8")
+        )))
+        await chat_server.outboxes[websocket].pump_task
+        assert len(websocket.sent) == 1
+        # a missing chunk does not stop serving the others
+        peer = RecordingWebsocket()
+        chunk_hash = chat_server.blob_store.put(b"chunk")
+        await exchange_server.handle_exchange(
+            peer, remote_server, {"tag": "blob_want", "hashes": ["0" * 64, chunk_hash]}
+        )
+        await exchange_server.get_outbox(peer).pump_task
+        assert [parse_json(data)["hash"] for data in peer.sent] == [chunk_hash]
+        # malformed blob is ignored without raising, the link is kept
+        for exchange in [
+            {"tag": "blob", "hash": chunk_hash, "info": "not base64!"},
+            {"tag": "blob", "hash": chunk_hash, "info": 5},
+            {"tag": "blob", "hash": ["x"], "info": base64.b64encode(b"chunk").decode("utf-8")},
+        ]:
+            await exchange_server.handle_exchange(peer, remote_server, exchange)
+
+    asyncio.run(run())
+
+
+def test_frame_missing_fields():
+    async def run():
+        chat_server, exchange_server = chat_servers()
+        websocket = ClientWebsocket()
+        # missing fields raise ValueError, answered by a notice without disconnecting
+        for frame in [
+            Frame(FrameType.DIRECT, (), b"message"),
+            Frame(FrameType.LEGACY_FILE, (text_field("c2"),), b"file"),
+            Frame(FrameType.ROOM, (), b"message"),
+        ]:
+            try:
+                await chat_server.handle_frame("c1", frame, websocket)
+                assert False
+            except ValueError:
+                pass
+
+    asyncio.run(run())
+
+
+def test_room_command_frame():
+    async def run():
+        chat_server, exchange_server = chat_servers()
+        chat_server.server_name = "s1"
+        websocket = ClientWebsocket()
+        await chat_server.handle_frame("c1", Frame(FrameType.COMMAND, (), text_field("JOIN lobby")), websocket)
+        assert exchange_server.rooms.rooms_of("c1@s1") == {"lobby"}
+        # an unknown command is answered by a notice and keeps the membership
+        sent = len(websocket.sent)
+        await chat_server.handle_frame("c1", Frame(FrameType.COMMAND, (), text_field("FOO lobby")), websocket)
+        await chat_server.get_outbox(websocket).drain()
+        assert exchange_server.rooms.rooms_of("c1@s1") == {"lobby"}
+        assert "Unknown command FOO" in str(websocket.sent[sent:])
+        await chat_server.handle_frame("c1", Frame(FrameType.COMMAND, (), text_field("LEAVE lobby")), websocket)
+        assert exchange_server.rooms.rooms_of("c1@s1") == set()
+
+    asyncio.run(run())
+
+
+def test_file_ref_pinned_in_journal(tmp_path):
+    async def run():
+        chat_server, exchange_server = chat_servers()
+        chat_server.server_name = "s1"
+        chat_server.accounts = {"c2": "hash"}
+        chat_server.journal = MessageJournal(str(tmp_path / "journal"), commit_interval=0)
+        chat_server.journal.open()
+        chat_server.blob_store = BlobStore(str(tmp_path / "blobs"), chunk_bytes=4, memory_bytes=8, disk_bytes=0)
+        chat_server.blob_store.open()
+        manifest = chat_server.blob_store.put_chunks(b"aaaabbbb")
+        # file of offline user is not evicted before it is delivered
+        await chat_server.deliver_file_ref("c1@s1", "c2", "f.txt", manifest, b"key")
+        chat_server.blob_store.put(b"cccc")
+        assert not chat_server.blob_store.missing(manifest)
+        # messages are kept in journal if the connection is lost during replay
+        lost = FailingWebsocket(fail_after=0)
+        lost.subprotocol = None
+        await chat_server.replay_journal("c2", lost)
+        assert lost.closed and chat_server.journal.pending_count("c2") == 1
+        assert not chat_server.blob_store.missing(manifest)
+        websocket = ClientWebsocket()
+        await chat_server.replay_journal("c2", websocket)
+        assert chat_server.journal.pending_count("c2") == 0
+        await chat_server.outboxes[websocket].pump_task
+        assert len(websocket.sent) == 1
+        assert chat_server.blob_store.missing(manifest)
+        chat_server.journal.close()
+
+    asyncio.run(run())
+
+
+def test_file_to_server_without_blob():
+    async def run():
+        chat_server, exchange_server = chat_servers()
+        exchange_server.server_name = "s1"
+        peer = RecordingWebsocket()
+        exchange_server.remote_servers = {"s2": {"name": "s2", "features": ["batch"], "request_websocket": peer}}
+        manifest = chat_server.blob_store.put_chunks(b"sealed file")
+        key = base64.b64encode(b"key").decode("utf-8")
+        # file is sent inline with its wrapped keys
+        assert await exchange_server.send_file_ref_to_server("c1@s1", "s2", {"c2@s2": key}, "f.txt", manifest)
+        await exchange_server.get_outbox(peer).pump_task
+        exchange = parse_json(peer.sent[0])
+        assert exchange["tag"] == "multi_file"
+        assert base64.b64decode(exchange["info"]) == b"sealed file"
+
+        receiver, receiver_exchange = chat_servers()
+        receiver.server_name = receiver_exchange.server_name = "s2"
+        websocket = ClientWebsocket()
+        receiver.clients["c2"] = ClientConnection("c2", websocket)
+        await receiver_exchange.handle_exchange(peer, {"name": "s1"}, exchange)
+        await receiver.outboxes[websocket].pump_task
+        assert len(websocket.sent) == 1
+
+    asyncio.run(run())
+
+
+def test_selective_compression():
+    settings = compression_settings({"threshold_bytes": 64})
+    # client offers preset dictionary first, server accepts only one deflate
+    offers = [(factory.name, factory.get_request_params()) for factory in client_extensions(settings)]
+    server_factories = server_extensions(settings)
+    accepted = []
+    for name, params in offers:
+        for factory in server_factories:
+            if factory.name == name:
+                try:
+                    response_params, extension = factory.process_request_params(params, accepted)
+                except NegotiationError:
+                    continue
+                accepted.append(extension)
+                break
+    assert [extension.name for extension in accepted] == [PRESET_DEFLATE_EXTENSION]
+    client = client_extensions(settings)[0].process_response_params(response_params, [])
+    server = accepted[0]
+
+    presence = presence_json([
+        Presence("c1", "c1@s1", "-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA\nIDAQAB\n-----END PUBLIC KEY-----\n")
+    ]).encode("utf-8")
+    ciphertext = os.urandom(1024)
+    for data in (presence, ciphertext, b"short", presence):
+        frame = client.encode(websockets.frames.Frame(websockets.frames.OP_BINARY, data))
+        # ciphertext and short messages are sent uncompressed
+        assert frame.rsv1 == (data == presence)
+        assert server.decode(frame).data == data
+    assert client.sent_bytes < client.raw_bytes
+    assert not is_ciphertext(base64.b64encode(ciphertext))
+
+
+class ClientWebsocket(RecordingWebsocket):
+    subprotocol = None
+    close_code = 1006
+
+
+def chat_servers():
+    chat_server = ChatServer()
+    exchange_server = ExchangeServer()
+    chat_server.set_exchange_server(exchange_server)
+    exchange_server.set_chat_server(chat_server)
+    return chat_server, exchange_server
+
+
+def test_overload_controller():
+    async def run():
+        budget = MemoryBudget()
+        outbox = PriorityOutbox(RecordingWebsocket(), budget=budget)
+        outbox.put("x" * 600, LANE_FILE)
+        outbox.put("chat", LANE_CHAT)
+        assert budget.lane_bytes == [0, 4, 600]
+        await outbox.pump_task
+        outbox.put("y" * 100, LANE_FILE)
+        outbox.close()
+        assert budget.total_bytes == 0
+
+        controller = OverloadController(budget, max_file_bytes=1000, max_outbound_bytes=10000, max_loop_lag=0.1)
+        budget.add(LANE_FILE, 800)
+        assert controller.admit("file", 200) and not controller.admit("file", 201)
+        controller.sample(0.15, None)
+        assert controller.level == LEVEL_SHED_FILES
+        assert controller.admit("broadcast") and not controller.admit("file")
+        controller.sample(0.25, None)
+        assert controller.level == LEVEL_SHED_BROADCASTS and not controller.admit("broadcast")
+        # levels are left one at a time once pressure is half of their entry
+        controller.sample(0.07, None)
+        assert controller.level == LEVEL_SHED_FILES
+        controller.sample(0.04, None)
+        assert controller.level == LEVEL_NORMAL
+        assert controller.shed == {"file": 2, "broadcast": 1}
+
+        # direct messages are admitted, broadcasts and files are refused with a notice
+        chat_server, _ = chat_servers()
+        chat_server.overload = controller
+        controller.sample(0.3, None)
+        direct = Frame(FrameType.DIRECT, (text_field("c2"),), b"hi")
+        broadcast = Frame(FrameType.BROADCAST, (), text_field("hi all"))
+        assert chat_server.admit(direct) and not chat_server.admit(broadcast)
+        # clients beyond max_connections are refused at handshake
+        chat_server.limits["max_connections"] = 1
+        assert await chat_server.process_request("/", {}) is None
+        chat_server.connection_count = 1
+        status, _, _ = await chat_server.process_request("/", {})
+        assert status == 503
+
+    asyncio.run(run())
+
+
+class BinaryClientWebsocket(ClientWebsocket):
+    subprotocol = BINARY_SUBPROTOCOL
+
+
+def test_message_tracing(tmp_path):
+    async def run():
+        path = str(tmp_path / "traces" / "spans.jsonl")
+        tracer = Tracer("s1", path=path, sample_rate=0)
+        tracer.open()
+        chat_server, exchange_server = chat_servers()
+        chat_server.server_name = exchange_server.server_name = "s1"
+        chat_server.tracer = exchange_server.tracer = tracer
+        receiver = BinaryClientWebsocket()
+        chat_server.clients["c2"] = ClientConnection("c2", receiver)
+        peer = RecordingWebsocket()
+        exchange_server.remote_servers = {"s2": {"name": "s2", "host": "127.0.0.1", "websocket": peer}}
+
+        # trace of client frame is continued to local receipient and remote server
+        trace_id = bytes(range(8))
+        for target in ("c2", "c3@s2"):
+            frame = Frame.decode(Frame(FrameType.DIRECT, (text_field(target),), b"secret", trace=trace_id).encode())
+            await chat_server.handle_traced_frame(chat_server.start_span(frame), "c1", frame, ClientWebsocket())
+        await chat_server.outboxes[receiver].pump_task
+        assert Frame.decode(receiver.sent[0]).trace == trace_id
+        await exchange_server.outboxes[peer].pump_task
+        assert parse_json(peer.sent[0])["trace"] == trace_id.hex()
+
+        # and continued by the remote server receiving it
+        exchange = parse_json(message_json("c4@s2", "c2@s1", b64(b"secret"), "ff" * 8))
+        await exchange_server.handle_traced_exchange(peer, exchange_server.remote_servers["s2"], exchange)
+        await chat_server.outboxes[receiver].pump_task
+        assert Frame.decode(receiver.sent[1]).trace == b"\xff" * 8
+
+        # frames without trace id are not sampled at rate 0
+        assert chat_server.start_span(Frame(FrameType.DIRECT, (text_field("c2"),), b"secret")) is None
+        tracer.close()
+        traces = read_spans([path])
+        assert [span["link"] for span in traces[trace_id.hex()]] == ["client", "client"]
+        assert [span["kind"] for span in traces["ff" * 8]] == ["message"]
+        for spans in traces.values():
+            for span in spans:
+                assert [event for event, _ in span["events"]] == ["receive", "route", "send"]
+
+    asyncio.run(run())
+
+
+
+def test_config_reload(tmp_path):
+    async def run():
+        limiter = RateLimiter({"message": (10, 2), "broadcast": (1, 1)})
+        limiter.reserve("c1", "message")
+        limiter.update({"message": (20, 1), "broadcast": (0, 0)})
+        # tokens are kept within the new burst, kinds no longer limited are dropped
+        assert limiter.reserve("c1", "message") == 0
+        assert 0.04 < limiter.reserve("c1", "message") <= 0.05
+        assert limiter.reserve("c1", "broadcast") == limiter.reserve("c1", "broadcast") == 0
+        outbox = PriorityOutbox(RecordingWebsocket(), max_queued_bytes=10)
+        outbox.update(weights=(1, 1, 1), quantum=10, max_queued_bytes=1000)
+        outbox.put("x" * 500, LANE_FILE)
+        await outbox.pump_task
+        # weights that would stall or break the pump fall back to the defaults
+        for weights in [(8, 0, 1), (8, 4), (8, 4, 1, 1), (8, "4", 1), (8, 4.5, 1), 4]:
+            assert outbox_settings({"weights": weights})["weights"] == DEFAULT_WEIGHTS
+        assert outbox_settings({"weights": [2, 2, 1]})["weights"] == (2, 2, 1)
+
+        chat_server, exchange_server = chat_servers()
+        config = {
+            "server_name": "s1",
+            "exchange_server": {"reliable_delivery": {"enabled": True}},
+            "remote_servers": [{"name": "s2", "host": "127.0.0.1", "port": 5556}],
+        }
+        exchange_server.configure(config)
+        for remote_server in config["remote_servers"]:
+            exchange_server.add_remote_server(remote_server)
+        chat_server.configure(config)
+        s2, link = exchange_server.remote_servers["s2"], exchange_server.links["s2"]
+        await exchange_server.update_group_presence("s2", [interned_presence("u0", "u0@s2", "key0")])
+        path = tmp_path / "server_config.yaml"
+        path.write_text(
+            "server_name: s1\n"
+            "exchange_server: {port: 5557, reliable_delivery: {enabled: true}}\n"
+            "rate_limits: {messages_per_second: 5}\n"
+            "remote_servers:\n"
+            "  - {name: s2, host: 127.0.0.1, port: 5556}\n"
+            "  - {name: s3, unix_path: /tmp/s3.sock}\n"
+        )
+        reloader = ConfigReloader(chat_server, exchange_server, str(path))
+        assert await reloader.reload()
+        # unchanged peer keeps its entry and link, the added one is not connected before start
+        assert exchange_server.remote_servers["s2"] is s2 and exchange_server.links["s2"] is link
+        assert "s3" in exchange_server.remote_servers and not exchange_server.connect_tasks
+        assert restart_settings_changed(config, chat_server.config) == ["exchange_server.port"]
+        path.write_text("remote_servers:\n  - {name: s3, unix_path: /tmp/s3.sock}\n")
+        assert await reloader.reload()
+        assert list(exchange_server.remote_servers) == ["s3"] and "s2" not in exchange_server.links
+        assert "u0@s2" not in exchange_server.roster.presences
+        # unreadable config keeps the running one
+        path.write_text("remote_servers: [")
+        assert not await reloader.reload()
+        assert reloader.reloads == 2 and list(exchange_server.remote_servers) == ["s3"]
+
+    asyncio.run(run())
+
+
+def test_update_group_presence():
+    async def run():
+        _, exchange_server = chat_servers()
+        announcement = [interned_presence(f"u{i}", f"u{i}@s2", f"key{i}") for i in range(3)]
+        await exchange_server.update_group_presence("s2", announcement)
+        first = exchange_server.presences["s2"]["u0@s2"]
+        # announced again with one key changed and one user gone
+        announcement = [
+            interned_presence("u0", "u0@s2", "key0"),
+            interned_presence("u1", "u1@s2", "rotated"),
+        ]
+        await exchange_server.update_group_presence("s2", announcement)
+        assert exchange_server.presences["s2"]["u0@s2"] is first
+        assert exchange_server.roster.presences["u1@s2"].publickey == "rotated"
+        assert exchange_server.roster.match() == ["u0@s2", "u1@s2"]
+        # same strings are stored once
+        assert announcement[0].publickey is interned_presence("u0", "u0@s2", "".join(["key", "0"])).publickey
+
+    asyncio.run(run())
+
+
+
+def test_peer_state_warm_restart(tmp_path):
+    async def run():
+        config = {"remote_servers": [{"name": "s2", "host": "127.0.0.1", "port": 5556}]}
+        store = PeerStateStore(str(tmp_path / "state" / "peers.json"), stale_timeout=0.05)
+
+        def restarted_server():
+            chat_server, exchange_server = chat_servers()
+            exchange_server.server_name = "s1"
+            exchange_server.configure(config)
+            exchange_server.add_remote_server(config["remote_servers"][0])
+            exchange_server.peer_state = store
+            exchange_server.restore_peer_state(store.load("s1"))
+            return exchange_server
+
+        exchange_server = restarted_server()
+        assert not exchange_server.presences
+        exchange_server.remote_servers["s2"]["features"] = ["reliable"]
+        announcement = [interned_presence(f"u{i}", f"u{i}@s2", f"key{i}") for i in range(3)]
+        await exchange_server.update_group_presence("s2", announcement, "e2.7")
+        store.save("s1", exchange_server.peer_snapshot())
+        assert store.load("s4") == {}
+
+        # restored presences are known at start, stale until confirmed by version
+        exchange_server = restarted_server()
+        assert exchange_server.roster.match() == ["u0@s2", "u1@s2", "u2@s2"]
+        assert exchange_server.stale_presences == {"s2"}
+        assert exchange_server.remote_servers["s2"]["features"] == ["reliable"]
+        remote_server = exchange_server.remote_servers["s2"]
+        websocket = RecordingWebsocket()
+        await exchange_server.handle_exchange(websocket, remote_server, {"tag": "presence_current", "version": "e2.7"})
+        assert not exchange_server.stale_presences
+        await asyncio.sleep(0.1)
+        assert len(exchange_server.presences["s2"]) == 3
+
+        # not confirmed within stale_timeout
+        exchange_server = restarted_server()
+        await asyncio.sleep(0.1)
+        assert not exchange_server.stale_presences and not exchange_server.roster.match()
+
+        # peer answers attendance with the restored version by a confirmation only
+        await exchange_server.update_presence("LOCAL", "c1", "c1", "key")
+        version = exchange_server.presence_version()
+        await exchange_server.handle_exchange(websocket, remote_server, {"tag": "attendance", "version": version})
+        await exchange_server.handle_exchange(websocket, remote_server, {"tag": "attendance", "version": "old.1"})
+        await exchange_server.get_outbox(websocket).pump_task
+        assert parse_json(websocket.sent[0]) == {"tag": "presence_current", "version": version}
+        assert parse_json(websocket.sent[1])["presence"][0]["jid"] == "c1@s1"
+
+    asyncio.run(run())
+
+
+def test_peer_state_skips_unchanged(tmp_path):
+    async def run():
+        store = PeerStateStore(str(tmp_path / "peers.json"), interval=0.01)
+        peers = {"s2": {"version": "e2.1", "features": [], "last_seen": 0, "presence": [["u0", "u0@s2", "key0"]]}}
+
+        def snapshot():
+            peers["s2"]["last_seen"] += 1
+            return peers
+
+        store.start("s1", snapshot)
+        await asyncio.sleep(0.1)
+        # snapshot is written again only once a peer version changed
+        assert store.saves == 1
+        peers["s2"]["version"] = "e2.2"
+        await asyncio.sleep(0.1)
+        assert store.saves == 2
+        assert store.load("s1")["s2"]["version"] == "e2.2"
+        store.stop()
+        store.snapshot = None
+
+    asyncio.run(run())
+
+def test_client_connection_resume():
+    async def run():
+        chat_server, _ = chat_servers()
+        websocket = ClientWebsocket()
+        chat_server.clients["c1"] = ClientConnection("c1", websocket)
+        await chat_server.handle_roster_command("SUBSCRIBE c", websocket, "c1")
+        detached = chat_server.detach_client(chat_server.clients["c1"])
+        detached.expire_handle.cancel()
+        # lost websocket does not remove the client once detached
+        await chat_server.remove_client("c1", websocket)
+        assert chat_server.client_socket("c1") is detached
+        resumed = ClientWebsocket()
+        await chat_server.attach_client("c1", resumed, detached)
+        connection = chat_server.clients["c1"]
+        # subscription is kept by the connection across websockets
+        assert connection.websocket is resumed
+        assert connection in chat_server.roster_subscribers and connection.roster_prefix == "c"
+        await chat_server.remove_client("c1", resumed)
+        assert not chat_server.clients and not chat_server.roster_subscribers
+
+    asyncio.run(run())
+
+
+def test_unix_socket_listener(tmp_path):
+    path = str(tmp_path / "run" / "exchange.sock")
+    assert unix_socket_settings({}) is None
+    assert unix_socket_settings({"unix_path": path, "unix_mode": "0600"}) == {"path": path, "mode": 0o600}
+
+    async def run():
+        _, exchange_server = chat_servers()
+        exchange_server.remote_servers = {"s2": {"name": "s2", "unix_path": path}}
+        async with websockets.unix_serve(exchange_server.exchange_handler, sock=bind_unix_socket(path, 0o600)):
+            assert os.stat(path).st_mode & 0o777 == 0o600
+            # a listening socket is not replaced by another server
+            with pytest.raises(OSError):
+                bind_unix_socket(path)
+            # peer without address is known by the name in its hello
+            async with websockets.unix_connect(path) as websocket:
+                await websocket.send(hello_json("s2", ["batch"]))
+                assert parse_json(await websocket.recv())["tag"] == "hello"
+                assert exchange_server.remote_servers["s2"]["features"] == ["batch"]
+            async with websockets.unix_connect(path) as websocket:
+                await websocket.send(hello_json("s9", []))
+                with pytest.raises(websockets.ConnectionClosed):
+                    await websocket.recv()
+        # socket file left by a stopped server is replaced
+        bind_unix_socket(path).close()
+
+    asyncio.run(run())
+
+
+def test_tls_session_resumption(tmp_path):
+    cert_file = str(tmp_path / "certs" / "server.pem")
+    key_file = str(tmp_path / "certs" / "server.key")
+    generate_self_signed(cert_file, key_file, ["localhost", "127.0.0.1"])
+    assert os.stat(key_file).st_mode & 0o777 == 0o600
+    assert tls_settings({"cert_file": cert_file}) is None
+    settings = tls_settings({"enabled": True, "cert_file": cert_file, "key_file": key_file, "ca_file": cert_file})
+
+    async def handler(websocket):
+        await websocket.send("hello")
+
+    async def run():
+        async with websockets.serve(handler, "localhost", 0, ssl=server_ssl_context(settings)) as server:
+            port = server.sockets[0].getsockname()[1]
+            context = client_ssl_context(settings)
+            for uri in (f"wss://localhost:{port}", f"wss://127.0.0.1:{port}", f"wss://localhost:{port}"):
+                async with websockets.connect(uri, ssl=context) as websocket:
+                    context.remember(websocket)
+                    assert await websocket.recv() == "hello"
+            # sessions after the first one are resumed
+            assert (context.handshakes, context.resumed) == (3, 2)
+            # certificate not signed by ca_file is rejected
+            other_cert = str(tmp_path / "other.pem")
+            generate_self_signed(other_cert, str(tmp_path / "other.key"), ["localhost"])
+            untrusted = client_ssl_context({**settings, "ca_file": other_cert})
+            with pytest.raises(ssl.SSLCertVerificationError):
+                await websockets.connect(f"wss://localhost:{port}", ssl=untrusted)
+
+    asyncio.run(run())
+
+
+def test_traffic_recorder(tmp_path):
+    path = str(tmp_path / "traces" / "test.trace")
+    recorder = TrafficRecorder(path, "s1")
+    recorder.open()
+    websocket = ClientWebsocket()
+    recorder.record_open(LINK_CLIENT, websocket, recorder.user_id("c1"))
+    direct = Frame(FrameType.DIRECT, (text_field("c2@s1"),), os.urandom(256))
+    recorder.record_client_in("c1", direct, len(direct.encode()))
+    recorder.record_client_in("c1", Frame(FrameType.COMMAND, (), text_field("JOIN lobby")), 10)
+    delivered = Frame(FrameType.DIRECT, (text_field("c3@s2"), text_field("c1")), b"secret")
+    recorder.record_client_out(websocket, delivered, 30)
+    recorder.record_peer_in("s2", parse_json(message_json("c3@s2", "c1@s1", "abc")), 70)
+    recorder.record_close(LINK_CLIENT, websocket)
+    recorder.close()
+
+    trace = read_trace(path)
+    c1, c2, lobby, c3, s2 = 1, 2, 3, 5, 4
+    assert trace.ids == {
+        c1: (ID_LOCAL_USER, 0), c2: (ID_LOCAL_USER, 0), lobby: (ID_ROOM, 0),
+        s2: (ID_SERVER, 0), c3: (ID_REMOTE_USER, s2),
+    }
+    assert [record[1:] for record in trace.records] == [
+        (EVENT_OPEN, LINK_CLIENT, 0, 0, 0, c1, 0),
+        (EVENT_IN, LINK_CLIENT, FrameType.DIRECT, 0, len(direct.encode()), c1, c2),
+        (EVENT_IN, LINK_CLIENT, FrameType.COMMAND, 4, 10, c1, lobby),
+        (EVENT_OUT, LINK_CLIENT, FrameType.DIRECT, 0, 30, c3, c1),
+        (EVENT_IN, LINK_PEER, EXCHANGE_KINDS["message"], 0, 70, s2, c1),
+        (EVENT_CLOSE, LINK_CLIENT, 0, 0, 0, c1, 0),
+    ]
+    # names, text and ciphertext are not recorded
+    with open(path, "rb") as f:
+        data = f.read()
+    assert b"c1" not in data and b"lobby" not in data and b"secret" not in data
+
+
+def test_replay_frames():
+    ids = {1: (ID_LOCAL_USER, 0), 2: (ID_LOCAL_USER, 0), 3: (ID_SERVER, 0), 4: (ID_REMOTE_USER, 3)}
+    record = TraceRecord(0.5, EVENT_IN, LINK_CLIENT, FrameType.DIRECT, 0, 300, 1, 4)
+    frame = build_client_frame(record, ids, [1, 2])
+    assert frame.field(0) == "u4@p3" and len(frame.encode()) == 300
+    assert payload_time(frame.payload) is not None
+    record = TraceRecord(0.5, EVENT_IN, LINK_CLIENT, FrameType.MULTI, 2, 600, 1, 2)
+    assert list(fields_to_pairs(build_client_frame(record, ids, [1, 2, 5]).fields)) == ["u2", "u5"]
+
+    # presence lists grow and shrink with the recorded size
+    pool = []
+    sizes = []
+    for size in (2000, 5000, 1000):
+        record = TraceRecord(1.0, EVENT_IN, LINK_PEER, EXCHANGE_KINDS["presence"], 0, size, 3, 0)
+        sizes.append(len(parse_json(build_peer_json(record, ids, pool))["presence"]))
+    assert sizes[1] > sizes[0] > sizes[2] > 0
+
+
+@pytest.mark.skipif(
+    not os.environ.get("SPCHAT_BENCHMARK_GATE"),
+    reason=f"set SPCHAT_BENCHMARK_GATE=1 to check hot paths against {BASELINE_FILE}",
+)
+def test_microbenchmark_gate():
+    regressions = gate_regressions()
+    assert not regressions, "slower than baseline:\n" + "\n".join(regressions)
@@ -0,0 +1,183 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# TLS of client and peer links. Outbound connections keep the session of
+# their last connection, so that reconnecting resumes it with an abbreviated
+# handshake instead of a full one.
+#
+# A self-signed certificate for local testing is written by:
+#   python tls.py certs/server.pem certs/server.key --hosts localhost 127.0.0.1
+
+import argparse
+import datetime
+import ipaddress
+import os
+import ssl
+from typing import List, Optional
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+
+def tls_settings(tls_config: dict) -> Optional[dict]:
+    """
+    TLS settings of one endpoint from tls section of config, None if TLS is
+    disabled
+    """
+    if not tls_config.get("enabled", False):
+        return None
+    return {
+        "cert_file": tls_config.get("cert_file", None),
+        "key_file": tls_config.get("key_file", None),
+        "ca_file": tls_config.get("ca_file", None),
+        "check_hostname": tls_config.get("check_hostname", True),
+        "session_resumption": tls_config.get("session_resumption", True),
+    }
+
+
+def server_ssl_context(settings: dict) -> ssl.SSLContext:
+    """
+    Context of a listener, sessions are resumed with TLS 1.3 tickets
+    encrypted by a key held by the context, so by the running process
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(settings["cert_file"], settings["key_file"])
+    if settings["session_resumption"]:
+        # clients keep the last ticket only, OpenSSL sends two by default
+        context.num_tickets = 1
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    ResumingSSLContext is the client context of one remote endpoint, which
+    offers the session of the previous connection in the handshake. asyncio
+    has no argument for the session, so it is given where asyncio creates
+    the SSLObject.
+
+    Attributes:
+    - session: last session received from the endpoint, None before the
+      first connection or if resumption is disabled
+    - handshakes: completed handshakes
+    - resumed: handshakes which resumed a session
+
+    Assumptions:
+    - one context per endpoint, a session is only resumed by the server
+      which issued it
+    - TLS 1.3 tickets arrive after the handshake, before the websocket
+      handshake response, so that they are known once connected
+    """
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, session_resumption: bool = True):
+        super().__init__()
+        self.session_resumption = session_resumption
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def remember(self, websocket):
+        """
+        Keep session of connected websocket for the next connection
+        """
+        ssl_object = websocket.transport.get_extra_info("ssl_object")
+        if ssl_object is None:
+            return
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        if self.session_resumption:
+            self.session = ssl_object.session
+
+
+def client_ssl_context(settings: dict) -> ResumingSSLContext:
+    """
+    Context verifying the endpoint with ca_file, or with the default
+    certificate authorities if ca_file is not set
+    """
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT, settings["session_resumption"])
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.check_hostname = settings["check_hostname"]
+    if settings["ca_file"]:
+        context.load_verify_locations(settings["ca_file"])
+    else:
+        context.load_default_certs()
+    return context
+
+
+def generate_self_signed(
+    cert_file: str, key_file: str, hosts: List[str], days: int = 365, key_type: str = "ec"
+):
+    """
+    Write a self-signed certificate for hosts, which are host names or IP
+    addresses, and its key, P-256 or RSA 2048 with key_type "rsa". The
+    certificate is also the ca_file of its clients and peers.
+    """
+    if key_type == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        key = ec.generate_private_key(ec.SECP256R1())
+    names = []
+    for host in hosts:
+        try:
+            names.append(x509.IPAddress(ipaddress.ip_address(host)))
+        except ValueError:
+            names.append(x509.DNSName(host))
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hosts[0])])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=days))
+        .add_extension(x509.SubjectAlternativeName(names), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    for path in (cert_file, key_file):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    with open(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ))
+    with open(cert_file, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write a self-signed certificate for local testing")
+    parser.add_argument("cert_file")
+    parser.add_argument("key_file")
+    parser.add_argument("--hosts", nargs="+", default=["localhost", "127.0.0.1"])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--key-type", choices=["ec", "rsa"], default="ec")
+    args = parser.parse_args()
+    generate_self_signed(args.cert_file, args.key_file, args.hosts, args.days, args.key_type)
+    print(f"certificate written to {args.cert_file}, key to {args.key_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# outbound traffic classes, in priority order
+LANE_CONTROL = 0
+LANE_CHAT = 1
+LANE_FILE = 2
+
+# share of each lane per scheduling round
+DEFAULT_WEIGHTS = (8, 4, 1)
+
+
+def is_valid_weights(weights) -> bool:
+    """
+    Check weights hold one positive integer per lane
+    """
+    return (
+        isinstance(weights, (list, tuple))
+        and len(weights) == len(DEFAULT_WEIGHTS)
+        and all(isinstance(weight, int) and not isinstance(weight, bool) and weight > 0 for weight in weights)
+    )
+
+
+def outbox_settings(outbound_config: dict) -> dict:
+    """
+    PriorityOutbox arguments from outbound section of config
+    """
+    weights = outbound_config.get("weights", DEFAULT_WEIGHTS)
+    if not is_valid_weights(weights):
+        # a zero weight never earns credit and would keep the pump spinning
+        logger.error(f"Invalid outbound weights {weights!r}, using {DEFAULT_WEIGHTS}")
+        weights = DEFAULT_WEIGHTS
+    return {
+        "weights": tuple(weights),
+        "quantum": outbound_config.get("quantum_bytes", 16 * 1024),
+        "max_queued_bytes": outbound_config.get("max_queued_bytes", 32 * 1024 * 1024),
+    }
+
+
+class MemoryBudget:
+    """
+    MemoryBudget counts bytes waiting in all outboxes sharing it, per lane,
+    for limits across connections
+
+    Attributes:
+    - lane_bytes: bytes waiting per lane, indexed by LANE_*
+    """
+
+    def __init__(self, lanes: int = len(DEFAULT_WEIGHTS)):
+        self.lane_bytes = [0] * lanes
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.lane_bytes)
+
+    def add(self, lane: int, size: int):
+        self.lane_bytes[lane] += size
+
+    def release(self, lane: int, size: int):
+        self.lane_bytes[lane] -= size
+
+
+class OutboxFull(Exception):
+    """
+    Raised when a slow receiver has more than max_queued_bytes waiting
+    """
+
+
+class TokenBucket:
+    """
+    TokenBucket refills rate tokens per second up to burst. A reservation
+    larger than the available tokens is granted, and the caller waits until
+    the debt is refilled, so that a single large file is still accepted.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take amount tokens
+
+        Returns:
+            seconds to wait before the reserved traffic may proceed
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """
+    RateLimiter keeps a token bucket per user and traffic kind.
+
+    Attributes:
+    - limits: a dict of bucket settings with format:
+        { <kind>: (rate, burst) }
+    - buckets: a dict of buckets with format:
+        { <username>: { <kind>: TokenBucket } }
+
+    Assumptions:
+    - buckets outlive connections, so that reconnecting does not refill them
+    - kinds without limit or with rate 0 are not limited
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        self.limits = {kind: limit for kind, limit in limits.items() if limit[0] > 0}
+        self.buckets = {}
+
+    def reserve(self, username: str, kind: str, amount: float = 1) -> float:
+        """
+        Return seconds user has to wait before sending amount of kind
+        """
+        if kind not in self.limits:
+            return 0.0
+        user_buckets = self.buckets.setdefault(username, {})
+        if kind not in user_buckets:
+            user_buckets[kind] = TokenBucket(*self.limits[kind])
+        return user_buckets[kind].reserve(amount)
+
+    def update(self, limits: Dict[str, Tuple[float, float]]):
+        """
+        Apply new limits in place, buckets keep their tokens up to the new
+        burst, buckets of kinds no longer limited are dropped
+        """
+        self.limits = {kind: limit for kind, limit in limits.items() if limit[0] > 0}
+        for user_buckets in self.buckets.values():
+            for kind in list(user_buckets):
+                if kind not in self.limits:
+                    del user_buckets[kind]
+                    continue
+                bucket = user_buckets[kind]
+                bucket.rate, bucket.burst = self.limits[kind]
+                bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    async def throttle(self, username: str, kind: str, amount: float = 1):
+        delay = self.reserve(username, kind, amount)
+        if delay > 0:
+            logger.debug(f"throttling {kind} of {username} for {delay:.3f}s")
+            await asyncio.sleep(delay)
+
+
+class PriorityOutbox:
+    """
+    PriorityOutbox serialises outgoing frames of one websocket by traffic
+    class. Lanes are served by deficit round robin: every round each lane
+    may send weight * quantum bytes, so that control and chat frames are
+    not queued behind file data, while file data still progresses.
+
+    With batch, frames selected in a round are coalesced into one batch
+    frame of up to max_batch_bytes, so that frames queued in the same loop
+    tick, or within batch_window seconds, cost one websocket send.
+
+    Attributes:
+    - lanes: deque of frames waiting per lane, indexed by LANE_*
+    - deficits: bytes each lane may still send in current round
+    - queued_bytes: bytes waiting in all lanes
+    - batched: list of (lane, data) selected for the next batch frame
+    - selected: (lane, data) taken from its lane, not yet batched or sent
+    - sending: list of (lane, data) in the websocket send under way
+    - sends: number of websocket sends, for measurement
+    - budget: MemoryBudget shared with the outboxes of other connections,
+      None if not counted
+
+    Assumptions:
+    - a send error closes the websocket, so that its receive loop removes
+      the connection, frames not sent, including the failed ones, are kept
+      for take_pending
+    - frames of the same lane are sent in order
+    - frames of max_batch_bytes or more are sent alone
+    """
+
+    def __init__(
+        self,
+        websocket,
+        weights: Sequence[int] = DEFAULT_WEIGHTS,
+        quantum: int = 16 * 1024,
+        max_queued_bytes: int = 16 * 1024 * 1024,
+        batch: Optional[Callable] = None,
+        batch_window: float = 0,
+        max_batch_bytes: int = 64 * 1024,
+        budget: Optional[MemoryBudget] = None,
+    ):
+        self.websocket = websocket
+        self.weights = weights
+        self.quantum = quantum
+        self.max_queued_bytes = max_queued_bytes
+        self.batch = batch
+        self.batch_window = batch_window
+        self.max_batch_bytes = max_batch_bytes
+        self.lanes = [deque() for _ in weights]
+        self.deficits = [0] * len(weights)
+        self.queued_bytes = 0
+        self.batched = []
+        self.batched_bytes = 0
+        self.selected = None
+        self.sending = []
+        self.sends = 0
+        self.budget = budget
+        self.pump_task = None
+        self.closed = False
+
+    def put(self, data, lane: int):
+        """
+        Queue frame on lane, sent in background
+
+        Raises:
+            ConnectionError if outbox is closed
+            OutboxFull if the receiver does not keep up
+        """
+        if self.closed:
+            raise ConnectionError("outbox closed")
+        if self.queued_bytes and self.queued_bytes + len(data) > self.max_queued_bytes:
+            raise OutboxFull(f"{self.queued_bytes} bytes waiting")
+        self.lanes[lane].append(data)
+        self.queued_bytes += len(data)
+        if self.budget is not None:
+            self.budget.add(lane, len(data))
+        if self.pump_task is None or self.pump_task.done():
+            self.pump_task = asyncio.ensure_future(self.pump())
+
+    async def pump(self):
+        try:
+            if self.batch is not None and self.batch_window > 0:
+                # wait for more frames to coalesce
+                await asyncio.sleep(self.batch_window)
+            while self.queued_bytes:
+                for lane, frames in enumerate(self.lanes):
+                    if not frames:
+                        # idle lane does not save up for later rounds
+                        self.deficits[lane] = 0
+                        continue
+                    self.deficits[lane] += self.weights[lane] * self.quantum
+                    while frames and len(frames[0]) <= self.deficits[lane]:
+                        data = frames.popleft()
+                        self.deficits[lane] -= len(data)
+                        self.queued_bytes -= len(data)
+                        if self.budget is not None:
+                            self.budget.release(lane, len(data))
+                        await self.send(lane, data)
+                await self.flush()
+        except Exception as e:
+            logger.warning(f"unable to send queued frame: {e}")
+            self.closed = True
+            self.batched = self.sending + self.batched + ([self.selected] if self.selected else [])
+            self.selected = None
+            self.sending = []
+            # frames kept for a resumed session no longer count against budget
+            self.release_budget()
+            await self.websocket.close()
+
+    async def send(self, lane: int, data):
+        self.selected = (lane, data)
+        if self.batch is None or len(data) >= self.max_batch_bytes:
+            await self.flush()
+            self.sending = [self.selected]
+            self.selected = None
+            self.sends += 1
+            await self.websocket.send(data)
+            self.sending = []
+            return
+        if self.batched_bytes + len(data) > self.max_batch_bytes:
+            await self.flush()
+        self.batched.append(self.selected)
+        self.selected = None
+        self.batched_bytes += len(data)
+
+    async def flush(self):
+        """
+        Send frames selected for batch, a single frame is sent as is
+        """
+        if not self.batched:
+            return
+        if len(self.batched) == 1:
+            data = self.batched[0][1]
+        else:
+            data = self.batch([data for _, data in self.batched])
+        self.sending = self.batched
+        self.batched = []
+        self.batched_bytes = 0
+        self.sends += 1
+        await self.websocket.send(data)
+        self.sending = []
+
+    async def drain(self) -> bool:
+        """
+        Wait until frames queued so far are sent, return False if the
+        outbox is closed before
+        """
+        while self.pump_task is not None and not self.pump_task.done():
+            await asyncio.shield(self.pump_task)
+        return not self.closed
+
+    def update(self, weights: Sequence[int], quantum: int, max_queued_bytes: int, **_):
+        """
+        Apply outbound settings to an open outbox, frames already queued
+        are kept even beyond a smaller max_queued_bytes
+        """
+        if len(weights) == len(self.lanes):
+            self.weights = weights
+        self.quantum = quantum
+        self.max_queued_bytes = max_queued_bytes
+
+    def take_pending(self) -> list:
+        """
+        Close outbox and return frames not yet sent as list of (lane, data)
+        """
+        pending = self.batched + [
+            (lane, data) for lane, frames in enumerate(self.lanes) for data in frames
+        ]
+        self.close()
+        return pending
+
+    def release_budget(self):
+        """
+        Release bytes of frames waiting in lanes from budget, they are no
+        longer counted afterwards
+        """
+        if self.budget is not None:
+            for lane, frames in enumerate(self.lanes):
+                self.budget.release(lane, sum(len(data) for data in frames))
+            self.budget = None
+
+    def close(self):
+        self.closed = True
+        self.release_budget()
+        for frames in self.lanes:
+            frames.clear()
+        self.queued_bytes = 0
+        self.batched = []
+        self.batched_bytes = 0
@@ -0,0 +1,85 @@
+###############################################
+#                  Group 4                    #
+###############################################
+#             Anlan Zou (a1899146)            #
+#     Czennen Trixter C Tamayo (a1904082)     #
+#           Yan Lok Chan (a1902578)           #
+#          Yu-Ting Huang (a1903622)           #
+###############################################
+
+# Unix domain socket listeners next to the TCP ones, for clients, bots and
+# peer servers on the same host. Access is controlled by the mode of the
+# socket file instead of by address.
+
+import logging
+import os
+import socket
+import stat
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_UNIX_MODE = 0o660
+
+
+def unix_socket_settings(listener_config: dict) -> Optional[dict]:
+    """
+    Socket path and file mode from chat_server or exchange_server section of
+    config, None if no unix_path is configured
+    """
+    path = listener_config.get("unix_path", None)
+    if not path:
+        return None
+    mode = listener_config.get("unix_mode", DEFAULT_UNIX_MODE)
+    # "0660" in yaml is a string, 0660 is read as an octal number already
+    if isinstance(mode, str):
+        mode = int(mode, 8)
+    return {"path": path, "mode": mode}
+
+
+def remove_stale_socket(path: str):
+    """
+    Remove socket file left by a server that is no longer running
+
+    Raises:
+        OSError if path is not a socket or a server is still listening on it
+    """
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(path_stat.st_mode):
+        raise OSError(f"{path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        logger.info(f"removing stale socket {path}")
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f"{path} is in use by another server")
+
+
+def bind_unix_socket(path: str, mode: int = DEFAULT_UNIX_MODE) -> socket.socket:
+    """
+    Bind listening socket at path with the given file mode, for the sock
+    argument of websockets.unix_serve
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    remove_stale_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # owner only until chmod, so that nobody connects in between
+    previous_umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    except OSError:
+        sock.close()
+        raise
+    finally:
+        os.umask(previous_umask)
+    os.chmod(path, mode)
+    return sock